@@ -38,9 +38,10 @@
 # __all__ = ["etc", "etcutils", "fftwconvolve", "galsim", "imutils", "linguineglobals", "lisim", "obssim", "ossim", "satsim", "starsim"]
 
 # Classes
+from configclass import Config
 from telescopeclass import Telescope
 from detectorclass import Detector
 from cryostatclass import Cryostat
 from opticalsystemclass import OpticalSystem
-from skyclass import Sky
+from skyclass import Sky, SkyEmissivity
 from galaxyclass import Galaxy
\ No newline at end of file
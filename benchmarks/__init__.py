@@ -0,0 +1,37 @@
+################################################################################
+#
+# 	File:		__init__.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Benchmarks of the simulation and Lucky Imaging hot paths.
+#
+#	Usage (from the linguinesim directory):
+#		python -m benchmarks run [-o results.json] [-k pattern]
+#		python -m benchmarks compare old.json new.json [--threshold 0.1]
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+
+from .suite import BENCHMARKS
+from .runner import run_benchmarks, save_results, load_results, compare_results
@@ -0,0 +1,75 @@
+################################################################################
+#
+# 	File:		__main__.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Command line interface to the benchmarks.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import sys
+import argparse
+
+from .suite import BENCHMARKS
+from .runner import run_benchmarks, save_results, load_results, compare_results
+
+################################################################################
+def main(argv = None):
+	parser = argparse.ArgumentParser(prog = 'python -m benchmarks', description = 'Benchmarks of the linguinesim hot paths.')
+	subparsers = parser.add_subparsers(dest = 'command')
+
+	parser_run = subparsers.add_parser('run', help = 'run the benchmarks and save the results as JSON')
+	parser_run.add_argument('-o', '--output', default = None, help = 'output file (default: benchmarks_<commit>.json)')
+	parser_run.add_argument('-k', '--pattern', action = 'append', default = None, help = "only run the benchmarks matching this shell-style pattern, e.g. 'lucky_imaging.*' (may be repeated)")
+	parser_run.add_argument('-r', '--repeat', type = int, default = 5, help = 'number of timings of each benchmark')
+	parser_run.add_argument('--min-time', type = float, default = 0.2, help = 'minimum duration (s) of each timing')
+	parser_run.add_argument('-v', '--verbose', action = 'store_true', help = 'show the output of the benchmarked functions')
+
+	parser_compare = subparsers.add_parser('compare', help = 'compare two sets of results; exits with status 1 if there are regressions')
+	parser_compare.add_argument('old')
+	parser_compare.add_argument('new')
+	parser_compare.add_argument('-t', '--threshold', type = float, default = 0.1, help = 'relative slowdown regarded as a regression')
+
+	subparsers.add_parser('list', help = 'list the benchmarks')
+
+	args = parser.parse_args(argv)
+	if args.command == 'run':
+		results = run_benchmarks(patterns = args.pattern, repeat = args.repeat, min_time = args.min_time, quiet = not args.verbose)
+		fname = args.output
+		if fname is None:
+			fname = 'benchmarks_{}.json'.format((results['meta']['commit'] or 'unknown')[:10])
+		save_results(results, fname)
+		print("Results saved to {}".format(fname))
+	elif args.command == 'compare':
+		regressions = compare_results(load_results(args.old), load_results(args.new), threshold = args.threshold)
+		return 1 if regressions else 0
+	elif args.command == 'list':
+		for name in BENCHMARKS:
+			print(name)
+	else:
+		parser.print_help()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,141 @@
+################################################################################
+#
+# 	File:		inputs.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Reproducible synthetic inputs for the benchmarks.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+from collections import OrderedDict
+
+from linguineglobals import *
+import ossim, rngutils
+
+# Every input is generated from this seed so that results can be compared
+# between commits.
+SEED = 42
+
+# Frame sizes (height, width) of the detectors.
+FRAME_SIZES = OrderedDict([
+	('saphira', (256, 320)),
+	('nuvu', (512, 512))
+])
+
+# Size (pixels) of the PSFs used in the convolutions.
+PSF_SIZE_PX = 63
+
+# Oversampling of the truth images relative to the detector.
+OVERSAMPLING = 2
+
+# Number of frames in the Lucky Imaging stacks.
+N_FRAMES = 16
+
+################################################################################
+def optical_system():
+	""" The optical system used in the ETC benchmarks. """
+	return ossim.linguine_optical_system()
+
+################################################################################
+def airy_disc_params(detector):
+	""" The wavelength (m), f ratio and pixel size (m) of the diffraction-limited PSF on each detector. """
+	if detector == 'saphira':
+		telescope = ossim.anu23mTelescope()
+		l_px_m = ossim.saphiraDetector().l_px_m
+		wavelength_m = FILTER_BANDS_M['H'][0]
+		plate_scale_rad_px = l_px_m * telescope.plate_scale_rad_m
+	else:
+		telescope = ossim.eos18mTelescope()
+		l_px_m = ossim.nuvuDetector().l_px_m
+		wavelength_m = FILTER_BANDS_M['I'][0]
+		plate_scale_rad_px = np.deg2rad(0.044 / 3600)	# As in ossim.aoiOpticalSystem()
+	f_ratio = l_px_m / plate_scale_rad_px / telescope.mirrors[0].D_outer_m
+	return wavelength_m, f_ratio, l_px_m
+
+################################################################################
+def galaxy_image(shape,
+	seed = SEED):
+	"""
+		An exponential disc galaxy (with a random inclination, position angle
+		and a little structure) of shape shape in electrons/s/pixel.
+	"""
+	rng = rngutils.get_rng(seed)
+	height, width = shape
+	y, x = np.mgrid[0:height, 0:width]
+	y = y - (height - 1) / 2
+	x = x - (width - 1) / 2
+	theta = rng.uniform(0, np.pi)
+	q = rng.uniform(0.3, 1)
+	r_e = min(shape) / 8
+	x_rot = x * np.cos(theta) + y * np.sin(theta)
+	y_rot = (-x * np.sin(theta) + y * np.cos(theta)) / q
+	r = np.sqrt(x_rot**2 + y_rot**2)
+	im = 100 * np.exp(-r / r_e)
+	im *= 1 + 0.2 * rng.standard_normal(shape)
+	return np.clip(im, 0, None)
+
+################################################################################
+def gaussian_psf(
+	size_px = PSF_SIZE_PX,
+	fwhm_px = 6):
+	""" A normalised Gaussian PSF of size (size_px, size_px). """
+	sigma = fwhm_px / (2 * np.sqrt(2 * np.log(2)))
+	y, x = np.mgrid[0:size_px, 0:size_px] - (size_px - 1) / 2
+	psf = np.exp(-(x**2 + y**2) / (2 * sigma**2))
+	return psf / np.sum(psf)
+
+################################################################################
+def lucky_frames(shape,
+	N = N_FRAMES,
+	sigma_tt_px = 3,
+	seed = SEED):
+	"""
+		A stack of N short-exposure frames of shape shape, each containing a
+		galaxy and a bright star blurred by a Gaussian PSF of random width,
+		shifted by random tip/tilt and with Poisson and read noise added.
+		Returns the frames and a reference frame (without tip/tilt).
+	"""
+	rng = rngutils.get_rng(seed)
+	height, width = shape
+	im = galaxy_image(shape, seed = seed)
+	im[height // 3, width // 3] += 1e4
+	fy = np.fft.fftfreq(height)[:, np.newaxis]
+	fx = np.fft.rfftfreq(width)[np.newaxis, :]
+
+	def _frame(tt, fwhm_px):
+		sigma = fwhm_px / (2 * np.sqrt(2 * np.log(2)))
+		frame_ft = np.fft.rfft2(im)
+		frame_ft *= np.exp(-2 * np.pi**2 * sigma**2 * (fy**2 + fx**2))
+		frame_ft *= np.exp(-2j * np.pi * (fy * tt[0] + fx * tt[1]))
+		return np.clip(np.fft.irfft2(frame_ft, s = shape), 0, None)
+
+	image_ref = _frame((0, 0), 3)
+	tt = sigma_tt_px * rng.standard_normal((N, 2))
+	fwhms_px = rng.uniform(3, 8, N)
+	frames = np.empty((N, height, width))
+	for k in range(N):
+		frames[k] = rng.poisson(_frame(tt[k], fwhms_px[k])) + 5 * rng.standard_normal(shape)
+
+	return frames, image_ref
@@ -0,0 +1,214 @@
+################################################################################
+#
+# 	File:		runner.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Running the benchmarks, storing the results as JSON and comparing the
+#	results of two runs (e.g. at different commits).
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+import sys
+import json
+import time
+import fnmatch
+import platform
+import subprocess
+from timeit import default_timer
+
+from .suite import BENCHMARKS
+from . import inputs
+
+################################################################################
+def run_benchmarks(
+	patterns = None,	# Shell-style patterns (e.g. 'lucky_imaging.*'); if given, only the matching benchmarks are run
+	repeat = 5,			# Number of timings of each benchmark
+	min_time = 0.2,		# Minimum duration (s) of each timing: the benchmark is called as many times as needed
+	quiet = True		# Whether to hide the output printed by the benchmarked functions
+	):
+	"""
+		Run the benchmarks and return the results as a dictionary.
+
+		Each benchmark is called once (untimed) first so that one-off costs
+		such as FFT planning and caching are excluded. It is then timed
+		repeat times, each timing calling it number times, where number is
+		the smallest power of 10 such that a timing takes at least min_time
+		seconds. The time per call of each timing is stored; the minimum is
+		the most reproducible estimate and is used to compare runs.
+	"""
+	names = [name for name in BENCHMARKS if patterns is None or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+	if not names:
+		print("ERROR: no benchmarks match {}!".format(patterns))
+		raise UserWarning
+
+	results = {
+		'meta' : _metadata(repeat, min_time),
+		'benchmarks' : {}
+	}
+	for name in names:
+		with _Silenced(quiet):
+			fun = BENCHMARKS[name]()
+			fun()
+			number = 1
+			while True:
+				t = _time(fun, number)
+				if t >= min_time or number >= 10**6:
+					break
+				number *= 10
+			times = [t / number] + [_time(fun, number) / number for k in range(repeat - 1)]
+		results['benchmarks'][name] = {
+			'times' : times,
+			'min' : min(times),
+			'median' : float(np.median(times)),
+			'number' : number,
+			'repeat' : repeat
+		}
+		print("{:<45s}{:>12s}{:>12s}".format(name, _format_time(min(times)), _format_time(np.median(times))))
+		sys.stdout.flush()
+
+	return results
+
+################################################################################
+def _time(fun, number):
+	tic = default_timer()
+	for k in range(number):
+		fun()
+	return default_timer() - tic
+
+################################################################################
+def _metadata(repeat, min_time):
+	""" Information about the run used to interpret the results. """
+	return {
+		'commit' : _git_commit(),
+		'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python' : platform.python_version(),
+		'numpy' : np.__version__,
+		'platform' : platform.platform(),
+		'N_cpus' : _cpu_count(),
+		'seed' : inputs.SEED,
+		'repeat' : repeat,
+		'min_time' : min_time
+	}
+
+################################################################################
+def _git_commit():
+	""" The commit (with a '+' appended if there are uncommitted changes) of the linguinesim directory, or None. """
+	cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	try:
+		with open(os.devnull, 'w') as devnull:
+			commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = cwd, stderr = devnull).decode().strip()
+			dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = cwd, stderr = devnull).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return commit + '+' if dirty else commit
+
+################################################################################
+def _cpu_count():
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return None
+
+################################################################################
+def _format_time(t):
+	for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+		if t >= scale:
+			return '{:.3g} {}'.format(t / scale, unit)
+	return '{:.3g} ns'.format(t / 1e-9)
+
+################################################################################
+class _Silenced(object):
+	""" Context manager hiding anything printed to stdout (if enabled). """
+
+	def __init__(self, enabled):
+		self.enabled = enabled
+
+	def __enter__(self):
+		if self.enabled:
+			self._stdout = sys.stdout
+			sys.stdout = open(os.devnull, 'w')
+
+	def __exit__(self, *args):
+		if self.enabled:
+			sys.stdout.close()
+			sys.stdout = self._stdout
+
+################################################################################
+def save_results(results, fname):
+	with open(fname, 'w') as f:
+		json.dump(results, f, indent = 4, sort_keys = True)
+
+################################################################################
+def load_results(fname):
+	with open(fname, 'r') as f:
+		return json.load(f)
+
+################################################################################
+def compare_results(results_old, results_new,
+	threshold = 0.1,		# Relative change in the minimum time per call regarded as significant
+	printIt = True):
+	"""
+		Compare two sets of benchmark results (e.g. from two commits) and
+		return the names of the benchmarks that are slower in results_new by
+		more than the fraction threshold (i.e. the regressions).
+
+		Benchmarks are compared using their minimum time per call. Those in
+		only one of the results are listed but not compared.
+	"""
+	old = results_old['benchmarks']
+	new = results_new['benchmarks']
+	regressions = []
+	rows = []
+	for name in sorted(set(old) | set(new)):
+		if name not in old or name not in new:
+			rows.append((name, old.get(name, {}).get('min'), new.get(name, {}).get('min'), None, 'only in {}'.format('old' if name in old else 'new')))
+			continue
+		ratio = new[name]['min'] / old[name]['min']
+		if ratio > 1 + threshold:
+			status = 'REGRESSION'
+			regressions.append(name)
+		elif ratio < 1 / (1 + threshold):
+			status = 'improved'
+		else:
+			status = ''
+		rows.append((name, old[name]['min'], new[name]['min'], ratio, status))
+
+	if printIt:
+		print("Old: {} ({})".format(results_old['meta'].get('commit'), results_old['meta'].get('date')))
+		print("New: {} ({})".format(results_new['meta'].get('commit'), results_new['meta'].get('date')))
+		if results_old['meta'].get('platform') != results_new['meta'].get('platform'):
+			print("WARNING: the results were obtained on different platforms!")
+		print("{:<45s}{:>12s}{:>12s}{:>8s}  {}".format('Benchmark', 'Old', 'New', 'Ratio', ''))
+		for name, t_old, t_new, ratio, status in rows:
+			print("{:<45s}{:>12s}{:>12s}{:>8s}  {}".format(name,
+				_format_time(t_old) if t_old is not None else '-',
+				_format_time(t_new) if t_new is not None else '-',
+				'{:.2f}'.format(ratio) if ratio is not None else '-',
+				status))
+		print("{:d} regression(s) (threshold {:.0f}%)".format(len(regressions), threshold * 100))
+
+	return regressions
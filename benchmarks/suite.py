@@ -0,0 +1,145 @@
+################################################################################
+#
+# 	File:		suite.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	The benchmarks. Each benchmark is a setup function that generates its
+#	inputs and returns a function of no arguments which is timed.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+from collections import OrderedDict
+from functools import partial
+
+import etc, fftwconvolve, lisim, obssim
+from . import inputs
+
+# Setup functions of the benchmarks, keyed by name.
+BENCHMARKS = OrderedDict()
+
+# Lucky Imaging methods benchmarked, keyed by the name used in the benchmark name.
+LI_METHODS = OrderedDict([
+	('xcorr', 'cross-correlation'),
+	('centroid', 'centroid'),
+	('peak_pixel', 'peak pixel'),
+	('gaussian_fit', 'gaussian fit'),
+	('fas', 'fas')
+])
+
+################################################################################
+def benchmark(name,
+	params = None):		# If given, a benchmark named <name>.<param> is registered for each param
+	""" Decorator registering a setup function as a benchmark. """
+	def _register(setup_fun):
+		if params is None:
+			BENCHMARKS[name] = setup_fun
+		else:
+			for param in params:
+				BENCHMARKS['{}.{}'.format(name, param)] = partial(setup_fun, param)
+		return setup_fun
+	return _register
+
+################################################################################
+@benchmark('fftconvolve', params = inputs.FRAME_SIZES)
+def bench_fftconvolve(detector):
+	im = inputs.galaxy_image(inputs.FRAME_SIZES[detector])
+	psf = inputs.gaussian_psf()
+	return partial(fftwconvolve.fftconvolve, im, psf, mode = 'same')
+
+################################################################################
+@benchmark('convolve_psf', params = inputs.FRAME_SIZES)
+def bench_convolve_psf(detector):
+	im = inputs.galaxy_image(inputs.FRAME_SIZES[detector])
+	psf = inputs.gaussian_psf()
+	return partial(obssim.convolve_psf, im, psf)
+
+################################################################################
+@benchmark('airy_disc', params = inputs.FRAME_SIZES)
+def bench_airy_disc(detector):
+	# A PSF-sized stamp: the trapezoidal rule integration is too slow to
+	# evaluate over a whole frame.
+	wavelength_m, f_ratio, l_px_m = inputs.airy_disc_params(detector)
+	return partial(obssim.airy_disc,
+		wavelength_m = wavelength_m,
+		f_ratio = f_ratio,
+		l_px_m = l_px_m,
+		detector_size_px = (inputs.PSF_SIZE_PX, inputs.PSF_SIZE_PX))
+
+################################################################################
+@benchmark('noise_frames_from_etc', params = inputs.FRAME_SIZES)
+def bench_noise_frames_from_etc(detector):
+	height_px, width_px = inputs.FRAME_SIZES[detector]
+	optical_system = inputs.optical_system()
+	etc_output = etc.exposure_time_calc(band = 'H', t_exp = 0.1, optical_system = optical_system, printIt = False)
+	return partial(obssim.noise_frames_from_etc, inputs.N_FRAMES, height_px, width_px,
+		gain = optical_system.detector.gain,
+		etc_input = etc_output,
+		rng = inputs.SEED)
+
+################################################################################
+@benchmark('lucky_frame', params = inputs.FRAME_SIZES)
+def bench_lucky_frame(detector):
+	final_sz = inputs.FRAME_SIZES[detector]
+	im = inputs.galaxy_image([inputs.OVERSAMPLING * n for n in final_sz])
+	psf = inputs.gaussian_psf(fwhm_px = 6 * inputs.OVERSAMPLING)
+	return partial(lisim.lucky_frame, im, psf,
+		scale_factor = inputs.OVERSAMPLING,
+		t_exp = 0.1,
+		final_sz = final_sz,
+		gain = 50,
+		rng = inputs.SEED)
+
+################################################################################
+def bench_lucky_imaging(li_method, detector):
+	frames, image_ref = inputs.lucky_frames(inputs.FRAME_SIZES[detector])
+	return partial(lisim.lucky_imaging, frames, LI_METHODS[li_method],
+		image_ref = image_ref,
+		fsr = 0.5,
+		timeit = False)
+
+for li_method in LI_METHODS:
+	benchmark('lucky_imaging.' + li_method, params = inputs.FRAME_SIZES)(partial(bench_lucky_imaging, li_method))
+
+################################################################################
+@benchmark('exposure_time_calc_warm', params = ('J', 'H', 'K'))
+def bench_exposure_time_calc_warm(band):
+	# The background rates are computed in the warm-up run and are read from
+	# the cache in the timed runs.
+	return partial(etc.exposure_time_calc,
+		band = band,
+		t_exp = 0.1,
+		optical_system = inputs.optical_system(),
+		surface_brightness = 18,
+		magnitude_system = 'AB',
+		printIt = False)
+
+################################################################################
+@benchmark('exposure_time_calc_cold', params = ('J', 'H', 'K'))
+def bench_exposure_time_calc_cold(band):
+	exposure_time_calc = bench_exposure_time_calc_warm(band)
+	def run():
+		# The background rates are computed in every run.
+		etc._background_rates_cache.clear()
+		return exposure_time_calc()
+	return run
@@ -0,0 +1,229 @@
+################################################################################
+#
+# 	File:		cacheutils.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Utilities for caching simulation products on disk.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+import tempfile
+import hashlib
+import functools
+import inspect
+
+################################################################################
+def param_hash(*args):
+	"""
+		Return a hex digest uniquely identifying the input parameters.
+
+		The digest is stable between sessions and processes (unlike hash()),
+		so it can be used to name files on disk. Scalars, strings, None,
+		tuples, lists, dicts, numpy arrays, module-level functions (hashed by
+		their qualified name), functools.partial objects and plain objects
+		(hashed by their class name and attributes) are supported.
+	"""
+	h = hashlib.sha1()
+	for arg in args:
+		_update_hash(h, arg)
+	return h.hexdigest()
+
+################################################################################
+def _update_hash(h, arg):
+	""" Recursively feed the value arg into the hash object h. """
+	if arg is None or isinstance(arg, (bool, str)):
+		h.update(repr(arg).encode('utf-8'))
+	elif isinstance(arg, np.ndarray):
+		h.update('ndarray{}{}'.format(arg.dtype.str, arg.shape).encode('utf-8'))
+		h.update(np.ascontiguousarray(arg).tobytes())
+	elif isinstance(arg, np.generic):
+		_update_hash(h, arg.item())
+	elif isinstance(arg, (int, float, complex)):
+		# Make sure that 1 and 1.0 give the same digest.
+		h.update(repr(float(arg) if not isinstance(arg, complex) else arg).encode('utf-8'))
+	elif isinstance(arg, (tuple, list)):
+		h.update('({:d}'.format(len(arg)).encode('utf-8'))
+		for item in arg:
+			_update_hash(h, item)
+		h.update(b')')
+	elif isinstance(arg, dict):
+		h.update('{{{:d}'.format(len(arg)).encode('utf-8'))
+		for key in sorted(arg, key=repr):
+			_update_hash(h, key)
+			_update_hash(h, arg[key])
+		h.update(b'}')
+	elif isinstance(arg, functools.partial):
+		h.update(b'partial')
+		_update_hash(h, (arg.func, arg.args, arg.keywords or {}))
+	elif inspect.isfunction(arg) or inspect.isbuiltin(arg) or inspect.isclass(arg):
+		h.update('{}.{}'.format(arg.__module__, getattr(arg, '__qualname__', arg.__name__)).encode('utf-8'))
+	elif hasattr(arg, 'digest') and callable(arg.digest):
+		# Config instances (see configclass.py)
+		h.update(type(arg).__name__.encode('utf-8'))
+		h.update(arg.digest().encode('utf-8'))
+	elif hasattr(arg, '__dict__'):
+		h.update(type(arg).__name__.encode('utf-8'))
+		_update_hash(h, vars(arg))
+	else:
+		h.update(repr(arg).encode('utf-8'))
+
+################################################################################
+def save_npy_atomic(fname, arr):
+	""" 
+		Save arr to the .npy file fname. The array is written to a temporary 
+		file first so that other processes never see a partially-written file. 
+	"""
+	fd, tmp_fname = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(fname)), suffix = '.npy.tmp')
+	with os.fdopen(fd, 'wb') as f:
+		np.save(f, np.asarray(arr))
+	os.rename(tmp_fname, fname)
+
+################################################################################
+def cached_array(fname, compute_fun,
+	recompute = False):
+	"""
+		Return the array stored in the .npy file fname as a read-only 
+		memory-mapped array. If the file does not exist (or recompute is 
+		True), then compute_fun() is called to compute the array, which is 
+		saved to fname first.
+	"""
+	if not recompute:
+		try:
+			return np.load(fname, mmap_mode = 'r')
+		except (IOError, OSError, ValueError):
+			pass
+	save_npy_atomic(fname, compute_fun())
+	return np.load(fname, mmap_mode = 'r')
+
+################################################################################
+class TruthImageCache(object):
+
+	def __init__(self, 
+		cache_dir = 'truth_cache',
+		max_size_bytes = 2 * 1024**3
+		):
+		"""
+			A content-addressed cache of simulated truth images stored on disk 
+			in cache_dir as .npy files named by the hash of the parameters 
+			used to generate them.
+
+			Images are returned as read-only memory-mapped arrays. When the 
+			total size of the cache exceeds max_size_bytes, the least recently 
+			used images are deleted. The last access time of each image is 
+			stored as the modification time of its file, so a cache directory 
+			can be shared between processes.
+		"""
+		self.cache_dir = cache_dir
+		self.max_size_bytes = max_size_bytes
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+		# Statistics
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, galaxy, plate_scale_as_px, size_px, zeropoint, band):
+		""" Return the cache key of the truth image of a Galaxy instance. """
+		return param_hash(galaxy, plate_scale_as_px, tuple(size_px), zeropoint, band)
+
+	def fname(self, key):
+		return os.path.join(self.cache_dir, key + '.npy')
+
+	def get(self, key):
+		""" Return the image stored under key, or None if it is not in the cache. """
+		fname = self.fname(key)
+		try:
+			im = np.load(fname, mmap_mode = 'r')
+		except (IOError, OSError, ValueError):
+			self.misses += 1
+			return None
+		self.hits += 1
+		# Mark the image as recently used.
+		try:
+			os.utime(fname, None)
+		except OSError:
+			pass
+		return im
+
+	def put(self, key, im):
+		""" Store the image im under key and return a memory-mapped copy. """
+		fname = self.fname(key)
+		save_npy_atomic(fname, im)
+		self.evict(keep = fname)
+		return np.load(fname, mmap_mode = 'r')
+
+	def get_or_render(self, key, render_fun):
+		""" Return the image stored under key, calling render_fun() to generate it if it is not in the cache. """
+		im = self.get(key)
+		if im is None:
+			im = self.put(key, render_fun())
+		return im
+
+	def evict(self, 
+		keep = None):
+		""" 
+			Delete the least recently used images until the cache is within 
+			its size limit. The file keep (if given) is never deleted. 
+		"""
+		entries = self._entries()
+		size_bytes = sum(entry[1] for entry in entries)
+		for _, nbytes, fname in sorted(entries):
+			if size_bytes <= self.max_size_bytes:
+				break
+			if fname == keep:
+				continue
+			try:
+				os.remove(fname)
+			except OSError:
+				pass
+			size_bytes -= nbytes
+		return size_bytes
+
+	def stats(self):
+		""" Return the cache hit/miss statistics. """
+		entries = self._entries()
+		N_lookups = self.hits + self.misses
+		return {
+			'hits' : self.hits,
+			'misses' : self.misses,
+			'hit_rate' : self.hits / N_lookups if N_lookups else 0.0,
+			'N_images' : len(entries),
+			'size_bytes' : sum(entry[1] for entry in entries)
+		}
+
+	def _entries(self):
+		""" Return the (last access time, size, file name) of each image in the cache. """
+		entries = []
+		for fname in os.listdir(self.cache_dir):
+			if not fname.endswith('.npy'):
+				continue
+			fname = os.path.join(self.cache_dir, fname)
+			try:
+				stat = os.stat(fname)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, fname))
+		return entries
@@ -0,0 +1,439 @@
+################################################################################
+#
+# 	File:		campaign.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Running large parameter sweeps (campaigns) of simulations on a local pool
+#	of worker processes, with checkpointing so that an interrupted campaign
+#	can be resumed.
+#
+#	Usage:
+#		spec = {
+#			'sweep' : {
+#				'galaxy' : [Galaxy(...), {'name' : 'gal2', 'R_e_as' : 1, ...}],
+#				'band' : ['J', 'H'],
+#				'seeing_as' : [0.8, 1.2],
+#				't_exp' : [0.01, 0.1],
+#				'gain' : [1, 50],
+#				'li_method' : ['cross-correlation', 'peak pixel']
+#			},
+#			'fixed' : {
+#				'N_frames' : 1000,
+#				'fsr' : 0.1
+#			}
+#		}
+#		campaign = Campaign(spec, out_dir = 'campaign')
+#		campaign.run()		# run again to resume after an interruption
+#		results = campaign.results()
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+import json
+import time
+import itertools
+import traceback
+from multiprocessing import Pool as ProcPool			# no dummy = Processes
+
+# linguine modules
+from galaxyclass import Galaxy
+from cacheutils import param_hash, save_npy_atomic, cached_array, TruthImageCache
+import etcutils, galsim, lisim, obssim, ossim, psfsim, rngutils
+
+# Parameters of the default task, lucky_imaging_task(), that are not swept
+# over. These are overridden by the 'fixed' parameters of a campaign spec.
+DEFAULT_PARAMS = {
+	'N_frames' : 100,				# Number of frames in each sequence
+	'fsr' : 1,						# Frame selection rate
+	'oversampling' : 2,				# Oversampling of the truth image relative to the detector
+	'psf_size_px' : 64,				# Size of the seeing-limited PSF (at the oversampled plate scale)
+	'sigma_tt_px' : 0,				# rms tip/tilt (detector pixels)
+	'magnitude_system' : 'AB',		# Magnitude system of the galaxies' surface brightnesses
+	'seed' : 1						# Seed from which the random numbers of every task are derived
+}
+
+################################################################################
+def expand_spec(spec):
+	"""
+		Expand a campaign specification into a list of tasks, each of which
+		is a dictionary of parameters.
+
+		spec is a dictionary containing
+			'sweep'		a dictionary mapping each swept parameter to a list
+						of its values: a task is created for every
+						combination of values
+			'fixed'		(optional) a dictionary of parameters common to
+						every task.
+		The values of 'galaxy' may be either Galaxy instances or dictionaries
+		of the arguments used to create them (e.g. when the spec is read
+		from a JSON file). The tasks are ordered by the swept parameters in
+		alphabetical order, so the order does not depend on that of spec.
+	"""
+	sweep = spec.get('sweep', {})
+	fixed = spec.get('fixed', {})
+	for key in sweep:
+		if key in fixed:
+			print("ERROR: parameter '{}' cannot be both swept and fixed!".format(key))
+			raise UserWarning
+		if len(sweep[key]) == 0:
+			print("ERROR: no values are given for swept parameter '{}'!".format(key))
+			raise UserWarning
+
+	keys = sorted(sweep)
+	tasks = []
+	for values in itertools.product(*[sweep[key] for key in keys]):
+		params = dict(fixed)
+		params.update(zip(keys, values))
+		if isinstance(params.get('galaxy'), dict):
+			params['galaxy'] = Galaxy(**params['galaxy'])
+		tasks.append(params)
+	return tasks
+
+################################################################################
+class Campaign(object):
+
+	def __init__(self, spec,
+		out_dir = 'campaign',			# Directory in which the outputs and the manifest are stored
+		task_fun = None,				# By default, lucky_imaging_task()
+		optical_system_fun = ossim.linguine_optical_system,
+		cache_dir = None,				# By default, out_dir/cache
+		psf_dir = None					# If given, the PSFs are read from the cubes written to psf_dir by psfsim.generate_psf_cubes()
+		):
+		"""
+			A campaign: a sweep over the parameters given in spec (see
+			expand_spec()) in which each combination of parameters is a task
+			that is run in a worker process by task_fun(task_id, params,
+			context). task_fun must be picklable (i.e. a module-level
+			function or a functools.partial of one) and must return a
+			JSON-serialisable result. context is a dictionary containing
+			out_dir, cache_dir, psf_dir and optical_system_fun, which must
+			return a new OpticalSystem instance and must also be picklable.
+
+			Each task is identified by a hash of its parameters (see
+			tasks()). When a task has finished, its result is appended to the
+			manifest file (manifest.jsonl in out_dir) by the parent process,
+			so that when the campaign is run again (e.g. after it was
+			interrupted, or after more values have been added to the sweep)
+			only the tasks that are not in the manifest are run. Tasks that
+			raised an exception are recorded along with the traceback and are
+			retried.
+
+			The truth images and PSFs are cached on disk in cache_dir, which
+			may be shared between campaigns, so each is computed only once
+			and is then read (memory-mapped) by every task that uses it.
+		"""
+		self.spec = spec
+		self.out_dir = out_dir
+		self.task_fun = task_fun if task_fun is not None else lucky_imaging_task
+		self.optical_system_fun = optical_system_fun
+		self.cache_dir = cache_dir if cache_dir is not None else os.path.join(out_dir, 'cache')
+		self.psf_dir = psf_dir
+		if self.psf_dir is not None and self.task_fun is lucky_imaging_task:
+			for params in expand_spec(self.spec):
+				_check_psf_params(params, self.psf_dir)
+		self.manifest_fname = os.path.join(out_dir, 'manifest.jsonl')
+		for dirname in [self.out_dir, self.cache_dir, os.path.join(self.cache_dir, 'truth'), os.path.join(self.cache_dir, 'psfs')]:
+			if not os.path.exists(dirname):
+				os.makedirs(dirname)
+
+	def tasks(self):
+		"""
+			Returns a list of the (task ID, parameters) of every task in the
+			campaign. The task ID is a hash of the parameters together with
+			DEFAULT_PARAMS, the task function, the optical system function
+			and the PSF cubes (if psf_dir is given), so that a task is run
+			again if any of these change.
+		"""
+		tasks = []
+		for params in expand_spec(self.spec):
+			psf_cube_params = psfsim.load_psf_cube_params(params.get('band'), self.psf_dir) if self.psf_dir is not None else None
+			task_id = param_hash(params, DEFAULT_PARAMS, self.task_fun, self.optical_system_fun,
+				os.path.abspath(self.psf_dir) if self.psf_dir is not None else None, psf_cube_params)
+			tasks.append((task_id, params))
+		return tasks
+
+	def completed(self):
+		"""
+			Returns a dictionary mapping the ID of each task that has
+			finished successfully to its entry in the manifest. Tasks whose
+			output file has since been deleted are not included.
+		"""
+		completed = {}
+		if not os.path.isfile(self.manifest_fname):
+			return completed
+		with open(self.manifest_fname, 'r') as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# The last line may be incomplete if the campaign was killed
+					# while writing it.
+					continue
+				if entry['error'] is not None:
+					continue
+				result = entry['result']
+				if isinstance(result, dict) and 'fname' in result and not os.path.isfile(result['fname']):
+					continue
+				completed[entry['task_id']] = entry
+		return completed
+
+	def pending(self):
+		""" Returns a list of the (task ID, parameters) of the tasks that have not yet finished successfully. """
+		completed = self.completed()
+		return [(task_id, params) for task_id, params in self.tasks() if task_id not in completed]
+
+	def context(self):
+		return {
+			'out_dir' : os.path.abspath(self.out_dir),
+			'cache_dir' : os.path.abspath(self.cache_dir),
+			'psf_dir' : os.path.abspath(self.psf_dir) if self.psf_dir is not None else None,
+			'optical_system_fun' : self.optical_system_fun
+		}
+
+	def run(self,
+		N_workers = None,		# Number of worker processes (default: number of CPUs). If 1, the tasks are run in this process
+		max_tasks = None,		# If given, at most max_tasks tasks are run
+		timeit = True
+		):
+		"""
+			Run the tasks that have not yet finished successfully and record
+			each one in the manifest as soon as it finishes. The campaign
+			can be interrupted at any time and resumed by calling run()
+			again. Returns a list of the manifest entries of the tasks run,
+			in the order in which they finished.
+		"""
+		tic = time.time()
+		N_tasks = len(self.tasks())
+		pending = self.pending()
+		if max_tasks is not None:
+			pending = pending[:max_tasks]
+		if timeit:
+			print("CAMPAIGN {}: {:d} of {:d} tasks finished, running {:d}...".format(self.out_dir, N_tasks - len(self.pending()), N_tasks, len(pending)))
+
+		context = self.context()
+		tasks = [(self.task_fun, task_id, params, context) for task_id, params in pending]
+		entries = []
+		pool = None
+		if N_workers == 1:
+			outputs = (_campaign_worker(task) for task in tasks)
+		else:
+			pool = ProcPool(N_workers)
+			outputs = pool.imap_unordered(_campaign_worker, tasks, 1)
+		try:
+			with open(self.manifest_fname, 'a') as f:
+				for entry in outputs:
+					f.write(json.dumps(entry, default = _json_default) + '\n')
+					f.flush()
+					os.fsync(f.fileno())
+					entries.append(entry)
+					if timeit:
+						print("CAMPAIGN TASK {:d}/{:d} ({}): {} in {:.5f} s".format(len(entries), len(pending), entry['task_id'][:10],
+							'done' if entry['error'] is None else 'FAILED', entry['time_s']))
+					if entry['error'] is not None:
+						print(entry['error'].rstrip())
+			if pool is not None:
+				pool.close()
+		finally:
+			if pool is not None:
+				# If the campaign was interrupted, the tasks still running are
+				# abandoned; they will be run again when the campaign is resumed.
+				pool.terminate()
+				pool.join()
+
+		if timeit:
+			N_failed = len([entry for entry in entries if entry['error'] is not None])
+			print("CAMPAIGN {}: {:d} tasks run ({:d} failed) in {:.5f} s".format(self.out_dir, len(entries), N_failed, time.time() - tic))
+
+		return entries
+
+	def results(self):
+		""" Returns a list of the manifest entries of the tasks that have finished successfully, in task order. """
+		completed = self.completed()
+		return [completed[task_id] for task_id, _ in self.tasks() if task_id in completed]
+
+################################################################################
+def _campaign_worker(task):
+	"""
+		A private method used by Campaign.run() to run a single task in a
+		worker process. Exceptions are caught so that a failed task does not
+		stop the campaign.
+	"""
+	tic = time.time()
+	task_fun, task_id, params, context = task
+	result = None
+	error = None
+	try:
+		result = task_fun(task_id, params, context)
+	except Exception:
+		error = traceback.format_exc()
+
+	return {
+		'task_id' : task_id,
+		'params' : params,
+		'result' : result,
+		'error' : error,
+		'time_s' : time.time() - tic,
+		'finished' : time.strftime('%Y-%m-%dT%H:%M:%S')
+	}
+
+def _json_default(obj):
+	""" Convert the objects in manifest entries (e.g. Galaxy instances and numpy scalars) to JSON. """
+	if isinstance(obj, np.generic):
+		return obj.item()
+	if isinstance(obj, np.ndarray):
+		return obj.tolist()
+	if hasattr(obj, '__dict__'):
+		return vars(obj)
+	return repr(obj)
+
+################################################################################
+def lucky_imaging_task(task_id, params, context):
+	"""
+		The default campaign task: simulate a sequence of Lucky Imaging
+		frames of a galaxy and apply a Lucky Imaging method to them.
+
+		params must contain galaxy, band, seeing_as (FWHM, arcsec), t_exp,
+		gain and li_method; the other parameters default to the values in
+		DEFAULT_PARAMS. If context['psf_dir'] is given, the PSFs are instead
+		read from the cubes in psf_dir, and seeing_as must not be given.
+		The random numbers are derived from the seed and the task ID, so
+		the output of a task does not depend on which worker runs it or on
+		the order in which tasks are run.
+
+		The stacked image is saved to <task_id>.npy in the output directory.
+	"""
+	p = dict(DEFAULT_PARAMS)
+	p.update(params)
+	galaxy = p['galaxy']
+	band = p['band']
+	gain = p['gain']
+	N_frames = p['N_frames']
+	oversampling = p['oversampling']
+
+	optical_system = context['optical_system_fun']()
+	optical_system.detector.gain = gain
+	# Frozen so that the ETC's cached background rates are looked up cheaply.
+	optical_system = optical_system.frozen()
+	height_px, width_px = optical_system.detector.size_px
+	plate_scale_as_px_conv = optical_system.plate_scale_as_px / oversampling
+
+	# Truth image in units of electrons/s/pixel at the oversampled plate
+	# scale. sersic_image() returns 10**(-(mu - zeropoint) / 2.5) * plate
+	# scale**2 in each pixel, so we choose the zeropoint for which this is
+	# the count rate of a pixel with surface brightness mu.
+	telescope = optical_system.telescope
+	tau = telescope.tau * optical_system.cryostat.Tr_win if optical_system.cryostat is not None else telescope.tau
+	count_rate_mu_0 = etcutils.surface_brightness_to_count_rate(mu = 0,
+		A_tel = telescope.A_collecting_m2,
+		plate_scale_as_px = plate_scale_as_px_conv,
+		tau = tau,
+		qe = optical_system.detector.qe,
+		gain = 1,
+		magnitude_system = p['magnitude_system'],
+		band = band)
+	zeropoint = 2.5 * np.log10(count_rate_mu_0 / plate_scale_as_px_conv**2)
+	im = galsim.get_truth_image(galaxy,
+		height_px = height_px * oversampling,
+		width_px = width_px * oversampling,
+		plate_scale_as_px = plate_scale_as_px_conv,
+		band = band,
+		zeropoint = zeropoint,
+		cache = TruthImageCache(os.path.join(context['cache_dir'], 'truth')))
+
+	# PSFs.
+	if context['psf_dir'] is not None:
+		_check_psf_params(p, context['psf_dir'])
+		psf = psfsim.load_psf_cube(band, context['psf_dir'])[:N_frames]
+	else:
+		psf = seeing_psf(p['seeing_as'], plate_scale_as_px_conv, p['psf_size_px'],
+			cache_dir = os.path.join(context['cache_dir'], 'psfs'))
+
+	# Random numbers.
+	seed = int(param_hash(p['seed'], task_id)[:8], 16)
+	streams = rngutils.FrameStreams(seed)
+	tt = obssim.TipTiltGenerator(p['sigma_tt_px'], 1 / p['t_exp'], rng = rngutils.get_rng(seed)).next(N_frames) if p['sigma_tt_px'] > 0 else np.zeros((N_frames, 2))
+
+	noise_frames, _ = obssim.noise_frames_from_etc(N_frames, height_px, width_px,
+		gain = gain,
+		band = band,
+		t_exp = p['t_exp'],
+		optical_system = optical_system,
+		rng = streams)
+	frames = lisim.lucky_frames(im, psf,
+		scale_factor = oversampling,
+		t_exp = p['t_exp'],
+		final_sz = (height_px, width_px),
+		tt = tt,
+		noise_frames_gain_multiplied = noise_frames['gain-multiplied'],
+		noise_frames_post_gain = noise_frames['post-gain'],
+		gain = gain,
+		detector_saturation = optical_system.detector.saturation,
+		rng = streams)
+	del noise_frames
+
+	image_stacked, _ = lisim.lucky_imaging(frames, p['li_method'],
+		fsr = p['fsr'],
+		timeit = False)
+
+	fname = os.path.join(context['out_dir'], task_id + '.npy')
+	save_npy_atomic(fname, image_stacked)
+	return {
+		'fname' : fname,
+		'peak' : float(np.max(image_stacked)),
+		'sum' : float(np.sum(image_stacked))
+	}
+
+def _check_psf_params(params, psf_dir):
+	"""
+		A private method used to check that the PSFs of a lucky_imaging_task()
+		with the given parameters can be read from the cubes in psf_dir.
+	"""
+	if 'seeing_as' in params:
+		print("ERROR: seeing_as cannot be given when the PSFs are read from psf_dir! The seeing is that used to generate the PSF cubes.")
+		raise UserWarning
+	psf_cube_params = psfsim.load_psf_cube_params(params['band'], psf_dir)
+	N_frames = params.get('N_frames', DEFAULT_PARAMS['N_frames'])
+	if psf_cube_params is not None and psf_cube_params['N_frames'] < N_frames:
+		print("ERROR: the PSF cube in band {} in {} contains only {:d} frames, but {:d} are needed!".format(params['band'], psf_dir, psf_cube_params['N_frames'], N_frames))
+		raise UserWarning
+
+################################################################################
+def seeing_psf(seeing_as, plate_scale_as_px, size_px,
+	cache_dir = 'psfs'):
+	"""
+		Returns a normalised Gaussian PSF with FWHM seeing_as of size
+		(size_px, size_px), cached in cache_dir so that it is shared between
+		tasks (and processes).
+	"""
+	def compute_psf():
+		sigma_px = seeing_as / (2 * np.sqrt(2 * np.log(2))) / plate_scale_as_px
+		y, x = np.mgrid[0:size_px, 0:size_px] - (size_px - 1) / 2
+		psf = np.exp(-(x**2 + y**2) / (2 * sigma_px**2))
+		return psf / np.sum(psf)
+
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	fname = os.path.join(cache_dir, 'psf_seeing_{}.npy'.format(param_hash(seeing_as, plate_scale_as_px, size_px)))
+	return cached_array(fname, compute_psf)
@@ -0,0 +1,187 @@
+################################################################################
+#
+# 	File:		configclass.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	A base class for configuration objects (telescopes, detectors, etc.)
+#	that can be frozen, hashed by their contents and pickled cheaply.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import copy
+
+from cacheutils import param_hash
+
+# Names of the fields of each Config subclass, in the order in which they are
+# pickled.
+_field_names = {}
+
+################################################################################
+class Config(object):
+	"""
+		A base class for configuration objects whose fields are given by
+		__slots__.
+
+		A Config instance can be modified until freeze() is called, after
+		which assigning to its fields raises an error. frozen() returns a
+		frozen copy, leaving the original untouched. Lists, dictionaries and
+		numpy arrays stored in a frozen instance are made immutable too, as
+		are the Config instances it contains.
+
+		digest() returns a stable hash of the contents, which can be used
+		(directly, or by passing the instance to cacheutils.param_hash()) to
+		key caches on disk or in memory. Instances with the same class and
+		contents compare equal. Frozen instances are also hashable, so they
+		can be used as dictionary keys.
+
+		Instances are pickled as a tuple of their field values, which is
+		cheaper than pickling a __dict__.
+	"""
+
+	__slots__ = ['_frozen', '_digest']
+
+	def __new__(cls, *args, **kwargs):
+		self = object.__new__(cls)
+		object.__setattr__(self, '_frozen', False)
+		object.__setattr__(self, '_digest', None)
+		return self
+
+	def __setattr__(self, name, value):
+		if self._frozen:
+			print("ERROR: cannot set {}.{}: the instance is frozen! Modify a copy instead.".format(type(self).__name__, name))
+			raise UserWarning
+		object.__setattr__(self, name, value)
+
+	def fields(self):
+		""" Returns a list of the (name, value) of each field that has been set. """
+		return [(name, getattr(self, name)) for name in _get_field_names(type(self)) if hasattr(self, name)]
+
+	def freeze(self):
+		""" Make this instance immutable and return it. """
+		if self._frozen:
+			return self
+		for name, value in self.fields():
+			object.__setattr__(self, name, _freeze_value(value))
+		object.__setattr__(self, '_frozen', True)
+		return self
+
+	def frozen(self):
+		""" Returns a frozen copy of this instance (or the instance itself if it is already frozen). """
+		if self._frozen:
+			return self
+		return copy.deepcopy(self).freeze()
+
+	@property
+	def is_frozen(self):
+		return self._frozen
+
+	def digest(self):
+		""" Returns a hex digest of the class and contents of this instance (computed only once if it is frozen). """
+		if self._digest is not None:
+			return self._digest
+		digest = param_hash(type(self).__name__, dict(self.fields()))
+		if self._frozen:
+			object.__setattr__(self, '_digest', digest)
+		return digest
+
+	def __eq__(self, other):
+		return type(self) is type(other) and self.digest() == other.digest()
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		if not self._frozen:
+			raise TypeError("unhashable type: '{}' (use frozen() to get a hashable copy)".format(type(self).__name__))
+		return int(self.digest()[:15], 16)
+
+	def __getstate__(self):
+		return (self._frozen, self._digest, tuple(getattr(self, name, _UNSET) for name in _get_field_names(type(self))))
+
+	def __setstate__(self, state):
+		frozen, digest, values = state
+		for name, value in zip(_get_field_names(type(self)), values):
+			if value is not _UNSET:
+				object.__setattr__(self, name, value)
+		object.__setattr__(self, '_frozen', frozen)
+		object.__setattr__(self, '_digest', digest)
+
+	def __repr__(self):
+		return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, value) for name, value in self.fields()))
+
+################################################################################
+class _Unset(object):
+	""" Placeholder for a field that has not been set, used when pickling. """
+
+	def __reduce__(self):
+		return '_UNSET'
+
+_UNSET = _Unset()
+
+################################################################################
+class FrozenDict(dict):
+	""" A dictionary that cannot be modified, used for the dictionaries stored in frozen Config instances. """
+
+	def _immutable(self, *args, **kwargs):
+		print("ERROR: cannot modify a dictionary stored in a frozen instance! Modify a copy instead.")
+		raise UserWarning
+
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+	def __reduce__(self):
+		return (FrozenDict, (dict(self),))
+
+	def __hash__(self):
+		return int(param_hash(dict(self))[:15], 16)
+
+################################################################################
+def _get_field_names(cls):
+	""" Returns the names of the fields (i.e. the __slots__, excluding those of Config) of a Config subclass. """
+	try:
+		return _field_names[cls]
+	except KeyError:
+		pass
+	names = []
+	for klass in reversed(cls.__mro__):
+		if klass is Config or klass is object:
+			continue
+		slots = klass.__dict__.get('__slots__', [])
+		if isinstance(slots, str):
+			slots = [slots]
+		names += [name for name in slots if name not in names]
+	_field_names[cls] = tuple(names)
+	return _field_names[cls]
+
+def _freeze_value(value):
+	""" Returns an immutable version of value. """
+	if isinstance(value, Config):
+		return value.freeze()
+	if isinstance(value, (list, tuple)):
+		return tuple(_freeze_value(item) for item in value)
+	if isinstance(value, dict) and not isinstance(value, FrozenDict):
+		return FrozenDict((key, _freeze_value(item)) for key, item in value.items())
+	if isinstance(value, np.ndarray):
+		value.setflags(write = False)
+	return value
@@ -28,9 +28,12 @@
 #
 ################################################################################
 from __future__ import division, print_function
+from configclass import Config
 
 ################################################################################
-class Cryostat(object):
+class Cryostat(Config):
+
+	__slots__ = ['T', 'Tr_win', 'Omega', 'eps_wall', 'eps_win']
 
 	def __init__(self,
 		T, 
@@ -0,0 +1,214 @@
+################################################################################
+#
+# 	File:		cubestore.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	A chunked, compressed container for simulated Lucky Imaging datasets.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import json
+try:
+	import h5py
+	HAS_H5PY = True
+except ImportError:
+	HAS_H5PY = False
+
+################################################################################
+class CubeStore(object):
+
+	def __init__(self, fname,
+		mode = 'r',			# 'r' (read-only), 'a' (read/append) or 'w' (create, overwriting any existing file)
+		height_px = None,	# Frame dimensions (required when creating a new file)
+		width_px = None,
+		dtype = np.float32,
+		chunk_frames = 16,	# Number of frames per chunk along the time axis
+		compression = 'gzip',
+		provenance = None	# Dictionary describing how the frames were generated
+		):
+		"""
+			An HDF5 container holding a cube of simulated frames together with
+			the tip/tilt applied to each frame, any per-frame quality metrics
+			(e.g. the peak pixel value or the Strehl ratio) and a provenance
+			dictionary (e.g. the ETC output and the simulation parameters).
+
+			The frames are stored compressed in chunks of chunk_frames frames
+			along the time axis, so that a range of frames can be read without
+			decompressing the rest of the cube. Frames can be appended to the
+			file as they are simulated using append().
+
+			File layout:
+				frames 				(N, height_px, width_px)
+				tt 					(N, 2) tip/tilt (pixels); NaN if unknown
+				metrics/<name>		(N,) per-frame metrics; NaN if unknown
+				attrs['provenance']	JSON-encoded provenance dictionary
+		"""
+		if not HAS_H5PY:
+			print("ERROR: h5py must be installed to use a CubeStore!")
+			raise UserWarning
+		self.fname = fname
+		self.f = h5py.File(fname, mode)
+
+		if 'frames' not in self.f:
+			if mode == 'r':
+				print("ERROR: {} does not contain a frame cube!".format(fname))
+				raise UserWarning
+			if height_px is None or width_px is None:
+				print("ERROR: height_px and width_px must be specified when creating a new CubeStore!")
+				raise UserWarning
+			self.f.create_dataset('frames',
+				shape = (0, height_px, width_px),
+				maxshape = (None, height_px, width_px),
+				chunks = (chunk_frames, height_px, width_px),
+				dtype = dtype,
+				compression = compression,
+				shuffle = compression is not None)
+			self.f.create_dataset('tt',
+				shape = (0, 2),
+				maxshape = (None, 2),
+				chunks = (max(chunk_frames, 1024), 2),
+				dtype = np.float64)
+			self.f.create_group('metrics')
+			self.f.attrs['provenance'] = json.dumps({})
+
+		if provenance is not None:
+			self.set_provenance(provenance)
+
+	def __len__(self):
+		return self.f['frames'].shape[0]
+
+	@property
+	def shape(self):
+		return self.f['frames'].shape
+
+	def append(self, frames,
+		tt = None,			# Tip/tilt of each frame, shape (N, 2)
+		metrics = None):	# Dictionary of per-frame metrics, each of shape (N,)
+		""" Append a frame or a cube of frames to the end of the file. """
+		frames = np.asarray(frames)
+		if frames.ndim == 2:
+			frames = frames[np.newaxis]
+		N_new = frames.shape[0]
+		N_old = len(self)
+		N = N_old + N_new
+
+		self.f['frames'].resize(N, axis=0)
+		self.f['frames'][N_old:N] = frames
+
+		self.f['tt'].resize(N, axis=0)
+		if tt is not None:
+			self.f['tt'][N_old:N] = np.reshape(tt, (N_new, 2))
+		else:
+			self.f['tt'][N_old:N] = np.nan
+
+		# Metrics that are not given for these frames are set to NaN.
+		metrics = metrics if metrics is not None else {}
+		for name in set(metrics) | set(self.f['metrics']):
+			if name not in self.f['metrics']:
+				self.f['metrics'].create_dataset(name,
+					shape = (N_old,),
+					maxshape = (None,),
+					chunks = (1024,),
+					dtype = np.float64,
+					fillvalue = np.nan)
+			dset = self.f['metrics'][name]
+			dset.resize(N, axis=0)
+			if name in metrics:
+				dset[N_old:N] = np.reshape(metrics[name], (N_new,))
+			else:
+				dset[N_old:N] = np.nan
+
+		self.f.flush()
+
+	def read_frames(self,
+		start = 0,
+		stop = None):
+		""" Return frames start to stop - 1, reading only the chunks containing them. """
+		return self.f['frames'][start:stop]
+
+	def __getitem__(self, key):
+		return self.f['frames'][key]
+
+	def select(self, idxs):
+		""" Return the frames with indices idxs (in the order given). """
+		idxs = np.asarray(idxs, dtype=int)
+		# HDF5 requires the indices to be increasing and unique.
+		idxs_unique, idxs_inverse = np.unique(idxs, return_inverse=True)
+		return self.f['frames'][idxs_unique.tolist()][idxs_inverse]
+
+	def select_best(self, metric, fsr):
+		""" Return the indices of the fraction fsr of frames with the highest values of the given metric, and the frames themselves. """
+		vals = self.metric(metric)
+		# Frames without a value for this metric are never selected.
+		vals[np.isnan(vals)] = -np.inf
+		N_valid = np.sum(np.isfinite(vals))
+		if N_valid == 0:
+			print("ERROR: no frame in the cube has a value for metric '{}'!".format(metric))
+			raise UserWarning
+		N_frames_to_keep = max(1, int(np.round(fsr * N_valid)))
+		idxs = np.sort(np.argsort(vals)[::-1][:N_frames_to_keep])
+		return idxs, self.select(idxs)
+
+	def tt(self,
+		start = 0,
+		stop = None):
+		return self.f['tt'][start:stop]
+
+	def metric(self, name,
+		start = 0,
+		stop = None):
+		return self.f['metrics'][name][start:stop]
+
+	@property
+	def metric_names(self):
+		return list(self.f['metrics'])
+
+	@property
+	def provenance(self):
+		return json.loads(self.f.attrs['provenance'])
+
+	def set_provenance(self, provenance):
+		""" Update the provenance dictionary with the entries in provenance. """
+		prov = self.provenance
+		prov.update(provenance)
+		self.f.attrs['provenance'] = json.dumps(prov, default=_json_default, sort_keys=True)
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+################################################################################
+def _json_default(obj):
+	""" Convert numpy types (e.g. in ETC outputs) to types that can be stored as JSON. """
+	if isinstance(obj, np.ndarray):
+		return obj.tolist()
+	if isinstance(obj, np.generic):
+		return obj.item()
+	return repr(obj)
@@ -29,9 +29,14 @@
 ################################################################################
 from __future__ import division, print_function
 import numpy as np
+from configclass import Config
 
 ################################################################################
-class Detector(object):
+class Detector(Config):
+
+	__slots__ = ['height_px', 'width_px', 'size_px', 'l_px_m', 'A_px_m2', 
+		'gain', 'qe', 'adu_gain', 'saturation', 'RN', 'cic', 'fps', 'excess_noise_factor', 
+		'wavelength_cutoff', 'wavelength_cutoff_h', 'dark_current']
 
 	def __init__(self,
 		height_px,
@@ -46,7 +51,8 @@ class Detector(object):
 		saturation=np.inf,
 		adu_gain=1,
 		qe=1,
-		fps=1):
+		fps=1,
+		excess_noise_factor=1):
 
 		# Detector geometry.
 		self.height_px = height_px
@@ -63,6 +69,7 @@ class Detector(object):
 		self.RN = RN
 		self.cic = cic
 		self.fps = fps
+		self.excess_noise_factor = excess_noise_factor	# Excess noise factor F of the internal (avalanche) gain: 1 for a noiseless gain, sqrt(2) for an EMCCD at high gain
 
 		# Optical properties.
 		self.wavelength_cutoff = wavelength_cutoff
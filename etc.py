@@ -48,7 +48,16 @@ import scipy.constants
 import json	
 
 from linguineglobals import *
+from skyclass import SkyEmissivity
+from cacheutils import param_hash
 import etcutils
+
+# Sky emissivity tables that have already been read, keyed by file name.
+_sky_emissivity_cache = {}
+
+# Background count rates computed by background_rates(), keyed by a hash of
+# the parameters of the optical system that they depend on.
+_background_rates_cache = {}
 ################################################################################
 def exposure_time_calc(band, t_exp, optical_system,
 		surface_brightness = None,
@@ -108,27 +117,21 @@ def exposure_time_calc(band, t_exp, optical_system,
 	else:
 		Sigma_source_e = 0
 
+	# The background count rates do not depend on the band or exposure time, 
+	# so they are only computed once for each optical system.
+	rates = background_rates(optical_system)
+
 	""" Cryostat photon flux """
-	Sigma_cryo = get_cryo_TE(optical_system=optical_system)
+	Sigma_cryo = rates['cryo']
 
 	""" Telescope thermal background photon flux """
-	Sigma_tel = get_telescope_TE(optical_system=optical_system, plotit=False)[band]
+	Sigma_tel = rates['tel'][band]
 
 	""" Sky thermal background photon flux """
-	Sigma_sky_thermal = get_sky_TE(optical_system=optical_system, plotit=False)[band]
+	Sigma_sky_thermal = rates['sky_thermal'][band]
 
 	""" Empirical sky background flux """
-	Sigma_sky_emp = etcutils.surface_brightness_to_count_rate(mu = sky.brightness[band], 
-		band = band,
-		# wavelength_m = wavelength_eff, 
-		# bandwidth_m = bandwidth, 
-		plate_scale_as_px = optical_system.plate_scale_as_px, 
-		A_tel = telescope.A_collecting_m2, 
-		tau = telescope.tau * cryostat.Tr_win,
-		qe = detector.qe,
-		gain = 1,
-		magnitude_system = sky.magnitude_system
-	)
+	Sigma_sky_emp = rates['sky_emp'][band]
 
 	""" Total sky background """
 	if band == 'K':
@@ -236,6 +239,52 @@ def exposure_time_calc(band, t_exp, optical_system,
 
 	return etc_output
 
+################################################################################
+def background_rates(optical_system):
+	"""
+		Return the background count rates (electrons/second/pixel, before gain 
+		multiplication) from the cryostat ('cryo'), and from the telescope 
+		('tel'), the thermal emission of the sky ('sky_thermal') and the 
+		empirical sky brightness ('sky_emp') in the J, H and K bands.
+
+		These are independent of the exposure time and of the detector gain, 
+		read noise and saturation, so they are computed once for each 
+		optical system and cached in memory, keyed by a hash of the 
+		parameters they depend on. The cache key is cheapest to compute if 
+		the optical system is frozen (see configclass.Config.frozen()). The 
+		returned dictionary is shared between calls and must not be modified.
+	"""
+	detector = optical_system.detector
+	telescope = optical_system.telescope
+	cryostat = optical_system.cryostat
+	sky = optical_system.sky
+
+	key = param_hash(telescope, cryostat, sky, 
+		optical_system.plate_scale_as_px, optical_system.omega_px_sr, 
+		detector.A_px_m2, detector.wavelength_cutoff, detector.qe)
+	if key in _background_rates_cache:
+		return _background_rates_cache[key]
+
+	rates = {
+		'cryo' : get_cryo_TE(optical_system=optical_system),
+		'tel' : get_telescope_TE(optical_system=optical_system, plotit=False),
+		'sky_thermal' : get_sky_TE(optical_system=optical_system, plotit=False),
+		'sky_emp' : {}
+	}
+	for band in rates['tel']:
+		rates['sky_emp'][band] = etcutils.surface_brightness_to_count_rate(mu = sky.brightness[band], 
+			band = band,
+			plate_scale_as_px = optical_system.plate_scale_as_px, 
+			A_tel = telescope.A_collecting_m2, 
+			tau = telescope.tau * cryostat.Tr_win,
+			qe = detector.qe,
+			gain = 1,
+			magnitude_system = sky.magnitude_system
+		)
+
+	_background_rates_cache[key] = rates
+	return rates
+
 ################################################################################
 def get_cryo_TE(optical_system):
 	"""
@@ -556,6 +605,8 @@ def get_sky_emissivity():
 	fname = 'cptrans_zm_23_10.dat'
 	this_dir, this_filename = os.path.split(__file__)
 	DATA_PATH = os.path.join(this_dir, 'skytransdata', fname)
+	if DATA_PATH in _sky_emissivity_cache:
+		return _sky_emissivity_cache[DATA_PATH]
 	f = open(DATA_PATH, 'r')
 
 	wavelengths_sky = [];
@@ -566,7 +617,10 @@ def get_sky_emissivity():
 		Tr_sky.append(float(cols[1]))
 	Tr_sky = np.asarray(Tr_sky)
 	wavelengths_sky = np.asarray(wavelengths_sky) * 1e-6
-	eps_sky = lambda wavelength_m: np.interp(wavelength_m, wavelengths_sky, 1 - Tr_sky)
+	# A SkyEmissivity instance rather than a closure so that the sky can be 
+	# pickled and hashed. It is frozen so that it can be shared by every Sky.
+	eps_sky = SkyEmissivity(wavelengths_sky, 1 - Tr_sky).freeze()
 	f.close()
 
+	_sky_emissivity_cache[DATA_PATH] = eps_sky
 	return eps_sky
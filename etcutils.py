@@ -35,6 +35,7 @@ import scipy.integrate
 
 # linguine modules 
 from linguineglobals import *
+import profutils, rngutils
 
 ###################################################################################
 def thermal_emission_intensity(		
@@ -269,8 +270,10 @@ def flux_to_count_rate(F,
 	return Sigma_electrons
 
 ################################################################################
+@profutils.timed()
 def expected_count_to_count(arg, 
-	t_exp = None):
+	t_exp = None,
+	rng = None):	# Random number generator (see rngutils.get_rng())
 	"""
 		Convert an expected photon count (in photons) OR expected photon count 
 		rate (in photons/s) to a 'truth' count assuming a Poisson distribution.
@@ -295,4 +298,4 @@ def expected_count_to_count(arg,
 			len(expectedCount[expectedCount<0].flatten())))
 		expectedCount = expectedCount.clip(0)
 		
-	return np.random.poisson(lam=expectedCount, size=expectedCount.shape)
\ No newline at end of file
+	return rngutils.get_rng(rng).poisson(lam=expectedCount, size=expectedCount.shape)
\ No newline at end of file
@@ -46,6 +46,7 @@ from __future__ import division, print_function, absolute_import
 from scipy import signal
 import warnings
 import threading
+import profutils
 try:
     import pyfftw    
     pyfftw.interfaces.cache.enable()
@@ -145,6 +146,7 @@ def _next_regular(target):
     return match
 
 
+@profutils.timed()
 def fftconvolve(in1, in2, mode="full"):
     """Convolve two N-dimensional arrays using FFT, implemented using the pyfftw module ('Fastest Fourier Transform in the West').
 
@@ -247,6 +249,7 @@ def fftconvolve(in1, in2, mode="full"):
     # Speed up FFT by padding to optimal size for FFTPACK
     fshape = [_next_regular(int(d)) for d in shape]
     fslice = tuple([slice(0, int(sz)) for sz in shape])
+    profutils.count_ffts(3, 3 * int(prod(fshape)))
     # Pre-1.9 NumPy FFT routines are not threadsafe.  For older NumPys, make
     # sure we only call rfftn/irfftn from one thread at a time.
     if not complex_result and (_rfft_mt_safe or _rfft_lock.acquire(False)):
@@ -276,6 +279,7 @@ def fftconvolve(in1, in2, mode="full"):
                 )[fslice].copy()
         if not complex_result:
             ret = ret.real
+    profutils.count_bytes(ret)
 
     if mode == "full":
         return ret
@@ -285,4 +289,262 @@ def fftconvolve(in1, in2, mode="full"):
         return _centered(ret, s1 - s2 + 1)
     else:
         raise ValueError("Acceptable mode flags are 'valid',"
-                         " 'same', or 'full'.")
\ No newline at end of file
+                         " 'same', or 'full'.")
+
+class RealFFT2(object):
+    """A planned 2D real FFT between two preallocated buffers.
+
+    `real` is an (aligned) real array of shape `shape` and `spec` is the
+    corresponding complex array of shape ``shape[:-1] + (shape[-1]//2 + 1,)``
+    holding its FFT over the last two axes. Any leading axes are treated as
+    a batch of independent 2D transforms.
+
+    `forward()` transforms `real` into `spec` and `inverse()` transforms
+    `spec` back into `real` (normalised, so that ``inverse(forward(x)) == x``).
+    Neither allocates memory, so these are suitable for use in loops.
+
+    Note that, as with FFTW, `inverse()` may overwrite the contents of
+    `spec`.
+    """
+
+    def __init__(self, shape, dtype=np.float64, threads=None,
+                 flags=('FFTW_MEASURE',)):
+        shape = tuple(int(d) for d in shape)
+        dtype = np.dtype(dtype)
+        cdtype = np.result_type(dtype, np.complex64)
+        spec_shape = shape[:-1] + (shape[-1] // 2 + 1,)
+        self.shape = shape
+        if threads is None:
+            threads = max(NTHREADS, 1)
+
+        if NTHREADS == 0:
+            self.real = np.zeros(shape, dtype=dtype)
+            self.spec = np.zeros(spec_shape, dtype=cdtype)
+            self._fft_forward = None
+            self._fft_inverse = None
+        else:
+            self.real = pyfftw.empty_aligned(shape, dtype=dtype)
+            self.spec = pyfftw.empty_aligned(spec_shape, dtype=cdtype)
+            # Planning may overwrite the buffers.
+            self._fft_forward = pyfftw.FFTW(self.real, self.spec,
+                                            axes=(-2, -1), flags=flags,
+                                            threads=threads)
+            self._fft_inverse = pyfftw.FFTW(self.spec, self.real,
+                                            axes=(-2, -1), flags=flags,
+                                            direction='FFTW_BACKWARD',
+                                            threads=threads)
+            self.real[...] = 0
+            self.spec[...] = 0
+        profutils.count_bytes(self.real, self.spec)
+        self._N_ffts = int(prod(shape[:-2]))
+        self._N_samples = int(prod(shape))
+
+    def forward(self):
+        profutils.count_ffts(self._N_ffts, self._N_samples)
+        if self._fft_forward is None:
+            self.spec[...] = np.fft.rfft2(self.real)
+        else:
+            self._fft_forward()
+        return self.spec
+
+    def inverse(self):
+        profutils.count_ffts(self._N_ffts, self._N_samples)
+        if self._fft_inverse is None:
+            self.real[...] = np.fft.irfft2(self.spec, s=self.shape[-2:])
+        else:
+            self._fft_inverse()
+        return self.real
+
+
+def _rfft2(a, s):
+    if NTHREADS == 0:
+        return np.fft.rfft2(a, s=s)
+    return pyfftw.interfaces.numpy_fft.rfft2(a, s=s, threads=NTHREADS)
+
+
+def _irfft2(a, s):
+    if NTHREADS == 0:
+        return np.fft.irfft2(a, s=s)
+    return pyfftw.interfaces.numpy_fft.irfft2(a, s=s, threads=NTHREADS)
+
+
+def _fft_cost(fshape):
+    """Relative cost of a real FFT convolution over an array of shape `fshape`."""
+    n = float(prod(fshape))
+    return n * np.log2(max(n, 2))
+
+
+# Smallest block FFT size (along each axis) used by oaconvolve: smaller
+# transforms are dominated by overheads.
+_OA_MIN_FFT_SIZE = 32
+
+# Extra cost per sample of splitting the input into blocks and adding the
+# convolved blocks together, in the same units as _fft_cost.
+_OA_COPY_COST = 1
+
+
+def _oa_block_shape(s1, s2):
+    """Block shape minimising the cost of an overlap-add convolution.
+
+    Returns the block shape, the (padded) FFT shape of each block and the
+    estimated relative cost.
+    """
+    block_shape = []
+    fshape = []
+    n_blocks = 1
+    for n, k in zip(s1, s2):
+        # Candidate FFT sizes from twice to eight times the kernel size; the
+        # cost per output sample is minimised at a few times the kernel size.
+        best = None
+        for f in sorted(set(_next_regular(max(m * int(k), _OA_MIN_FFT_SIZE)) for m in (2, 3, 4, 6, 8))):
+            b = f - int(k) + 1
+            if b >= n:
+                f = _next_regular(int(n + k - 1))
+                b = int(n)
+            cost = -(-int(n) // b) * f * (np.log2(max(f, 2)) + _OA_COPY_COST)
+            if best is None or cost < best[0]:
+                best = (cost, b, f)
+        block_shape.append(best[1])
+        fshape.append(best[2])
+        n_blocks *= -(-int(n) // best[1])
+    n = float(prod(fshape))
+    return tuple(block_shape), tuple(fshape), n_blocks * n * (np.log2(n) + _OA_COPY_COST)
+
+
+@profutils.timed()
+def oaconvolve(in1, in2, mode="full"):
+    """Convolve two 2-dimensional arrays using the overlap-add method.
+
+    `in1` is split into blocks, each of which is convolved with `in2` using
+    FFTs of a size only a few times that of `in2`, and the results are
+    added together. The block FFTs are computed together as a batch. When
+    `in2` is much smaller than `in1`, this is much faster than
+    `fftconvolve`, which transforms the whole of `in1` padded to the full
+    linear convolution size.
+
+    Parameters
+    ----------
+    in1 : array_like
+        First input (the larger array).
+    in2 : array_like
+        Second input (e.g. a PSF). Should have the same number of dimensions
+        as `in1`.
+    mode : str {'full', 'valid', 'same'}, optional
+        As for `fftconvolve`.
+
+    Returns
+    -------
+    out : array
+        An array containing a subset of the discrete linear convolution of
+        `in1` with `in2`.
+    """
+    in1 = asarray(in1)
+    in2 = asarray(in2)
+    if in1.ndim != 2 or in2.ndim != 2 or iscomplexobj(in1) or iscomplexobj(in2):
+        return fftconvolve(in1, in2, mode=mode)
+
+    s1 = array(in1.shape)
+    s2 = array(in2.shape)
+    if mode == "valid":
+        _check_valid_mode_shapes(s1, s2)
+    (by, bx), fshape, _ = _oa_block_shape(s1, s2)
+    ny = -(-s1[0] // by)
+    nx = -(-s1[1] // bx)
+    ky, kx = s2
+
+    # Split in1 (zero-padded to a whole number of blocks) into blocks and
+    # convolve them all with in2 at once.
+    padded = zeros((ny * by, nx * bx), dtype=np.result_type(in1.dtype, np.float64))
+    padded[:s1[0], :s1[1]] = in1
+    blocks = padded.reshape(ny, by, nx, bx).swapaxes(1, 2)
+    blocks_conv = _irfft2(_rfft2(blocks, fshape) * _rfft2(in2, fshape), fshape)
+    profutils.count_ffts(2 * ny * nx + 1, (2 * ny * nx + 1) * int(prod(fshape)))
+    profutils.count_bytes(padded, blocks_conv)
+
+    # Add the overlapping convolved blocks. Each convolved block extends
+    # ky - 1 rows and kx - 1 columns into the following blocks (which is
+    # less than a block, unless there is only one block along that axis).
+    blocks_conv = blocks_conv[:, :, :by + ky - 1, :bx + kx - 1].swapaxes(1, 2)
+    sy, ty = (by, ky - 1) if ny > 1 else (by + ky - 1, 0)
+    sx, tx = (bx, kx - 1) if nx > 1 else (bx + kx - 1, 0)
+    ret = zeros((ny + 1, sy, nx + 1, sx), dtype=blocks_conv.dtype)
+    ret[:ny, :, :nx, :] = blocks_conv[:, :sy, :, :sx]
+    ret[1:, :ty, :nx, :] += blocks_conv[:, sy:, :, :sx]
+    ret[:ny, :, 1:, :tx] += blocks_conv[:, :sy, :, sx:]
+    ret[1:, :ty, 1:, :tx] += blocks_conv[:, sy:, :, sx:]
+    ret = ret.reshape(((ny + 1) * sy, (nx + 1) * sx))[:s1[0] + ky - 1, :s1[1] + kx - 1]
+
+    if mode == "full":
+        return ret.copy()
+    elif mode == "same":
+        return _centered(ret, s1)
+    elif mode == "valid":
+        return _centered(ret, s1 - s2 + 1)
+    else:
+        raise ValueError("Acceptable mode flags are 'valid',"
+                         " 'same', or 'full'.")
+
+
+# Relative cost of one multiply-add in a direct convolution compared with a
+# unit of FFT cost (n log2 n), measured for scipy.signal.convolve2d and pyfftw.
+_DIRECT_COST_FACTOR = 1.0
+
+
+def choose_conv_method(in1, in2, mode="full"):
+    """Find the fastest method to convolve `in1` with `in2`.
+
+    Returns one of 'direct' (`scipy.signal.convolve2d`), 'fft'
+    (`fftconvolve`) or 'oa' (`oaconvolve`), based on a simple model of the
+    cost of each method given the sizes of the inputs.
+    """
+    s1 = asarray(in1).shape
+    s2 = asarray(in2).shape
+    if len(s1) != 2 or iscomplexobj(in1) or iscomplexobj(in2):
+        return 'fft'
+    if prod(s2) > prod(s1):
+        s1, s2 = s2, s1
+    costs = {
+        'direct': _DIRECT_COST_FACTOR * float(prod(s1)) * float(prod(s2)),
+        'fft': _fft_cost([_next_regular(int(n + k - 1)) for n, k in zip(s1, s2)]),
+        'oa': _oa_block_shape(s1, s2)[2],
+    }
+    return min(costs, key=costs.get)
+
+
+@profutils.timed()
+def convolve(in1, in2, mode="full", method="auto"):
+    """Convolve two 2-dimensional arrays.
+
+    Parameters
+    ----------
+    in1, in2, mode
+        As for `fftconvolve`.
+    method : str {'auto', 'direct', 'fft', 'oa'}, optional
+        ``direct``
+           Direct convolution using `scipy.signal.convolve2d`. Fastest for
+           very small kernels.
+        ``fft``
+           FFT convolution of the whole arrays using `fftconvolve`.
+        ``oa``
+           Overlap-add FFT convolution using `oaconvolve`. Fastest when one
+           array is much larger than the other.
+        ``auto``
+           Choose the fastest method using `choose_conv_method`. (Default)
+
+    Returns
+    -------
+    out : array
+        An array containing a subset of the discrete linear convolution of
+        `in1` with `in2`.
+    """
+    if method == "auto":
+        method = choose_conv_method(in1, in2, mode)
+    if method == "direct":
+        return signal.convolve2d(in1, in2, mode=mode)
+    elif method == "fft":
+        return fftconvolve(in1, in2, mode=mode)
+    elif method == "oa":
+        return oaconvolve(in1, in2, mode=mode)
+    else:
+        raise ValueError("Acceptable method flags are 'auto', 'direct',"
+                         " 'fft', or 'oa'.")
@@ -37,11 +37,19 @@ from matplotlib.colors import LogNorm
 from matplotlib import rc
 rc('image', interpolation='none', cmap = 'binary_r')
 import os
+import scipy.special
+
+# Multithreading/processing packages
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool as ProcPool			# no dummy = Processes
 
 # linguine modules 
 from linguineglobals import *
 import etcutils
 import imutils
+from cacheutils import param_hash, TruthImageCache
 
 ################################################################################
 # The following functions are for use with GALFIT.
@@ -60,12 +68,32 @@ def simulate_sersic_galaxy(im_out_fname, # Output FITS file name
 	object_type = 'sersic/2',
 	galfit_input_fname = None,
 	plotit = False,
-	overwrite_existing = False
+	overwrite_existing = False,
+	use_galfit = False	# If False, render the galaxy in Python using sersic_image() instead of calling GALFIT
 	):
 	"""
-		Return a simulated image of a galaxy (made using GALFIT) given the inputs.
+		Return a simulated image of a galaxy given the inputs.
+
+		By default the image is rendered natively by sersic_image(), which 
+		follows the same conventions as GALFIT, so no file is written and 
+		im_out_fname is ignored. If use_galfit is True, then GALFIT is called 
+		and the image is read back from the FITS file im_out_fname.
 	"""
-	
+	if not use_galfit:
+		im_raw = sersic_image(
+			height_px = height_px, 
+			width_px = width_px, 
+			mu_e = mu_e, 
+			R_e_px = R_e_px, 
+			n = n, 
+			plate_scale_as_px = plate_scale_as_px, 
+			axis_ratio = axis_ratio, 
+			zeropoint = zeropoint, 
+			pos_px = pos_px, 
+			PA_deg = PA_deg,
+			plotit = plotit)
+		return im_raw
+
 	if galfit_input_fname == None:
 		if not os.path.exists("galfit"):
 			os.makedirs("galfit")
@@ -95,14 +123,18 @@ def simulate_sersic_galaxy(im_out_fname, # Output FITS file name
 	else:
 		print("WARNING: I found a GALFIT .fits file '{}' with the same name as the input filename, so I am using that instead of calling GALFIT again!".format(im_out_fname))
 
-	# Editing the header to include the input parameters.
-	hdulist = astropy.io.fits.open(im_out_fname, mode='update')
+	# Editing the header to include the input parameters. An existing file is 
+	# opened read-only so that its header is not rewritten.
 	if overwrite_existing:
+		hdulist = astropy.io.fits.open(im_out_fname, mode='update')
 		hdulist[0].header['R_E_PX'] = R_e_px
 		hdulist[0].header['MU_E'] = mu_e
 		hdulist[0].header['SER_IDX'] = n
-	im_raw = hdulist[0].data
-	hdulist.flush()
+		im_raw = hdulist[0].data
+		hdulist.flush()
+	else:
+		hdulist = astropy.io.fits.open(im_out_fname)
+		im_raw = hdulist[0].data
 	hdulist.close()
 
 	# Plotting.
@@ -115,14 +147,153 @@ def simulate_sersic_galaxy(im_out_fname, # Output FITS file name
 
 	return im_raw
 
+################################################################################
+def get_truth_image(galaxy, height_px, width_px, plate_scale_as_px, band,
+	zeropoint = -AB_MAGNITUDE_ZEROPOINT, # Careful of the minus sign!
+	cache = None
+	):
+	"""
+		Return a truth image of a Galaxy instance rendered using sersic_image().
+
+		If a TruthImageCache instance is given, the image is looked up in the 
+		cache using the galaxy's parameters, the plate scale, the image size, 
+		the zeropoint and the band, and is only rendered if it is not found. 
+		In this case the returned image is a read-only memory-mapped array.
+	"""
+	render_fun = lambda: sersic_image(
+		height_px = height_px, 
+		width_px = width_px, 
+		mu_e = galaxy.mu_e, 
+		R_e_px = galaxy.R_e_as / plate_scale_as_px, 
+		n = galaxy.sersic_idx, 
+		plate_scale_as_px = plate_scale_as_px, 
+		axis_ratio = galaxy.axis_ratio, 
+		zeropoint = zeropoint, 
+		PA_deg = galaxy.PA_deg)
+
+	if cache is None:
+		return render_fun()
+
+	key = cache.key(galaxy = galaxy, 
+		plate_scale_as_px = plate_scale_as_px, 
+		size_px = (height_px, width_px), 
+		zeropoint = zeropoint, 
+		band = band)
+	return cache.get_or_render(key, render_fun)
+
 ################################################################################
 from subprocess import call
-def call_GALFIT(galfit_input_fname):
+def call_GALFIT(galfit_input_fname,
+	cwd = None):
 	""" 
 		Call GALFIT on the file galfit_input_fname.
+
+		GALFIT writes its log files to the working directory, so concurrent 
+		calls should each be given their own working directory cwd.
 	"""
 	print("Calling GALFIT...")
-	call(["galfit", galfit_input_fname])
+	call(["galfit", galfit_input_fname], cwd = cwd)
+
+################################################################################
+def simulate_sersic_galaxies(galaxies, height_px, width_px, plate_scale_as_px,
+	out_dir = 'galfit',	# Directory in which the output FITS files are stored
+	zeropoint = -AB_MAGNITUDE_ZEROPOINT, # Careful of the minus sign!
+	object_type = 'sersic/2',
+	use_galfit = True,
+	N_workers = None,	# Number of worker processes (default: number of CPUs)
+	overwrite_existing = False,
+	timeit = True
+	):
+	"""
+		Render images of a list of Galaxy instances concurrently using a pool 
+		of N_workers processes.
+
+		Each image is saved in out_dir under a file name containing a hash of 
+		the parameters used to generate it. If such a file already exists, 
+		then it is read instead of rendering the galaxy again (unless 
+		overwrite_existing is True). When GALFIT is used, each call is made in 
+		its own scratch directory so that concurrent calls cannot overwrite 
+		each other's input and log files.
+
+		Returns a list of the images and a list of dictionaries containing 
+		the output file name, whether the image was read from an existing 
+		file and the time taken for each galaxy.
+	"""
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+
+	tasks = []
+	for galaxy in galaxies:
+		params = {
+			'height_px' : height_px,
+			'width_px' : width_px,
+			'mu_e' : galaxy.mu_e,
+			'R_e_px' : galaxy.R_e_as / plate_scale_as_px,
+			'n' : galaxy.sersic_idx,
+			'plate_scale_as_px' : plate_scale_as_px,
+			'axis_ratio' : galaxy.axis_ratio,
+			'zeropoint' : zeropoint,
+			'PA_deg' : galaxy.PA_deg,
+			'object_type' : object_type
+		}
+		# The renderer is hashed too, so that GALFIT and sersic_image() images of the same galaxy are stored separately.
+		renderer = 'galfit' if use_galfit else 'sersic_image'
+		im_out_fname = os.path.abspath(os.path.join(out_dir, 'gal_{}.fits'.format(param_hash(dict(params, renderer = renderer)))))
+		tasks.append((galaxy.name, im_out_fname, params, use_galfit, overwrite_existing))
+
+	pool = ProcPool(N_workers)
+	results = pool.map(_simulate_sersic_galaxy_worker, tasks, 1)
+	pool.close()
+	pool.join()
+
+	ims = [result[0] for result in results]
+	timings = [result[1] for result in results]
+
+	if timeit:
+		for timing in timings:
+			print("SIMULATING GALAXY {}: {} in {:.5f} s ({})".format(timing['name'], 
+				'read from existing file' if timing['skipped'] else 'rendered', 
+				timing['time_s'], timing['fname']))
+
+	return ims, timings
+
+################################################################################
+def _simulate_sersic_galaxy_worker(task):
+	"""
+		A private method used by simulate_sersic_galaxies() to render a 
+		single galaxy in a worker process.
+	"""
+	tic = time.time()
+	name, im_out_fname, params, use_galfit, overwrite_existing = task
+
+	skipped = os.path.isfile(im_out_fname) and not overwrite_existing
+	if not skipped:
+		if use_galfit:
+			# Run GALFIT in a scratch directory, then move the output into place.
+			scratch_dir = tempfile.mkdtemp(dir = os.path.dirname(im_out_fname))
+			try:
+				galfit_input_fname, scratch_im_fname = write_GALFIT_params_file(
+					galfit_input_fname = os.path.join(scratch_dir, 'galfit_input.txt'), 
+					im_out_fname = os.path.join(scratch_dir, 'galaxy.fits'), 
+					**params)
+				call_GALFIT(galfit_input_fname, cwd = scratch_dir)
+				os.rename(scratch_im_fname, im_out_fname)
+			finally:
+				shutil.rmtree(scratch_dir, ignore_errors = True)
+		else:
+			im = sersic_image(**{key : params[key] for key in params if key != 'object_type'})
+			imutils.export_fits(image_in_array = im, fname = im_out_fname, overwrite_existing = True)
+
+	im_raw = imutils.image_from_fits(im_out_fname)[0]
+
+	timing = {
+		'name' : name,
+		'fname' : im_out_fname,
+		'skipped' : skipped,
+		'time_s' : time.time() - tic
+	}
+
+	return im_raw, timing
 
 ################################################################################
 def write_GALFIT_params_file(
@@ -182,7 +353,106 @@ def write_GALFIT_params_file(
 
 ################################################################################
 # The following functions are for generating an image of a galaxy without GALFIT 
-# (not recommended for now)
+################################################################################
+def sersic_b_n(n):
+	"""
+		Return the Sersic constant b_n for Sersic index n, defined such that 
+		the effective radius R_e encloses half of the total luminosity, i.e. 
+		gamma(2n, b_n) = Gamma(2n) / 2. This is computed exactly using the 
+		inverse of the regularised lower incomplete gamma function.
+	"""
+	return scipy.special.gammaincinv(2 * n, 0.5)
+
+################################################################################
+def sersic_image(height_px, width_px, mu_e, R_e_px, n, plate_scale_as_px,
+	axis_ratio = 1,		# Axis ratio (b/a)
+	zeropoint = -AB_MAGNITUDE_ZEROPOINT, # Careful of the minus sign!
+	pos_px = None,		# Position of galaxy in frame 
+	PA_deg = 0,			# Rotation angle
+	oversampling = 16,	# Sub-pixel oversampling factor in the innermost region
+	core_radius_px = 2,	# Half-width of the innermost (most finely oversampled) region
+	plotit = False
+	):
+	"""
+		Return an image of a Sersic galaxy rendered directly in Python, 
+		without calling GALFIT.
+
+		The inputs follow the same conventions as write_GALFIT_params_file(): 
+		pos_px = (x, y) is given in 1-indexed pixel coordinates (by default, the 
+		galaxy is centred at (width_px/2, height_px/2)), PA_deg is measured 
+		anticlockwise from the vertical axis of the image, the axis ratio is 
+		that of the minor to major axes, and the pixel values are such that 
+		mu = -2.5 * log10(pixel value / plate_scale_as_px^2) + zeropoint.
+
+		The profile is integrated over each pixel by averaging over a grid of 
+		sub-pixels. Because the profile is steepest at the core, the 
+		oversampling is adaptive: the region within core_radius_px of the 
+		centre is oversampled by a factor oversampling, and the oversampling 
+		factor is halved each time the half-width of the region is doubled, 
+		until it reaches 1 (i.e. the profile is evaluated at the pixel centre).
+	"""
+	# By default, the galaxy is centered in the middle of the image plane.
+	if not pos_px:
+		pos_px = (width_px/2, height_px/2)
+	x_0, y_0 = pos_px
+
+	# Exact Sersic constant.
+	b_n = sersic_b_n(n)
+	# Pixel value at the effective radius.
+	I_e = np.power(10, - (mu_e - zeropoint) / 2.5) * plate_scale_as_px**2
+
+	PA_rad = np.deg2rad(PA_deg)
+	cos_PA = np.cos(PA_rad)
+	sin_PA = np.sin(PA_rad)
+	def profile(x, y):
+		# Distances along the major and minor axes.
+		dx = x - x_0
+		dy = y - y_0
+		r_major = - dx * sin_PA + dy * cos_PA
+		r_minor = dx * cos_PA + dy * sin_PA
+		R = np.sqrt(r_major**2 + (r_minor / axis_ratio)**2)
+		return I_e * np.exp(- b_n * (np.power(R / R_e_px, 1 / n) - 1))
+
+	# Evaluate the profile at the pixel centres.
+	x = np.arange(width_px, dtype='float') + 1
+	y = np.arange(height_px, dtype='float') + 1
+	im = profile(x[np.newaxis, :], y[:, np.newaxis])
+
+	# Oversampling levels, from the outermost (coarsest) to the innermost 
+	# (finest), so that the finer levels overwrite the coarser ones.
+	levels = []
+	factor = int(oversampling)
+	half_width_px = core_radius_px
+	while factor > 1:
+		levels.append((factor, half_width_px))
+		factor //= 2
+		half_width_px *= 2
+
+	for factor, half_width_px in levels[::-1]:
+		# Pixels in the oversampled region (0-indexed).
+		r_min = max(int(np.floor(y_0 - 1 - half_width_px)), 0)
+		r_max = min(int(np.ceil(y_0 - 1 + half_width_px)) + 1, height_px)
+		c_min = max(int(np.floor(x_0 - 1 - half_width_px)), 0)
+		c_max = min(int(np.ceil(x_0 - 1 + half_width_px)) + 1, width_px)
+		if r_min >= r_max or c_min >= c_max:
+			continue
+		# Sub-pixel offsets w.r.t. the pixel centres.
+		offsets = (np.arange(factor) + 0.5) / factor - 0.5
+		x_sub = (x[c_min:c_max, np.newaxis] + offsets[np.newaxis, :]).reshape(1, -1)
+		y_sub = (y[r_min:r_max, np.newaxis] + offsets[np.newaxis, :]).reshape(-1, 1)
+		im_sub = profile(x_sub, y_sub)
+		im[r_min:r_max, c_min:c_max] = im_sub.reshape(
+			r_max - r_min, factor, c_max - c_min, factor).mean(axis=(1,3))
+
+	if plotit:
+		mu.newfigure()
+		plt.imshow(im)
+		plt.title("Sersic galaxy image")
+		mu.colorbar()
+		mu.show_plot()
+
+	return im
+
 ################################################################################
 def sersic(n, R_e, R, mu_e,
 	zeropoint = 0,
@@ -197,13 +467,7 @@ def sersic(n, R_e, R, mu_e,
 	F_e = etcutils.surface_brightness_to_flux(mu = mu_e, zeropoint=zeropoint, wavelength_m=wavelength_m)
 
 	# Calculating b_n given the Sersic index n.
-	if n > 0.5 and n < 8:
-		b_n = 1.9992 * n - 0.3271
-	elif n >= 8:
-		b_n = 2 * n - 1 / 3
-	else:
-		print('ERROR: haven\'t implemented n < 0.5 yet! Check again later...')
-		return
+	b_n = sersic_b_n(n)
 
 	F = {
 		'F_nu_cgs' 		: F_e['F_nu_cgs'] * np.exp(- b_n * (np.power(R/R_e, 1/n) - 1)),
@@ -233,13 +497,12 @@ def sersic_2D(n, R_e, mu_e,
 
 	# Making a 2D intensity plot of the galaxy given its inclination and orientation.
 	dR = 2 * R_max / gridsize
-	scaleFactor = 2
-	imsize = gridsize*scaleFactor
-	r = np.linspace(-R_max*scaleFactor, +R_max*scaleFactor, imsize)
+	r = np.linspace(-R_max, +R_max, gridsize)
 	X, Y = np.meshgrid(r, r)
-	if theta_rad != 0:
-		print('WARNING: rotations are still kinda dodgy. Proceed with caution!')
-	R = imutils.rotateAndCrop(image_in_array = np.sqrt(X * X + Y * Y / (np.cos(i_rad) * np.cos(i_rad))), angle=theta_rad * 180 / np.pi, cropArg=(imsize-gridsize)//2)
+	# Coordinates along the major and minor axes.
+	X_major = X * np.cos(theta_rad) + Y * np.sin(theta_rad)
+	Y_minor = - X * np.sin(theta_rad) + Y * np.cos(theta_rad)
+	R = np.sqrt(X_major * X_major + Y_minor * Y_minor / (np.cos(i_rad) * np.cos(i_rad)))
 	# Calculating the Sersic flux and surface brightness profiles
 	R, mu_map, F_map = sersic(n=n, R_e=R_e, R=R, mu_e=mu_e, zeropoint=zeropoint, wavelength_m=wavelength_m)
 	# Truncating the profiles
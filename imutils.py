@@ -38,6 +38,18 @@ from matplotlib import rc
 rc('image', interpolation='none', cmap = 'binary_r')
 import pyfftw
 import fftwconvolve
+import memutils
+import profutils
+import scipy.ndimage
+import scipy.optimize
+import scipy.signal
+import os
+import threading
+from collections import OrderedDict
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 import astropy.io.fits
 
@@ -71,6 +83,80 @@ def image_from_fits(fname,
 
 	return np.squeeze(images_raw), hdulist
 
+################################################################################
+class FitsCube(object):
+
+	def __init__(self, fname,
+		idx=0,
+		scale=True):
+		"""
+			A lazy, memory-mapped reader for (possibly very large) cubes of 
+			images stored in HDU idx of the FITS file fname. 
+
+			Nothing is read from disk until frames are requested: indexing 
+			(e.g. cube[k] or cube[k1:k2]) returns only the requested frames, 
+			and iter_chunks() iterates through the cube a few frames at a 
+			time. 2D images are treated as cubes with a single frame.
+
+			If scale is False, then the BSCALE/BZERO keywords are ignored and 
+			the raw stored values are returned; this allows frames to be 
+			returned as views into the memory-mapped file instead of copies.
+		"""
+		if not fname.lower().endswith('fits'):
+			fname += '.fits'
+		self.fname = fname
+		self.hdulist = astropy.io.fits.open(fname, memmap=True, do_not_scale_image_data=not scale)
+		self.hdu = self.hdulist[idx]
+		self.header = self.hdu.header
+
+		# Get the dimensions from the header without reading the data.
+		naxis = self.header['NAXIS']
+		if naxis == 3:
+			self.shape = (self.header['NAXIS3'], self.header['NAXIS2'], self.header['NAXIS1'])
+		elif naxis == 2:
+			self.shape = (1, self.header['NAXIS2'], self.header['NAXIS1'])
+		else:
+			print("ERROR: invalid image array shape!")
+			raise UserWarning
+		self._naxis = naxis
+		self._scale = scale
+		self.N, self.height, self.width = self.shape
+
+	def __len__(self):
+		return self.N
+
+	@profutils.timed('imutils.FitsCube.read')
+	def __getitem__(self, key):
+		""" Return the frame(s) specified by key, reading only those frames from disk. """
+		if not self._scale:
+			# The unscaled data is a memory map of the file, so we can index it directly.
+			return get_image_size(self.hdu.data)[0][key]
+		if self._naxis == 2:
+			# Promote to 3D using a view.
+			return get_image_size(self.hdu.section[:, :])[0][key]
+		if isinstance(key, (list, np.ndarray)):
+			return np.array([self.hdu.section[int(k)] for k in key])
+		return self.hdu.section[key]
+
+	def iter_chunks(self, 
+		chunk_size = None):		# By default, as many frames as fit in the memory budget (see memutils.chunk_size())
+		""" Iterate through the cube chunk_size frames at a time, yielding the index of the first frame and the frames in each chunk. """
+		if chunk_size is None:
+			# Scaled frames are returned as float64.
+			itemsize = 8 if self._scale else abs(self.header['BITPIX']) // 8
+			chunk_size = memutils.chunk_size(self.height * self.width * itemsize, self.N)
+		for k in range(0, self.N, chunk_size):
+			yield k, self[k : min(k + chunk_size, self.N)]
+
+	def close(self):
+		self.hdulist.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
 ################################################################################
 def image_obj_to_array(im):
 	" Convert an Image object im into an array. "
@@ -132,8 +218,8 @@ def get_image_size(image_in_array):
 		N = 1
 		height = image_in_array.shape[0]
 		width = image_in_array.shape[1]
-		image_out_array = np.ndarray((1, height, width), dtype=type(image_in_array[0,0]))
-		image_out_array[0,:,:] = image_in_array
+		# A view rather than a copy.
+		image_out_array = image_in_array[np.newaxis, :, :]
 	else:
 		print("ERROR: invalid image array shape!")
 		return -1
@@ -176,40 +262,326 @@ def export_fits(image_in_array, fname,
 
 
 ################################################################################
+class AsyncCubeWriter(object):
+
+	def __init__(self, fname, N_frames, height_px, width_px,
+		dtype = np.float32,
+		queue_size = 16,			# Maximum number of frames waiting to be written
+		otherHeaderData = None,		# FITS header data (FITS output only)
+		overwrite_existing = False):
+		"""
+			Write a cube of N_frames images to disk in a background thread, 
+			so that the simulation does not have to wait for the disk.
+
+			Frames are passed to put() and written in order to the file fname, 
+			which is either a FITS file (if fname ends in '.fits') or a .npy 
+			file (if fname ends in '.npy'). The file is created with its full 
+			size when the writer is created: in the case of a FITS file, the 
+			header is written up front and the frames are appended after it; 
+			in the case of a .npy file, the frames are written into a memory 
+			map of the file. 
+
+			At most queue_size frames are held in memory waiting to be 
+			written: if the queue is full then put() blocks until there is 
+			room. close() must be called once all frames have been passed to 
+			put(): it waits for the queue to empty, then flushes the file and 
+			updates its header if fewer than N_frames frames were written.
+		"""
+		if not (fname.endswith('.fits') or fname.endswith('.npy')):
+			fname += '.fits'
+		if os.path.exists(fname) and not overwrite_existing:
+			print("ERROR: file {} already exists!".format(fname))
+			raise UserWarning
+		self.fname = fname
+		self.shape = (N_frames, height_px, width_px)
+		self.dtype = np.dtype(dtype)
+		self.N_written = 0
+		self._N_queued = 0
+		self._error = None
+		self._closed = False
+
+		if fname.endswith('.npy'):
+			self._cube = np.lib.format.open_memmap(fname, mode='w+', dtype=self.dtype, shape=self.shape)
+		else:
+			if self.dtype.kind == 'u' and self.dtype.itemsize > 1:
+				print("ERROR: unsigned integer frames cannot be written directly to a FITS file!")
+				raise UserWarning
+			self._cube = None
+			hdu = astropy.io.fits.PrimaryHDU(data = np.zeros((1, 1, 1), dtype=self.dtype))
+			self.header = hdu.header
+			self.header['NAXIS1'] = width_px
+			self.header['NAXIS2'] = height_px
+			self.header['NAXIS3'] = N_frames
+			if otherHeaderData != None:
+				for key in otherHeaderData:
+					self.header[key] = otherHeaderData[key]
+			self._f = open(fname, 'wb')
+			self._f.write(self.header.tostring().encode('ascii'))
+
+		self._queue = queue.Queue(maxsize = queue_size)
+		self._thread = threading.Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	@profutils.timed('imutils.AsyncCubeWriter.put')
+	def put(self, frame):
+		""" Queue a frame to be written, blocking if the queue is full. """
+		if self._error is not None:
+			raise self._error
+		if self._N_queued >= self.shape[0]:
+			print("ERROR: all {:d} frames have already been written!".format(self.shape[0]))
+			raise UserWarning
+		# Copy the frame, as the caller may reuse its buffer.
+		self._queue.put(np.array(frame, dtype=self.dtype).reshape(self.shape[1:]))
+		self._N_queued += 1
+
+	def close(self):
+		""" Wait for the queued frames to be written, then flush and close the file. """
+		if self._closed:
+			return
+		self._closed = True
+		self._queue.put(None)
+		self._thread.join()
+
+		N_frames, height_px, width_px = self.shape
+		if self._cube is not None:
+			self._cube.flush()
+			offset = self._cube.offset
+			del self._cube
+			if self.N_written < N_frames:
+				# Update the shape in the header and truncate the file.
+				with open(self.fname, 'r+b') as f:
+					f.seek(8)
+					header_len = np.frombuffer(f.read(2), dtype='<u2')[0]
+					header = repr({
+						'descr' : np.lib.format.dtype_to_descr(self.dtype),
+						'fortran_order' : False,
+						'shape' : (self.N_written, height_px, width_px)})
+					f.write(header.ljust(header_len - 1).encode('latin1') + b'\n')
+					f.truncate(offset + self.N_written * height_px * width_px * self.dtype.itemsize)
+		else:
+			if self.N_written < N_frames:
+				# Update NAXIS3 in the header (this does not change the header length).
+				self.header['NAXIS3'] = self.N_written
+				self._f.seek(0)
+				self._f.write(self.header.tostring().encode('ascii'))
+				self._f.seek(0, os.SEEK_END)
+			# Pad the data to a multiple of the FITS block size.
+			nbytes = self.N_written * height_px * width_px * self.dtype.itemsize
+			self._f.write(b'\0' * (-nbytes % 2880))
+			self._f.close()
+
+		if self._error is not None:
+			raise self._error
+
+	def _run(self):
+		""" Write frames from the queue to disk until close() is called. """
+		big_endian_dtype = self.dtype.newbyteorder('>')
+		while True:
+			frame = self._queue.get()
+			if frame is None:
+				break
+			if self._error is not None:
+				# Discard the remaining frames.
+				continue
+			try:
+				with profutils.stage('imutils.AsyncCubeWriter.write'):
+					if self._cube is not None:
+						self._cube[self.N_written] = frame
+					else:
+						self._f.write(frame.astype(big_endian_dtype).tobytes())
+				self.N_written += 1
+			except Exception as e:
+				self._error = e
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+################################################################################
+# Planned FFTs used by fourier_resize().
+# Maximum number of input shape, type and scale factor combinations for 
+# which fourier_resize() keeps its FFT plans; the least recently used are 
+# discarded.
+FOURIER_RESIZE_MAX_PLANS = 8
+
+_fourier_resize_plans = OrderedDict()	# Key -> list of the (forward, inverse) plans not currently in use
+_fourier_resize_lock = threading.Lock()
+
+@profutils.timed()
 def fourier_resize(im, scale_factor,
 	conserve_pixel_sum=True):
+	"""
+		Resize an image, or a stack of images with shape (N, height, width), 
+		by a factor 1 / scale_factor by cropping (scale_factor > 1) or 
+		zero-padding (scale_factor < 1) its Fourier transform. The output 
+		image dimensions are rounded to the nearest integer.
 
-	# Resize an image using a Fourier transform.
-	h,w = im.shape
-	h_s = h/scale_factor
-	w_s = w/scale_factor
-
-	# Take the Fourier transform & shift so that low frequency components are in
-	# the centre.
-	im_fft = np.fft.fftshift(pyfftw.interfaces.numpy_fft.fft2(im))
+		The real FFTs are planned once for each combination of input shape, 
+		type and scale factor and reused in subsequent calls (for up to 
+		FOURIER_RESIZE_MAX_PLANS combinations). Concurrent calls from 
+		different threads each use their own plans, so they run in parallel.
+	"""
+	im = np.asarray(im)
+	dtype = im.dtype if np.issubdtype(im.dtype, np.floating) else np.float64
 
-	# Crop it.
-	im_fft_cropped = centre_crop(im_fft,sz_final=(h_s,w_s))
+	key = (im.shape, np.dtype(dtype).str, scale_factor)
+	fft_in, fft_out = _get_fourier_resize_plans(key)
 
-	# Inverse transform.
-	im_resized = np.abs(pyfftw.interfaces.numpy_fft.ifft2(
-		np.fft.fftshift(im_fft_cropped)))
+	# Take the Fourier transform, keep only the low frequency components 
+	# and inverse transform.
+	fft_in.real[...] = im
+	if conserve_pixel_sum:
+		sum_before = np.sum(fft_in.real, axis=(-2, -1), keepdims=True)
+	fft_in.forward()
+	_fourier_crop(fft_in.spec, fft_out.spec)
+	im_resized = fft_out.inverse().copy()
+	_release_fourier_resize_plans(key, (fft_in, fft_out))
+	profutils.count_bytes(im_resized)
 
 	if conserve_pixel_sum:
-		sum_before = sum(im.flatten())
-		sum_after = sum(im_resized.flatten())
-		im_resized = im_resized / sum_after * sum_before
+		sum_after = np.sum(im_resized, axis=(-2, -1), keepdims=True)
+		im_resized *= np.divide(sum_before, sum_after, out=np.ones_like(sum_after), where=sum_after != 0)
 
 	return im_resized
 
+def _get_fourier_resize_plans(key):
+	""" 
+		A private method used by fourier_resize() to take a pair of (forward, 
+		inverse) plans for key out of the cache, or to create one if none are 
+		free. They must be returned using _release_fourier_resize_plans(). 
+	"""
+	shape, dtype, scale_factor = key
+	with _fourier_resize_lock:
+		# Mark key as the most recently used and evict the least recently used.
+		free_plans = _fourier_resize_plans.pop(key, [])
+		_fourier_resize_plans[key] = free_plans
+		while len(_fourier_resize_plans) > FOURIER_RESIZE_MAX_PLANS:
+			_fourier_resize_plans.popitem(last=False)
+		if free_plans:
+			return free_plans.pop()
+
+		# FFTW's planner is not thread-safe, so plan while holding the lock.
+		h, w = shape[-2:]
+		shape_out = shape[:-2] + (int(np.round(h / scale_factor)), int(np.round(w / scale_factor)))
+		return (fftwconvolve.RealFFT2(shape, dtype=dtype), fftwconvolve.RealFFT2(shape_out, dtype=dtype))
+
+def _release_fourier_resize_plans(key, plans):
+	""" A private method used by fourier_resize() to return plans to the cache (unless key has since been evicted). """
+	with _fourier_resize_lock:
+		if key in _fourier_resize_plans:
+			_fourier_resize_plans[key].append(plans)
+
+################################################################################
+def _fourier_crop(spec_in, spec_out):
+	"""
+		Copy the low spatial frequency components of spec_in, the real FFT 
+		(as returned by rfft2) of one or more images, into spec_out, the real 
+		FFT of images of a different size. Components that are not present in 
+		spec_in are set to zero. The frequencies retained are the same as 
+		those retained by centre-cropping the fftshift-ed full FFT. Both 
+		arrays may have leading (batch) dimensions.
+	"""
+	rows_in = spec_in.shape[-2]
+	rows_out = spec_out.shape[-2]
+	rows = min(rows_in, rows_out)
+	cols = min(spec_in.shape[-1], spec_out.shape[-1])
+	rows_pos = (rows + 1) // 2	# Non-negative frequencies
+	rows_neg = rows // 2		# Negative frequencies
+
+	spec_out[..., :rows_pos, :cols] = spec_in[..., :rows_pos, :cols]
+	spec_out[..., rows_pos:rows_out - rows_neg, :] = 0
+	if rows_neg > 0:
+		spec_out[..., rows_out - rows_neg:, :cols] = spec_in[..., rows_in - rows_neg:, :cols]
+	spec_out[..., cols:] = 0
+
+	return spec_out
+
 ################################################################################
 def gaussian_smooth(im, sigma):
 	# Smooth an image by convolving it with a Gaussian kernel.
-	# Generate a Gaussian kernel.
-	# Make it extend out to 5sigma.
-	x = np.arange(-5*sigma, +5*sigma, dtype='float')
-	y = x
-	X, Y = np.meshgrid(x,y)
-	kernel = 1 / (2 * np.pi * sigma**2) * \
-	np.exp( -(X**2 + Y**2) / (2 * sigma**2) )
-	return fftwconvolve.fftconvolve(im, kernel, mode='same')
+	return gaussian_blur(im, sigma)
+
+################################################################################
+# Above this sigma (in pixels) the recursive filter is faster than the 
+# separable convolution.
+GAUSSIAN_BLUR_RECURSIVE_SIGMA = 4
+
+@profutils.timed()
+def gaussian_blur(im, sigma,
+	method = 'auto',	# 'separable', 'recursive' or 'auto'
+	truncate = 5):		# Extent of the separable kernel in units of sigma
+	"""
+		Convolve an image, or a stack of images with shape (N, height, width), 
+		with a circular 2D Gaussian with standard deviation sigma (in pixels). 
+		Pixels outside the image are assumed to be zero. 
+
+		The 2D Gaussian is applied as two 1D passes along the rows and 
+		columns. With method = 'separable', each pass is a direct convolution 
+		with a kernel extending out to truncate * sigma, so the cost per pixel 
+		scales with sigma. With method = 'recursive', each pass is the 
+		recursive (IIR) approximation to a Gaussian of van Vliet, Young & 
+		Verbeek (1998), whose cost per pixel is independent of sigma. By default 
+		('auto') the recursive filter is used when sigma is larger than 
+		GAUSSIAN_BLUR_RECURSIVE_SIGMA.
+	"""
+	if method == 'auto':
+		method = 'recursive' if sigma > GAUSSIAN_BLUR_RECURSIVE_SIGMA else 'separable'
+
+	im = np.asarray(im)
+	if not np.issubdtype(im.dtype, np.floating):
+		im = im.astype(np.float64)
+
+	if method == 'separable':
+		im_blurred = scipy.ndimage.gaussian_filter1d(im, sigma, axis=-1, mode='constant', truncate=truncate)
+		im_blurred = scipy.ndimage.gaussian_filter1d(im_blurred, sigma, axis=-2, mode='constant', truncate=truncate)
+	elif method == 'recursive':
+		im_blurred = _recursive_gaussian_1d(im, sigma, axis=-1)
+		im_blurred = _recursive_gaussian_1d(im_blurred, sigma, axis=-2)
+	else:
+		print("ERROR: method must be one of 'separable', 'recursive' or 'auto'!")
+		raise UserWarning
+
+	return im_blurred
+
+################################################################################
+def _recursive_gaussian_1d(im, sigma, axis):
+	"""
+		Apply the 3rd-order recursive Gaussian filter of van Vliet, Young & 
+		Verbeek (1998) to im along the given axis: a causal IIR filter 
+		followed by the same filter applied in the reverse direction. The 
+		poles of the filter are scaled so that the variance of its impulse 
+		response is exactly sigma**2.
+	"""
+	if sigma < 0.5:
+		print("ERROR: the recursive Gaussian filter requires sigma >= 0.5 pixels!")
+		raise UserWarning
+	poles = _RECURSIVE_GAUSSIAN_POLES**(-1 / _recursive_gaussian_q(sigma))
+	a = np.real(np.poly(poles))
+	B = np.sum(a)	# Unit gain at zero frequency
+
+	# The response of the causal pass extends beyond the end of the image, 
+	# so pad the end with zeros before applying the anti-causal pass.
+	axis = axis % im.ndim
+	L = im.shape[axis]
+	N_pad = int(np.ceil(4 * sigma))
+	pad_width = [(0, 0)] * im.ndim
+	pad_width[axis] = (0, N_pad)
+	im_filtered = scipy.signal.lfilter([B], a, np.pad(im, pad_width, mode='constant'), axis=axis)
+	im_filtered = np.flip(scipy.signal.lfilter([B], a, np.flip(im_filtered, axis), axis=axis), axis)
+
+	idxs = [slice(None)] * im.ndim
+	idxs[axis] = slice(0, L)
+	return im_filtered[tuple(idxs)]
+
+# Poles of the recursive Gaussian filter for q = 1, i.e. sigma = 2 (van Vliet et al. 1998).
+_RECURSIVE_GAUSSIAN_POLES = np.array([1.41650 + 1.00829j, 1.41650 - 1.00829j, 1.86543])
+
+def _recursive_gaussian_q(sigma):
+	""" Return the scaling q of the poles of the recursive Gaussian filter with standard deviation sigma. """
+	def variance(q):
+		d = _RECURSIVE_GAUSSIAN_POLES**(1 / q)
+		return np.real(np.sum(2 * d / (d - 1)**2))
+	return scipy.optimize.brentq(lambda q: variance(q) - sigma**2, 0.1, 10 * sigma + 10)
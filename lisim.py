@@ -63,9 +63,10 @@ import time
 
 # linguine modules 
 from linguineglobals import *
-import fftwconvolve, obssim, etcutils, imutils
+import fftwconvolve, obssim, etcutils, imutils, memutils, profutils, rngutils
 
 ################################################################################
+@profutils.timed()
 def lucky_frame(
 	im, 							# In electron counts/s.
 	psf, 							# Normalised.
@@ -80,12 +81,16 @@ def lucky_frame(
 	detector_saturation=np.inf,		# Detector saturation.
 	plate_scale_as_px_conv = 1,		# Only used for plotting.
 	plate_scale_as_px = 1,			# Only used for plotting.
+	rng = None,						# Random number generator (see rngutils.get_rng()).
 	plotit=False):
 	""" 
 		This function can be used to generate a short-exposure 'lucky' image that can be input to the Lucky Imaging algorithms.
 			Input: 	one 'raw' countrate image of a galaxy; one PSF with which to convolve it (at the same plate scale)
 			Output: a 'Lucky' exposure. 			
 			Process: convolve with PSF --> resize to detector --> add tip and tilt (from a premade vector of tip/tilt values) --> convert to counts --> add noise --> subtract the master sky/dark current. 
+
+		To generate many frames, use a LuckyFrameEngine instead, which avoids 
+		reallocating the intermediate arrays for every frame.
 	"""	
 	# Convolve with PSF.
 	im_raw = im
@@ -114,7 +119,7 @@ def lucky_frame(
 		im_tt = imutils.centre_crop(im_tt, final_sz)	
 	# Convert to counts. Note that we apply the gain AFTER we convert to integer
 	# counts.
-	im_counts = etcutils.expected_count_to_count(im_tt, t_exp = t_exp) * gain
+	im_counts = etcutils.expected_count_to_count(im_tt, t_exp = t_exp, rng = rng) * gain
 	# Add the pre-gain noise. Here, we assume that the noise frame has already 
 	# been multiplied by the gain before being passed into this function.
 	im_noisy = im_counts + noise_frame_gain_multiplied
@@ -191,6 +196,389 @@ def lucky_frame(
 	return im_noisy
 
 ################################################################################
+class LuckyFrameEngine(object):
+
+	# Stages, in the order in which they are applied.
+	_stages = ['convolve', 'add star', 'resize', 'tip/tilt', 'counts', 'noise', 'saturation']
+
+	def __init__(self, psf, im_shape, scale_factor, t_exp, final_sz,
+		optical_system = None,			# If given, the gain and saturation are taken from optical_system.detector.
+		gain = 1,						# Detector gain.
+		detector_saturation = np.inf,	# Detector saturation.
+		dtype = np.float64,
+		rng = None						# Random number generator, or a rngutils.FrameStreams instance to use a separate stream for each frame.
+		):
+		""" 
+			A frame synthesis engine that generates 'lucky' exposures in the 
+			same way as lucky_frame(), but which is configured once for a run 
+			of many frames with the same PSF, image sizes and detector.
+
+			All the buffers needed for each stage are allocated (aligned, if 
+			pyfftw is available) when the engine is created, and the FFT of 
+			the PSF and the FFT plans are computed only once. Each stage then 
+			operates in place on these buffers, so generating a frame does 
+			not allocate any full-size temporary arrays (other than the 
+			Poisson draw).
+
+			The time spent in each stage is accumulated in self.timing; call 
+			print_timing() to see a summary.
+
+			If rng is a rngutils.FrameStreams instance, then the Poisson noise 
+			in each frame is drawn from that frame's own stream, so that a 
+			sequence of frames generated in chunks (or by several engines in 
+			different processes) is identical to one generated serially, 
+			provided that each frame is given its index in the sequence.
+		"""
+		if optical_system is not None:
+			gain = optical_system.detector.gain
+			detector_saturation = optical_system.detector.saturation
+		self.scale_factor = scale_factor
+		self.t_exp = t_exp
+		self.gain = gain
+		self.detector_saturation = detector_saturation
+		self.dtype = np.dtype(dtype)
+		self.rng = rng if isinstance(rng, rngutils.FrameStreams) else rngutils.get_rng(rng)
+		self._next_frame_idx = 0
+
+		# Image sizes at each stage.
+		self.im_shape = tuple(im_shape)
+		height, width = self.im_shape
+		self.resized_shape = (int(np.round(height / scale_factor)), int(np.round(width / scale_factor)))
+		if np.isscalar(final_sz):
+			final_sz = (final_sz, final_sz)
+		self.final_sz = tuple(int(x) for x in final_sz)
+
+		# Convolution: the image is zero-padded to the full linear convolution 
+		# size and the 'same' part of the result is kept.
+		self._conv = None
+		self.set_psf(psf)
+
+		# Resizing.
+		self._resize_in = fftwconvolve.RealFFT2(self.im_shape, dtype=self.dtype)
+		self._resize_out = fftwconvolve.RealFFT2(self.resized_shape, dtype=self.dtype)
+
+		# Tip/tilt, cropping and conversion to counts.
+		self._im_tt = np.zeros(self.resized_shape, dtype=self.dtype)
+		crop_height = max((self.resized_shape[0] - self.final_sz[0]) // 2, 0)
+		crop_width = max((self.resized_shape[1] - self.final_sz[1]) // 2, 0)
+		self._crop = (
+			slice(crop_height, crop_height + min(self.resized_shape[0], self.final_sz[0])), 
+			slice(crop_width, crop_width + min(self.resized_shape[1], self.final_sz[1])))
+		self._edge_buffer_px = (self.resized_shape[0] - self.final_sz[0]) / 2
+		self._im_cropped_shape = self._im_tt[self._crop].shape
+		self._im_expected = np.zeros(self._im_cropped_shape, dtype=self.dtype)
+		self._im_noisy = np.zeros(self._im_cropped_shape, dtype=self.dtype)
+		profutils.count_bytes(self._im_tt, self._im_expected, self._im_noisy)
+
+		self.reset_timing()
+
+	def set_psf(self, psf):
+		""" Set the PSF with which images are convolved. """
+		height, width = self.im_shape
+		psf_height, psf_width = psf.shape
+		conv_shape = (
+			fftwconvolve._next_regular(height + psf_height - 1), 
+			fftwconvolve._next_regular(width + psf_width - 1))
+		if self._conv is None or self._conv.shape != conv_shape:
+			self._conv = fftwconvolve.RealFFT2(conv_shape, dtype=self.dtype)
+		self._conv.real[...] = 0
+		self._conv.real[:psf_height, :psf_width] = psf
+		self._psf_spec = self._conv.forward().copy()
+		self._same = (
+			slice((psf_height - 1) // 2, (psf_height - 1) // 2 + height), 
+			slice((psf_width - 1) // 2, (psf_width - 1) // 2 + width))
+
+	def reset_timing(self):
+		self.timing = {}
+		self.N_frames = 0
+
+	def _time_stage(self, stage, tic):
+		toc = profutils.clock()
+		self.timing[stage] = self.timing.get(stage, 0) + (toc - tic)
+		profutils.record('lisim.LuckyFrameEngine.' + stage, tic, toc)
+		return toc
+
+	def print_timing(self):
+		""" Print the time spent in each stage. """
+		total = sum(self.timing.values())
+		print("LUCKY FRAME ENGINE: {:d} frames, total time {:.5f} s".format(self.N_frames, total))
+		for stage in self._stages:
+			if stage in self.timing:
+				print("\t{:<12}\t{:.5f} s\t({:.1f}%)".format(stage, self.timing[stage], 100 * self.timing[stage] / total if total else 0))
+
+	def convolve_and_resize(self, im, 
+		im_star = None):
+		"""
+			Convolve the image im with the PSF, add the star (if given) and 
+			resize to the detector plate scale. Returns the resized image, 
+			which is a buffer owned by the engine.
+		"""
+		height, width = self.im_shape
+		tic = profutils.clock()
+
+		# Convolve with PSF.
+		self._conv.real[...] = 0
+		self._conv.real[:height, :width] = im
+		self._conv.forward()
+		self._conv.spec *= self._psf_spec
+		self._conv.inverse()
+		im_convolved = self._conv.real[self._same]
+		tic = self._time_stage('convolve', tic)
+
+		# Add a star to the field.
+		if im_star is not None:
+			if im_star.shape != im_convolved.shape:
+				print("ERROR: the input image of the star MUST have the same size and plate scale as the image of the galaxy after convolution!")
+				raise UserWarning
+			im_convolved += im_star
+			tic = self._time_stage('add star', tic)
+
+		# Resize to detector (+ edge buffer), conserving the pixel sum.
+		self._resize_in.real[...] = im_convolved
+		sum_before = np.sum(self._resize_in.real)
+		self._resize_in.forward()
+		imutils._fourier_crop(self._resize_in.spec, self._resize_out.spec)
+		im_resized = self._resize_out.inverse()
+		sum_after = np.sum(im_resized)
+		if sum_after != 0:
+			im_resized *= sum_before / sum_after
+		self._time_stage('resize', tic)
+
+		return im_resized
+
+	def frame_from_resized(self, im_resized, 
+		tt = np.array([0, 0]),
+		noise_frame_gain_multiplied = 0,
+		noise_frame_post_gain = 0,
+		out = None,
+		frame_idx = None):
+		"""
+			Add tip and tilt to an image that has already been convolved and 
+			resized by convolve_and_resize(), crop it to the detector size, 
+			convert to counts, add noise and account for detector saturation.
+
+			frame_idx is the index of the frame in the sequence, which selects 
+			its random number stream if the engine's rng is a FrameStreams 
+			instance. By default, it is one more than that of the last frame.
+		"""
+		if frame_idx is None:
+			frame_idx = self._next_frame_idx
+		self._next_frame_idx = frame_idx + 1
+		if isinstance(self.rng, rngutils.FrameStreams):
+			rng = self.rng.frame(frame_idx)
+		else:
+			rng = self.rng
+
+		tic = profutils.clock()
+
+		# Add tip and tilt. To avoid edge effects, max(abs(tt)) should be less than or equal to the edge buffer.
+		if self._edge_buffer_px > 0 and np.max(np.abs(tt)) > self._edge_buffer_px:
+			print("WARNING: the edge buffer is less than the supplied tip and tilt by a margin of {:.2f} pixels! Shifted image will be clipped.".format(np.max(np.abs(tt)) - self._edge_buffer_px))
+		scipy.ndimage.interpolation.shift(im_resized, (tt[0], tt[1]), output=self._im_tt)
+		tic = self._time_stage('tip/tilt', tic)
+
+		# Crop back down to the detector size and convert to counts. Note that 
+		# we apply the gain AFTER we convert to integer counts.
+		im_expected = self._im_expected
+		np.multiply(self._im_tt[self._crop], self.t_exp, out=im_expected)
+		np.maximum(im_expected, 0, out=im_expected)
+		im_noisy = self._im_noisy if out is None else out
+		np.multiply(rng.poisson(lam=im_expected), self.gain, out=im_noisy, casting='unsafe')
+		tic = self._time_stage('counts', tic)
+
+		# Add the pre-gain noise (which is assumed to have already been 
+		# multiplied by the gain) and the post-gain noise (i.e. read noise).
+		im_noisy += noise_frame_gain_multiplied
+		im_noisy += noise_frame_post_gain
+		tic = self._time_stage('noise', tic)
+
+		# Account for detector saturation.
+		np.clip(im_noisy, 0, self.detector_saturation, out=im_noisy)
+		self._time_stage('saturation', tic)
+		self.N_frames += 1
+
+		return im_noisy if out is not None else im_noisy.copy()
+
+	def frame(self, im, 
+		tt = np.array([0, 0]),
+		im_star = None,
+		noise_frame_gain_multiplied = 0,
+		noise_frame_post_gain = 0,
+		out = None,
+		frame_idx = None):
+		"""
+			Generate a 'lucky' exposure from the truth image im (in electron 
+			counts/s). This is equivalent to lucky_frame(). 
+
+			If out is given, the frame is written into it; otherwise a new 
+			array is returned.
+		"""
+		im_resized = self.convolve_and_resize(im, im_star=im_star)
+		return self.frame_from_resized(im_resized, 
+			tt = tt, 
+			noise_frame_gain_multiplied = noise_frame_gain_multiplied, 
+			noise_frame_post_gain = noise_frame_post_gain, 
+			out = out,
+			frame_idx = frame_idx)
+
+	def sequence(self, im, tt,
+		im_star = None,
+		noise_frames_gain_multiplied = 0,
+		noise_frames_post_gain = 0,
+		out = None,
+		first_frame = None):	# Index of the first frame in the sequence (by default, following the last frame generated)
+		"""
+			Generate a sequence of 'lucky' exposures of the truth image im 
+			with tip and tilt tt (with shape (N, 2)), all with the engine's PSF.
+
+			Because the PSF is the same for every frame, the truth image (plus 
+			the star, if given) is convolved and resized only once; only the 
+			tip/tilt, conversion to counts and noise are applied to each frame. 
+			The noise frames may be given either as a single frame or as an 
+			array of N frames.
+		"""
+		tt = np.reshape(tt, (-1, 2))
+		N = tt.shape[0]
+		if out is None:
+			out = np.zeros((N,) + self._im_cropped_shape, dtype=self.dtype)
+			profutils.count_bytes(out)
+
+		if first_frame is None:
+			first_frame = self._next_frame_idx
+
+		im_resized = self.convolve_and_resize(im, im_star=im_star)
+		for k in range(N):
+			self.frame_from_resized(im_resized, 
+				tt = tt[k], 
+				noise_frame_gain_multiplied = _kth_frame(noise_frames_gain_multiplied, k), 
+				noise_frame_post_gain = _kth_frame(noise_frames_post_gain, k), 
+				out = out[k],
+				frame_idx = first_frame + k)
+
+		return out
+
+	def iter_sequence(self, im, tt,
+		im_star = None,
+		noise_frames_gain_multiplied = 0,
+		noise_frames_post_gain = 0,
+		chunk_size = None,		# By default, as many frames as fit in the memory budget (see memutils.chunk_size())
+		first_frame = None):
+		"""
+			Generate the same frames as sequence(), but chunk_size frames at 
+			a time, yielding the index of the first frame of each chunk 
+			(relative to the start of the sequence) and the frames in it, so 
+			that the whole sequence never needs to be held in memory, e.g. 
+			when writing the frames to disk with an imutils.AsyncCubeWriter. 
+			The same buffer is reused for every chunk, so copy it if it must 
+			be kept.
+		"""
+		tt = np.reshape(tt, (-1, 2))
+		N = tt.shape[0]
+		if chunk_size is None:
+			frame_bytes = self._im_cropped_shape[0] * self._im_cropped_shape[1] * self.dtype.itemsize
+			chunk_size = memutils.chunk_size(frame_bytes, N)
+		if first_frame is None:
+			first_frame = self._next_frame_idx
+
+		out = np.zeros((min(chunk_size, N),) + self._im_cropped_shape, dtype=self.dtype)
+		im_resized = self.convolve_and_resize(im, im_star=im_star)
+		for start in range(0, N, chunk_size):
+			stop = min(start + chunk_size, N)
+			for k in range(start, stop):
+				self.frame_from_resized(im_resized, 
+					tt = tt[k], 
+					noise_frame_gain_multiplied = _kth_frame(noise_frames_gain_multiplied, k), 
+					noise_frame_post_gain = _kth_frame(noise_frames_post_gain, k), 
+					out = out[k - start],
+					frame_idx = first_frame + k)
+			yield start, out[:stop - start]
+
+################################################################################
+@profutils.timed()
+def lucky_frames(im, psf, scale_factor, t_exp, final_sz, tt,
+	im_star = None,
+	noise_frames_gain_multiplied = 0,	# Either a single noise frame or one for each frame
+	noise_frames_post_gain = 0,			# Either a single noise frame or one for each frame
+	gain = 1,
+	detector_saturation = np.inf,
+	optical_system = None,
+	dtype = np.float64,
+	rng = None,			# Random number generator, or a rngutils.FrameStreams instance to use a separate stream for each frame
+	first_frame = 0,	# Index of the first frame (e.g. when a sequence is generated in chunks)
+	timeit = False):
+	"""
+		Generate a sequence of N 'lucky' exposures of the truth image im with 
+		tip and tilt tt (with shape (N, 2)). Each frame is generated in the 
+		same way as in lucky_frame().
+
+		psf may be either a single PSF or a cube of N PSFs (one per frame). 
+		If a single PSF is given, or every PSF in the cube is identical, then 
+		the PSF is static and the truth image is convolved and resized only 
+		once, so that only the tip/tilt and noise are computed for each frame. 
+		Otherwise, each frame is convolved with its own PSF.
+	"""
+	tic = time.time()
+	tt = np.reshape(tt, (-1, 2))
+	N = tt.shape[0]
+	if psf.ndim == 3 and psf.shape[0] != N:
+		print("ERROR: the number of PSFs must be equal to the number of tip/tilt values!")
+		raise UserWarning
+
+	static_psf = psf.ndim == 2 or _is_static(psf)
+	engine = LuckyFrameEngine(
+		psf = psf if psf.ndim == 2 else psf[0], 
+		im_shape = im.shape, 
+		scale_factor = scale_factor, 
+		t_exp = t_exp, 
+		final_sz = final_sz, 
+		optical_system = optical_system, 
+		gain = gain, 
+		detector_saturation = detector_saturation, 
+		dtype = dtype,
+		rng = rng)
+
+	if static_psf:
+		ims = engine.sequence(im, tt, 
+			im_star = im_star, 
+			noise_frames_gain_multiplied = noise_frames_gain_multiplied, 
+			noise_frames_post_gain = noise_frames_post_gain,
+			first_frame = first_frame)
+	else:
+		ims = np.zeros((N,) + engine._im_cropped_shape, dtype=dtype)
+		for k in range(N):
+			if k > 0:
+				engine.set_psf(psf[k])
+			engine.frame(im, 
+				tt = tt[k], 
+				im_star = im_star, 
+				noise_frame_gain_multiplied = _kth_frame(noise_frames_gain_multiplied, k), 
+				noise_frame_post_gain = _kth_frame(noise_frames_post_gain, k), 
+				out = ims[k],
+				frame_idx = first_frame + k)
+
+	if timeit:
+		print("GENERATING LUCKY FRAMES: Elapsed time for {:d} frames with {} PSF: {:.5f}".format(N, 'static' if static_psf else 'time-varying', time.time() - tic))
+		engine.print_timing()
+
+	return ims
+
+################################################################################
+def _is_static(psfs):
+	""" Returns True if every PSF in the cube psfs is identical. """
+	for k in range(1, psfs.shape[0]):
+		if not np.array_equal(psfs[k], psfs[0]):
+			return False
+	return True
+
+################################################################################
+def _kth_frame(frames, k):
+	""" Returns frames[k] if frames is a cube of frames, or frames otherwise. """
+	if np.ndim(frames) == 3:
+		return frames[k]
+	return frames
+
+################################################################################
+@profutils.timed()
 def shift_pp(image, img_ref_peak_idx, fsr, bid_area):
 	if type(image) == list:
 		image = np.array(image)	
@@ -211,6 +599,7 @@ def shift_pp(image, img_ref_peak_idx, fsr, bid_area):
 	return image_shifted, -rel_shift_idx, peak_pixel_val
 
 ################################################################################
+@profutils.timed()
 def shift_centroid(image, img_ref_peak_idx, centroid_threshold):
 	if type(image) == list:
 		image = np.array(image)
@@ -230,6 +619,7 @@ def shift_centroid(image, img_ref_peak_idx, centroid_threshold):
 	return image_shifted, -rel_shift_idx
 
 ################################################################################
+@profutils.timed()
 def shift_xcorr(image, image_ref, buff_xcorr, sub_pixel_shift):
 	if type(image) == list:
 		image = np.array(image)
@@ -272,6 +662,7 @@ def shift_xcorr(image, image_ref, buff_xcorr, sub_pixel_shift):
 	return image_shifted, tuple(-x for x in rel_shift_idx)
 
 ################################################################################
+@profutils.timed()
 def shift_gaussfit(image, img_ref_peak_idx):
 	if type(image) == list:
 		image = np.array(image)
@@ -288,6 +679,7 @@ def shift_gaussfit(image, img_ref_peak_idx):
 	return image_shifted, tuple(-x for x in rel_shift_idx)
 
 ################################################################################
+@profutils.timed()
 def lucky_imaging(images, li_method, 
 	mode = 'serial',		# whether or not to process images in parallel
 	image_ref = None,		# reference image
@@ -310,6 +702,10 @@ def lucky_imaging(images, li_method,
 	"""
 	tic = time.time()
 	images, image_ref, N = _li_error_check(images, image_ref, N)
+	memutils.check_memory(
+		memutils.lucky_imaging_bytes(N, image_ref.shape[0], image_ref.shape[1], li_method, 
+			fsr = fsr, mode = mode, stacking_method = stacking_method, sigma_kernel = sigma_kernel), 
+		"Lucky Imaging technique '{}' with {:d} {:d} x {:d} images".format(li_method, N, image_ref.shape[0], image_ref.shape[1]))
 	if not timeit:
 		print("Applying Lucky Imaging technique '{}' to input series of {:d} images...".format(li_method, N))
 	
@@ -368,6 +764,7 @@ def lucky_imaging(images, li_method,
 	# In here, want to parallelise the processing for *each image*. So make 
 	# shift functions that work on a single image and return the shifted image, 
 	# then stack it out here.
+	tic_stage = profutils.clock()
 	if mode == 'parallel':
 		# Setting up to execute in parallel.
 		images = images.tolist()	# Need to convert the image array to a list.
@@ -398,6 +795,7 @@ def lucky_imaging(images, li_method,
 	else:
 		print("ERROR: mode must be either parallel or serial!")
 		raise UserWarning
+	tic_stage = profutils.lap('lisim.lucky_imaging.registration', tic_stage)
 
 	# If we're using an FSR < 1 in the peak pixel method, then we must do the following:
 	#	1. Get our method to return a list of peak pixel values.
@@ -405,7 +803,7 @@ def lucky_imaging(images, li_method,
 	#	3. Add these images together. 
 	if li_method == 'peak pixel' and fsr < 1:
 		sorted_idx = np.argsort(peak_pixel_vals)[::-1]	# Array holding indices of images
-		N = np.ceil(fsr * N)
+		N = int(np.ceil(fsr * N))
 		# Is averaging the best way to do this? Probably not...
 		if stacking_method == 'median combine':
 			arr = np.ndarray((1, image_ref.shape[0], image_ref.shape[1]))
@@ -462,11 +860,10 @@ def lucky_imaging(images, li_method,
 
 		# Smoothing with a Gaussian kernel
 		if sigma_kernel != 0:
-			for k in range(images_fft_amp.shape[0]):
-				images_fft_amp[k] = imutils.gaussian_smooth(
-					im=images_fft_amp[k],
-					sigma=sigma_kernel
-					)
+			images_fft_amp = imutils.gaussian_blur(
+				im=images_fft_amp,
+				sigma=sigma_kernel
+				)
 
 		# For now, don't worry about parallelisation.		
 		vals_to_keep=np.zeros( (h, w, N_frames_to_keep), dtype=complex )
@@ -494,6 +891,7 @@ def lucky_imaging(images, li_method,
 				(image_ref, images_shifted)))
 		elif stacking_method == 'average':
 			image_stacked = (image_ref + np.sum(images_shifted, 0)) / (N + 1)	
+	profutils.lap('lisim.lucky_imaging.stacking', tic_stage)
 
 	toc = time.time()
 	if timeit:
@@ -0,0 +1,252 @@
+################################################################################
+#
+# 	File:		memutils.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Predicting the peak memory use of each simulation and Lucky Imaging
+#	stage and choosing chunk sizes that stay within a memory budget.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+try:
+	import psutil
+	HAS_PSUTIL = True
+except ImportError:
+	HAS_PSUTIL = False
+
+# Unless set using set_memory_budget(), the memory budget is this fraction
+# of the memory available when it is requested.
+MEMORY_BUDGET_FRACTION = 0.5
+
+# Memory budget used if the available memory cannot be determined.
+DEFAULT_MEMORY_BUDGET_BYTES = 2 * 1024**3
+
+_memory_budget_bytes = None
+
+################################################################################
+def available_memory_bytes():
+	""" Returns the memory (bytes) available to new processes, or None if it cannot be determined. """
+	if HAS_PSUTIL:
+		return int(psutil.virtual_memory().available)
+	# Linux
+	try:
+		with open('/proc/meminfo', 'r') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except (IOError, OSError, ValueError):
+		pass
+	# Other POSIX systems: the free physical memory (which underestimates
+	# the available memory).
+	try:
+		return int(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+	except (AttributeError, ValueError, OSError):
+		return None
+
+################################################################################
+def set_memory_budget(nbytes):
+	""" 
+		Set the memory budget (bytes) used to choose chunk sizes. If nbytes 
+		is None, the budget is MEMORY_BUDGET_FRACTION of the available memory. 
+	"""
+	global _memory_budget_bytes
+	_memory_budget_bytes = nbytes
+
+def memory_budget_bytes(
+	available_bytes = None):	# By default, available_memory_bytes()
+	""" Returns the memory budget (bytes) used to choose chunk sizes. """
+	if _memory_budget_bytes is not None:
+		return _memory_budget_bytes
+	if available_bytes is None:
+		available_bytes = available_memory_bytes()
+	if available_bytes is None:
+		return DEFAULT_MEMORY_BUDGET_BYTES
+	return int(MEMORY_BUDGET_FRACTION * available_bytes)
+
+################################################################################
+def chunk_size(bytes_per_frame,
+	N_frames = None,		# If given, the chunk size is at most N_frames
+	fixed_bytes = 0,		# Memory (bytes) used independently of the chunk size
+	budget_bytes = None):	# By default, memory_budget_bytes()
+	"""
+		Returns the largest number of frames (at least 1) that can be
+		processed at once if each frame requires bytes_per_frame bytes
+		(including any temporary arrays) without exceeding the budget.
+	"""
+	if budget_bytes is None:
+		budget_bytes = memory_budget_bytes()
+	N = int((budget_bytes - fixed_bytes) // max(bytes_per_frame, 1))
+	if N_frames is not None:
+		N = min(N, N_frames)
+	return max(N, 1)
+
+################################################################################
+# Peak memory (bytes) used by each stage, not including its inputs. These
+# count the arrays allocated by each function, including the largest
+# temporary arrays; small arrays are neglected.
+################################################################################
+def noise_frames_from_etc_bytes(N_frames, height_px, width_px):
+	""" noise_frames_from_etc(): 8 integer cubes, plus 2 temporary cubes while summing. """
+	return 10 * N_frames * height_px * width_px * np.dtype(int).itemsize
+
+def detector_frames_bytes(N_frames, height_px, width_px):
+	""" detector_frames(): Poisson, Gamma and read noise draws and the output, all float64. """
+	return 6 * N_frames * height_px * width_px * 8
+
+def star_field_bytes(N_frames, N_stars, stamp_shape, height_px, width_px):
+	""" star_field(): the shifted stamps, their spectra, pixel indices and the accumulated counts. """
+	return N_frames * (80 * N_stars * stamp_shape[0] * stamp_shape[1] + 8 * height_px * width_px)
+
+def lucky_frames_bytes(N_frames, im_shape, psf_shape, scale_factor, final_sz,
+	dtype = np.float64):
+	""" lucky_frames(): the output cube and the LuckyFrameEngine's buffers. """
+	itemsize = np.dtype(dtype).itemsize
+	height, width = im_shape
+	# Convolution (real and complex buffers and the PSF spectrum).
+	conv_px = (height + psf_shape[0]) * (width + psf_shape[1])
+	fixed = conv_px * itemsize * 3
+	# Resizing.
+	resized_px = int(np.round(height / scale_factor)) * int(np.round(width / scale_factor))
+	fixed += (height * width + resized_px) * itemsize * 2
+	# Tip/tilt and counts.
+	fixed += 4 * resized_px * itemsize
+	return fixed + N_frames * final_sz[0] * final_sz[1] * itemsize
+
+def lucky_imaging_bytes(N_frames, height_px, width_px, li_method,
+	fsr = 1,
+	mode = 'serial',
+	stacking_method = 'average',
+	sigma_kernel = 0):
+	""" lucky_imaging(): the shifted images plus the temporary arrays used to select and stack them. """
+	cube = N_frames * height_px * width_px * 8
+	li_method = li_method.lower()
+	if li_method == 'blind stack':
+		# The images are stacked without being shifted.
+		return 2 * (N_frames + 1) * height_px * width_px * 8 if stacking_method == 'median combine' else 0
+
+	# Shifted images.
+	peak = cube
+	if mode == 'parallel':
+		# The images are converted to a list of Python floats and the
+		# shifted images are returned as a list.
+		peak += 5 * cube
+
+	N_frames_to_keep = max(1, int(np.ceil(fsr * N_frames)))
+	keep = N_frames_to_keep * height_px * width_px
+	if li_method == 'fourier amplitude selection' or li_method == 'fas':
+		# Edge ramp, complex FFT of the cube (and its fftshift), Fourier
+		# amplitudes (and their smoothed copy) and the selected values.
+		peak += cube + 4 * cube + cube + (2 * cube if sigma_kernel != 0 else 0) + 2 * keep * 16 + keep * 8
+	elif stacking_method == 'median combine':
+		n_stacked = N_frames_to_keep if li_method == 'peak pixel' else N_frames
+		peak += 2 * (n_stacked + 1) * height_px * width_px * 8
+	elif li_method == 'peak pixel' and fsr < 1:
+		peak += keep * 8
+	return peak
+
+################################################################################
+def memory_plan(N_frames, height_px, width_px,
+	li_method = 'cross-correlation',
+	fsr = 1,
+	mode = 'serial',
+	stacking_method = 'average',
+	sigma_kernel = 0,
+	dtype = np.float64,			# Type of the simulated frames
+	oversampling = 2,			# Oversampling of the truth image relative to the detector
+	psf_shape = (128, 128),		# Shape of the PSF (at the oversampled plate scale)
+	available_bytes = None,		# By default, available_memory_bytes()
+	printIt = True):
+	"""
+		Predict the peak memory used by each stage of a simulation of
+		N_frames frames of size (height_px, width_px) followed by the Lucky
+		Imaging method li_method, and the number of frames per chunk that
+		keeps each chunked stage within the memory budget.
+
+		Returns a dictionary containing the predicted peak memory (bytes) of
+		each stage, the memory needed to hold the frames themselves, the
+		available memory and budget and the chunk sizes. Stages whose peak
+		memory exceeds the available memory are flagged. The stages that
+		take a first_frame argument can be run one chunk at a time (with
+		the same result if rng is a rngutils.FrameStreams instance).
+	"""
+	if available_bytes is None:
+		available_bytes = available_memory_bytes()
+	budget_bytes = memory_budget_bytes(available_bytes)
+	frame_px = height_px * width_px
+	im_shape = (oversampling * height_px, oversampling * width_px)
+	frames_bytes = N_frames * frame_px * np.dtype(dtype).itemsize
+
+	stages = {
+		'noise_frames_from_etc' : noise_frames_from_etc_bytes(N_frames, height_px, width_px),
+		'lucky_frames' : lucky_frames_bytes(N_frames, im_shape, psf_shape, oversampling, (height_px, width_px), dtype),
+		'detector_frames' : detector_frames_bytes(N_frames, height_px, width_px),
+		'lucky_imaging' : lucky_imaging_bytes(N_frames, height_px, width_px, li_method, fsr, mode, stacking_method, sigma_kernel)
+	}
+	fixed_bytes = lucky_frames_bytes(0, im_shape, psf_shape, oversampling, (height_px, width_px), dtype)
+	chunk_frames = {
+		'noise_frames_from_etc' : chunk_size(noise_frames_from_etc_bytes(1, height_px, width_px), N_frames, budget_bytes = budget_bytes),
+		'lucky_frames' : chunk_size(lucky_frames_bytes(1, im_shape, psf_shape, oversampling, (height_px, width_px), dtype) - fixed_bytes, N_frames, fixed_bytes, budget_bytes),
+		'detector_frames' : chunk_size(detector_frames_bytes(1, height_px, width_px), N_frames, budget_bytes = budget_bytes),
+	}
+	plan = {
+		'stages' : stages,
+		'frames' : frames_bytes,
+		'peak' : max(stages.values()) + frames_bytes,
+		'available' : available_bytes,
+		'budget' : budget_bytes,
+		'chunk_frames' : chunk_frames,
+		'exceeds_available' : [stage for stage in stages if available_bytes is not None and stages[stage] + frames_bytes > available_bytes]
+	}
+
+	if printIt:
+		print("MEMORY PLAN: {:d} frames of {:d} x {:d} pixels, Lucky Imaging method '{}'".format(N_frames, height_px, width_px, li_method))
+		print("Available memory:\t{}".format(format_bytes(available_bytes) if available_bytes is not None else 'unknown'))
+		print("Memory budget:\t\t{}".format(format_bytes(budget_bytes)))
+		print("Frames:\t\t\t{}".format(format_bytes(frames_bytes)))
+		for stage in ['noise_frames_from_etc', 'lucky_frames', 'detector_frames', 'lucky_imaging']:
+			print("\t{:<24}{:>12}{:>20}{}".format(stage,
+				format_bytes(stages[stage]),
+				'{:d} frames/chunk'.format(chunk_frames[stage]) if stage in chunk_frames else '',
+				'\tEXCEEDS AVAILABLE MEMORY' if stage in plan['exceeds_available'] else ''))
+
+	return plan
+
+################################################################################
+def check_memory(nbytes, description):
+	""" Print a warning if nbytes bytes are unlikely to fit in the available memory. """
+	available_bytes = available_memory_bytes()
+	if available_bytes is not None and nbytes > available_bytes:
+		print("WARNING: {} is expected to need {} but only {} is available!".format(description, format_bytes(nbytes), format_bytes(available_bytes)))
+		return False
+	return True
+
+################################################################################
+def format_bytes(nbytes):
+	for unit in ['B', 'KiB', 'MiB', 'GiB']:
+		if abs(nbytes) < 1024:
+			return '{:.1f} {}'.format(nbytes, unit)
+		nbytes /= 1024
+	return '{:.1f} TiB'.format(nbytes)
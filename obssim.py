@@ -41,7 +41,10 @@ rc('image', interpolation='none', cmap = 'binary_r')
 import scipy.integrate
 import scipy.special
 import scipy.ndimage.interpolation
+import scipy.signal
 from scipy.signal import convolve2d
+from multiprocessing.dummy import Pool as ThreadPool	# dummy = Threads
+from collections import OrderedDict
 
 # Image processing library
 import PIL
@@ -53,12 +56,14 @@ except:
 
 # linguine modules 
 from linguineglobals import *
-import etc, etcutils, fftwconvolve, imutils
+import etc, etcutils, fftwconvolve, imutils, memutils, profutils, rngutils
 
 ################################################################################
+@profutils.timed()
 def add_tt(image, 
 	sigma_tt_px=None, 
-	tt_idxs=None):
+	tt_idxs=None,
+	rng=None):		# Random number generator (see rngutils.get_rng())
 
 	if not plt.is_numlike(sigma_tt_px) and not plt.is_numlike(tt_idxs):
 		print("ERROR: either sigma_tt_px OR tt_idxs must be specified!")
@@ -67,8 +72,9 @@ def add_tt(image,
 	# Adding a randomised tip/tilt to the image
 	if plt.is_numlike(sigma_tt_px):
 		# If no vector of tip/tilt values is specified, then we use random numbers.
-		shift_height = np.random.randn() * sigma_tt_px
-		shift_width = np.random.randn() * sigma_tt_px
+		rng = rngutils.get_rng(rng)
+		shift_height = rng.standard_normal() * sigma_tt_px
+		shift_width = rng.standard_normal() * sigma_tt_px
 		tt_idxs = [shift_height, shift_width]
 	else:
 		# Otherwise we take them from the input vector.
@@ -79,12 +85,136 @@ def add_tt(image,
 
 	return image_tt, tt_idxs
 
+################################################################################
+def tt_psd(f_hz, v_wind_m_s, D_tel_m,
+	L0_m = 25):		# Outer scale of the turbulence (m)
+	"""
+		Returns the (unnormalised) temporal power spectral density of the 
+		tip or tilt due to atmospheric turbulence (von Karman spectrum) at 
+		frequencies f_hz, for a turbulent layer moving at v_wind_m_s across a 
+		telescope of diameter D_tel_m:
+
+			S(f) = (f**2 + f_0**2)**(-1/3) * (1 + (f / f_c)**2)**(-5/2)
+
+		where f_0 = v / L0 is set by the outer scale and f_c = 0.3 v / D is 
+		the cutoff frequency due to averaging over the aperture, so that the 
+		PSD is flat at low frequencies, falls off as f**(-2/3) above f_0 and 
+		as f**(-17/3) above f_c.
+	"""
+	f_0 = v_wind_m_s / L0_m
+	f_c = 0.3 * v_wind_m_s / D_tel_m
+	return (f_hz**2 + f_0**2)**(-1/3) * (1 + (f_hz / f_c)**2)**(-5/2)
+
+################################################################################
+class TipTiltGenerator(object):
+
+	def __init__(self, sigma_tt_px, fps,
+		model = 'von karman',	# 'von karman' or 'ar'
+		v_wind_m_s = 10,		# Wind speed (von Karman model)
+		D_tel_m = 2.337,		# Telescope diameter (von Karman model)
+		L0_m = 25,				# Outer scale (von Karman model)
+		filter_len = None,		# Length of the FIR filter (von Karman model); by default, long enough to capture correlations on the outer scale
+		ar_coeffs = None,		# Coefficients a_1, ..., a_n of the AR(n) model x_k = a_1 x_{k-1} + ... + a_n x_{k-n} + e_k
+		rng = None				# Random number generator (see rngutils.get_rng())
+		):
+		"""
+			A generator of temporally correlated tip/tilt sequences (in 
+			pixels, with rms sigma_tt_px on each axis) sampled at fps, 
+			which can be produced in chunks of any length with next(). 
+			Successive chunks form a continuous sequence, so a long sequence 
+			never needs to be held in memory at once.
+
+			With model = 'von karman', white noise is filtered with a FIR 
+			filter whose power spectrum is tt_psd(), using overlap-save FFT 
+			filtering: the last filter_len - 1 noise samples of each chunk are 
+			kept so that the next chunk continues the sequence seamlessly.
+
+			With model = 'ar', white noise is passed through the AR(n) 
+			filter given by ar_coeffs, and the filter state is carried over 
+			between chunks. By default, an AR(1) model is used with a 
+			corner frequency equal to the von Karman cutoff frequency 
+			0.3 v / D.
+
+			The output of next() has shape (N, 2) and can be passed directly 
+			as the tip/tilt of a sequence of frames, e.g. to 
+			LuckyFrameEngine.sequence().
+		"""
+		self.sigma_tt_px = sigma_tt_px
+		self.fps = fps
+		self.model = model.lower()
+		self.rng = rngutils.get_rng(rng)
+
+		if self.model == 'von karman':
+			if filter_len is None:
+				f_0 = v_wind_m_s / L0_m
+				filter_len = int(2**np.ceil(np.log2(4 * fps / f_0)))
+			self.filter_len = int(filter_len)
+			# Zero-phase filter with amplitude response sqrt(S(f)), centred 
+			# and tapered with a Hann window.
+			f_hz = np.fft.rfftfreq(self.filter_len, d=1/fps)
+			h = np.fft.fftshift(np.fft.irfft(np.sqrt(tt_psd(f_hz, v_wind_m_s, D_tel_m, L0_m)), n=self.filter_len))
+			h *= np.hanning(self.filter_len)
+			# White noise with unit variance gives an output variance of sum(h**2).
+			self._h = h * sigma_tt_px / np.sqrt(np.sum(h**2))
+			self._noise_tail = self.rng.standard_normal(size=(self.filter_len - 1, 2))
+			self._H = {}	# FFT of the filter for each FFT length
+		elif self.model == 'ar':
+			if ar_coeffs is None:
+				f_c = 0.3 * v_wind_m_s / D_tel_m
+				ar_coeffs = [np.exp(-2 * np.pi * f_c / fps)]
+			self._a = np.concatenate(([1], -np.asarray(ar_coeffs, dtype=np.float64)))
+			pole_max = np.max(np.abs(np.roots(self._a))) if len(self._a) > 1 else 0
+			if pole_max >= 1:
+				print("ERROR: the AR coefficients must give a stationary process!")
+				raise UserWarning
+			# Scale the driving noise so that the stationary variance is 
+			# sigma_tt_px**2, using the impulse response up to the point where 
+			# it has decayed by a factor of 1e-12.
+			impulse = np.zeros(int(np.ceil(np.log(1e-12) / np.log(max(pole_max, 1e-3)))) + len(self._a))
+			impulse[0] = 1
+			h = scipy.signal.lfilter([1], self._a, impulse)
+			self._b = [sigma_tt_px / np.sqrt(np.sum(h**2))]
+			# Start from the stationary distribution by discarding a burn-in.
+			self._zi = np.zeros((len(self._a) - 1, 2))
+			self.next(len(impulse))
+		else:
+			print("ERROR: model must be either 'von karman' or 'ar'!")
+			raise UserWarning
+
+	@profutils.timed('obssim.TipTiltGenerator.next')
+	def next(self, N):
+		""" Returns the next N tip/tilt values as an array with shape (N, 2). """
+		noise = self.rng.standard_normal(size=(N, 2))
+		if self.model == 'ar':
+			tt, self._zi = scipy.signal.lfilter(self._b, self._a, noise, axis=0, zi=self._zi)
+			return tt
+
+		# Overlap-save: prepend the end of the previous chunk's noise.
+		noise = np.concatenate((self._noise_tail, noise), axis=0)
+		self._noise_tail = noise[N:]
+		n_fft = fftwconvolve._next_regular(noise.shape[0])
+		if n_fft not in self._H:
+			self._H[n_fft] = np.fft.rfft(self._h, n=n_fft)[:, np.newaxis]
+		tt = np.fft.irfft(np.fft.rfft(noise, n=n_fft, axis=0) * self._H[n_fft], n=n_fft, axis=0)
+		return tt[self.filter_len - 1:self.filter_len - 1 + N]
+
+	def chunks(self, N, 
+		chunk_size = None):		# By default, as many values as fit in the memory budget (see memutils.chunk_size())
+		""" Yields N tip/tilt values in chunks of at most chunk_size. """
+		if chunk_size is None:
+			# The noise, its FFT and the filtered values (2 axes, complex), 
+			# including the overlap with the previous chunk.
+			chunk_size = memutils.chunk_size(2 * 3 * 16, N, fixed_bytes = 2 * 3 * 16 * getattr(self, 'filter_len', 0))
+		for start in range(0, N, chunk_size):
+			yield self.next(min(chunk_size, N - start))
+
 ################################################################################
 def strehl(psf, psf_dl):
 	""" Calculate the Strehl ratio of an aberrated input PSF given the diffraction-limited PSF. """
 	return np.amax(psf) / np.amax(psf_dl)
 
 ################################################################################
+@profutils.timed()
 def field_star(psf, band, mag, optical_system, star_coords_as, final_sz, plate_scale_as_px,
 	gain = 1,
 	magnitude_system = 'AB',
@@ -92,7 +222,9 @@ def field_star(psf, band, mag, optical_system, star_coords_as, final_sz, plate_s
 	):
 	"""
 		Returns an image of a star in a field with a specified position offset
-		(specified w.r.t. the centre of the image).
+		(specified w.r.t. the centre of the image). The offset is rounded to 
+		the nearest pixel; see star_field() for sub-pixel positioning of many 
+		stars.
 
 		The returned image IS NOT gain-multiplied by default. Be careful!
 	"""
@@ -137,66 +269,232 @@ def field_star(psf, band, mag, optical_system, star_coords_as, final_sz, plate_s
 	return star_padded
 
 ################################################################################
-def convolve_psf(image, psf, 
-	padFactor=1,
-	plotit=False):
-	"""
-		 Convolve an input PSF with an input image. 
+@profutils.timed()
+def star_field(psf, band, mags, optical_system, star_coords_as, final_sz, plate_scale_as_px,
+	gain = 1,
+	magnitude_system = 'AB',
+	out = None
+	):
 	"""
+		Returns an image of a field of M stars with magnitudes mags at 
+		positions star_coords_as (specified w.r.t. the centre of the image, 
+		as in field_star()). 
+
+		star_coords_as may have shape (M, 2), in which case a single image is 
+		returned, or (N, M, 2), in which case a cube of N images is returned 
+		in which the stars may move from frame to frame. 
+
+		Unlike field_star(), positions are not rounded to the nearest pixel: 
+		the PSF is shifted by the sub-pixel part of each star's position 
+		(using the Fourier shift theorem) and then added to the image as a 
+		stamp of the size of the PSF. The stamps of all stars are shifted 
+		and accumulated at once in chunks of as many frames as fit in the 
+		memory budget (see memutils.chunk_size()), and only the range of 
+		pixels covered by the stamps is updated. Parts of stamps falling 
+		outside the image are discarded. If out is given, the stars are 
+		added to it.
 
-	# Padding the source image.
-	height, width = image.shape
-	pad_ud = height // padFactor // 2
-	pad_lr = width // padFactor // 2
-	
-	# If the image dimensions are odd, need to ad an extra row/column of zeros.
-	image_padded = np.pad(
-		image, 
-		((pad_ud,pad_ud + height % 2),
-		(pad_lr,pad_lr + width % 2)), 
-		mode='constant')
-	conv_height = 2 * pad_ud + height + (height % 2)
-	conv_width = 2 * pad_lr + width + (width % 2)
+		The returned image IS NOT gain-multiplied by default. Be careful!
+	"""
+	mags = np.atleast_1d(mags)
+	star_coords_as = np.asarray(star_coords_as, dtype=np.float64)
+	single_frame = star_coords_as.ndim == 2
+	if single_frame:
+		star_coords_as = star_coords_as[np.newaxis]
+	N, M = star_coords_as.shape[0:2]
+	if mags.shape != (M,):
+		print("ERROR: one magnitude must be given for each star!")
+		raise UserWarning
+	height, width = final_sz[0:2]
+	if out is None:
+		out = np.zeros((N, height, width))
+	elif single_frame:
+		out = out[np.newaxis]
+
+	# Count rate of each star.
+	count_rates = etcutils.surface_brightness_to_count_rate(
+		mu = mags, 
+		A_tel = optical_system.telescope.A_collecting_m2, 
+		tau = optical_system.telescope.tau,
+		qe = optical_system.detector.qe,
+		gain = gain,
+		magnitude_system = magnitude_system,
+		band = band)
+	count_rates = np.broadcast_to(count_rates, (M,))
+
+	# Position of the top left corner of the PSF stamp of each star: the PSF
+	# is placed at the centre of the image (as in field_star()) and then 
+	# shifted by the star's position. Pad the PSF by a pixel on each side so 
+	# that the sub-pixel shift does not wrap around the edges of the stamp.
+	psf_padded = np.pad(psf, 1, mode='constant')
+	stamp_height, stamp_width = psf_padded.shape
+	psf_padded_fft = np.fft.rfft2(psf_padded)[np.newaxis]
+	k_y = np.fft.fftfreq(stamp_height)[np.newaxis, :, np.newaxis]
+	k_x = np.fft.rfftfreq(stamp_width)[np.newaxis, np.newaxis, :]
+	centre_px = np.array([(height - psf.shape[0]) // 2 - 1, (width - psf.shape[1]) // 2 - 1])
+
+	chunk_size = memutils.chunk_size(memutils.star_field_bytes(1, M, psf_padded.shape, height, width), N)
+	for k0 in range(0, N, chunk_size):
+		k1 = min(k0 + chunk_size, N)
+		N_chunk = k1 - k0
+		star_coords_px = star_coords_as[k0:k1].reshape((N_chunk * M, 2)) / plate_scale_as_px
+		corner_px = centre_px + star_coords_px
+		corner_int = np.floor(corner_px).astype(int)
+		shift_px = corner_px - corner_int
+
+		# Shift every stamp by its sub-pixel offset at once.
+		phase = np.exp(-2j * np.pi * (k_y * shift_px[:, 0, np.newaxis, np.newaxis] + k_x * shift_px[:, 1, np.newaxis, np.newaxis]))
+		stamps = np.fft.irfft2(psf_padded_fft * phase, s=(stamp_height, stamp_width))
+		del phase
+		stamps *= np.tile(count_rates, N_chunk)[:, np.newaxis, np.newaxis]
+
+		# Indices of each stamp pixel in the chunk of the output cube.
+		frame_idxs = np.repeat(np.arange(N_chunk), M)[:, np.newaxis, np.newaxis]
+		row_idxs = corner_int[:, 0, np.newaxis, np.newaxis] + np.arange(stamp_height)[np.newaxis, :, np.newaxis]
+		col_idxs = corner_int[:, 1, np.newaxis, np.newaxis] + np.arange(stamp_width)[np.newaxis, np.newaxis, :]
+		frame_idxs, row_idxs, col_idxs = np.broadcast_arrays(frame_idxs, row_idxs, col_idxs)
+		inside = (row_idxs >= 0) & (row_idxs < height) & (col_idxs >= 0) & (col_idxs < width)
+		if not np.any(inside):
+			continue
+
+		# Accumulate the stamps (overlapping stamps are summed). np.bincount 
+		# is much faster than np.add.at for this; it is only taken over the 
+		# range of pixels covered by the stamps.
+		out_chunk = out[k0:k1]
+		if out_chunk.flags.c_contiguous:
+			idxs = np.ravel_multi_index((frame_idxs[inside], row_idxs[inside], col_idxs[inside]), out_chunk.shape)
+			idx_min = idxs.min()
+			counts = np.bincount(idxs - idx_min, weights=stamps[inside])
+			out_flat = out_chunk.reshape(-1)
+			out_flat[idx_min:idx_min + counts.size] += counts
+		else:
+			np.add.at(out_chunk, (frame_idxs[inside], row_idxs[inside], col_idxs[inside]), stamps[inside])
 
-	# Convolving the kernel with the image.
-	image_conv = np.ndarray((conv_height, conv_width))
-	image_conv_cropped = np.ndarray((height, width))
+	return out[0] if single_frame else out
 
-	image_padded = np.pad(image, ((pad_ud,pad_ud + height % 2),(pad_lr,pad_lr + width % 2)), mode='constant')
-	
-	image_conv = fftwconvolve.fftconvolve(image_padded, psf, mode='same')
+################################################################################
+@profutils.timed()
+def convolve_psf(image, psf, 
+	padFactor=1,			# Unused: the image is implicitly zero-padded
+	method='auto',			# 'auto', 'direct', 'fft' or 'oa' (see fftwconvolve.convolve())
+	plotit=False):
+	"""
+		 Convolve an input PSF with an input image. 
 
-	image_conv_cropped = image_conv[pad_ud : height + pad_ud, pad_lr : width + pad_lr]		
+		 The image is treated as if it were surrounded by zeros, i.e. light 
+		 falling outside the image is lost. By default the fastest method 
+		 (direct convolution, a single FFT or overlap-add for small kernels on 
+		 large images) is chosen using fftwconvolve.choose_conv_method().
+	"""
+	image_conv = fftwconvolve.convolve(image, psf, mode='same', method=method)
 
 	if plotit:
-		mu.newfigure(2,2)
+		mu.newfigure(1,3)
 		plt.suptitle('Seeing-limiting image')
-		plt.subplot(2,2,1)
+		plt.subplot(1,3,1)
 		plt.imshow(image)
 		mu.colorbar()
 		plt.title('Input image')
-		plt.subplot(2,2,2)
+		plt.subplot(1,3,2)
 		plt.imshow(psf)
 		mu.colorbar()
 		plt.title('Kernel')
-		plt.subplot(2,2,3)
+		plt.subplot(1,3,3)
 		plt.imshow(image_conv)
 		mu.colorbar()
-		plt.title('Convolved image (padded)')
-		plt.subplot(2,2,4)
-		plt.imshow(image_conv_cropped)
-		mu.colorbar()
-		plt.title('Convolved image (original size)')
+		plt.title('Convolved image')
 		mu.show_plot()
 
-	return image_conv_cropped
+	return image_conv
+
+################################################################################
+@profutils.timed()
+def convolve_psf_grid(image, psfs,
+	N_threads = None):		# Number of threads (default: number of CPUs)
+	"""
+		Convolve an input image with a field-dependent PSF. 
+
+		psfs has shape (N_y, N_x, psf_height, psf_width) and gives the PSF at 
+		each node of an N_y x N_x grid spanning the image, with nodes at the 
+		corners (and evenly spaced between them). The PSF at any other 
+		position is the bilinear interpolation of the PSFs at the 
+		surrounding nodes.
+
+		This is implemented by splitting the image into overlapping tiles 
+		weighted by bilinear (tent-shaped) weights, which sum to one at every 
+		pixel: the tile of each node covers the grid cells around it and is 
+		convolved with that node's PSF, and the convolved tiles are added 
+		together. Each tile is convolved (in 'full' mode, so that no light is 
+		lost at the edges of the tile) only over its own support, and the 
+		tiles are convolved in parallel using a pool of N_threads threads. 
+		With a single node this is equivalent to convolve_psf().
+	"""
+	height, width = image.shape
+	N_y, N_x = psfs.shape[0:2]
+	psf_height, psf_width = psfs.shape[2:4]
+	nodes_y = np.linspace(0, height - 1, N_y) if N_y > 1 else np.array([0.])
+	nodes_x = np.linspace(0, width - 1, N_x) if N_x > 1 else np.array([0.])
+	weights_y = [_tent_weights(nodes_y, i, height) for i in range(N_y)]
+	weights_x = [_tent_weights(nodes_x, j, width) for j in range(N_x)]
+
+	def _convolve_tile(idxs):
+		i, j = idxs
+		(y_start, y_stop), w_y = weights_y[i]
+		(x_start, x_stop), w_x = weights_x[j]
+		tile = image[y_start:y_stop, x_start:x_stop] * w_y[:, np.newaxis] * w_x[np.newaxis, :]
+		return fftwconvolve.convolve(tile, psfs[i, j], mode='full')
+
+	tiles = [(i, j) for i in range(N_y) for j in range(N_x)]
+	pool = ThreadPool(N_threads)
+	tiles_conv = pool.map(_convolve_tile, tiles)
+	pool.close()
+	pool.join()
+
+	# Add the convolved tiles, each offset by the centre of its PSF (as in 
+	# 'same' mode) and cropped to the image.
+	image_conv = np.zeros((height, width))
+	for (i, j), tile_conv in zip(tiles, tiles_conv):
+		y_0 = weights_y[i][0][0] - (psf_height - 1) // 2
+		x_0 = weights_x[j][0][0] - (psf_width - 1) // 2
+		y_min, x_min = max(y_0, 0), max(x_0, 0)
+		y_max, x_max = min(y_0 + tile_conv.shape[0], height), min(x_0 + tile_conv.shape[1], width)
+		image_conv[y_min:y_max, x_min:x_max] += tile_conv[y_min - y_0:y_max - y_0, x_min - x_0:x_max - x_0]
+
+	return image_conv
+
+################################################################################
+def _tent_weights(nodes, i, N):
+	"""
+		Returns the extent (start, stop) and values of the bilinear 
+		interpolation weight of node i (at position nodes[i]) along an axis 
+		of length N. The weights of all nodes sum to one at every pixel.
+	"""
+	if len(nodes) == 1:
+		return (0, N), np.ones(N)
+	lo = nodes[i - 1] if i > 0 else nodes[0]
+	hi = nodes[i + 1] if i < len(nodes) - 1 else nodes[-1]
+	start = int(np.floor(lo)) if i > 0 else 0
+	stop = int(np.ceil(hi)) + 1 if i < len(nodes) - 1 else N
+	x = np.arange(start, stop, dtype=np.float64)
+	w = np.ones(x.shape)
+	if i > 0:
+		rising = x < nodes[i]
+		w[rising] = (x[rising] - lo) / (nodes[i] - lo)
+	if i < len(nodes) - 1:
+		falling = x > nodes[i]
+		w[falling] = (hi - x[falling]) / (hi - nodes[i])
+	return (start, stop), np.clip(w, 0, 1)
 
 ################################################################################
+@profutils.timed()
 def noise_frames_from_etc(N, height_px, width_px, 
 	gain=1,
 	band=None,
 	t_exp=None,
-	etc_input=None):
+	etc_input=None,
+	optical_system=None,
+	rng=None,			# Random number generator, or a rngutils.FrameStreams instance to use a separate stream for each frame
+	first_frame=0):		# Index of the first frame (used to select the stream of each frame)
 	""" 
 	Generate a series of N noise frames with dimensions (height_px, width_px) based on the output of exposure_time_calc() (in etc.py). 
 
@@ -208,6 +506,7 @@ def noise_frames_from_etc(N, height_px, width_px,
 
 	"""
 	print ("Generating noise frames...")
+	memutils.check_memory(memutils.noise_frames_from_etc_bytes(N, height_px, width_px), "noise_frames_from_etc() with {:d} {:d} x {:d} frames".format(N, height_px, width_px))
 
 	# The output is stored in a dictionary with each entry containing the noise frames.
 	noise_frames_dict = {
@@ -220,6 +519,7 @@ def noise_frames_from_etc(N, height_px, width_px,
 		'unity gain' : np.zeros((N, height_px, width_px), dtype=int),
 		'post-gain' : np.zeros((N, height_px, width_px), dtype=int)
 	}
+	profutils.count_bytes(*noise_frames_dict.values())
 
 	# Getting noise parameters from the ETC.
 	if not etc_input:
@@ -239,10 +539,23 @@ def noise_frames_from_etc(N, height_px, width_px,
 		etc_output = etc_input
 
 	# Adding noise to each image and multiplying by the detector gain where appropriate.
-	noise_frames_dict['sky'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_sky'], N_frames = N) * gain
-	noise_frames_dict['dark'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_dark'], N_frames = N) * gain
-	noise_frames_dict['cryo'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_cryo'], N_frames = N) * gain
-	noise_frames_dict['RN'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_RN'], N_frames = N)
+	if isinstance(rng, rngutils.FrameStreams):
+		# Every component of a frame is drawn from that frame's stream.
+		rngs = rng.frames(first_frame, first_frame + N)
+		for k in range(N):
+			noise_frames_dict['sky'][k] = rngs[k].poisson(lam=etc_output['unity gain']['N_sky'], size=(height_px, width_px))
+			noise_frames_dict['dark'][k] = rngs[k].poisson(lam=etc_output['unity gain']['N_dark'], size=(height_px, width_px))
+			noise_frames_dict['cryo'][k] = rngs[k].poisson(lam=etc_output['unity gain']['N_cryo'], size=(height_px, width_px))
+			noise_frames_dict['RN'][k] = rngs[k].poisson(lam=etc_output['unity gain']['N_RN'], size=(height_px, width_px))
+		noise_frames_dict['sky'] = noise_frames_dict['sky'] * gain
+		noise_frames_dict['dark'] = noise_frames_dict['dark'] * gain
+		noise_frames_dict['cryo'] = noise_frames_dict['cryo'] * gain
+	else:
+		# Each component is drawn for every frame at once.
+		noise_frames_dict['sky'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_sky'], N_frames = N, rng = rng) * gain
+		noise_frames_dict['dark'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_dark'], N_frames = N, rng = rng) * gain
+		noise_frames_dict['cryo'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_cryo'], N_frames = N, rng = rng) * gain
+		noise_frames_dict['RN'] = noise_frames(height_px, width_px, etc_output['unity gain']['N_RN'], N_frames = N, rng = rng)
 	
 	noise_frames_dict['total'] = noise_frames_dict['sky'] + noise_frames_dict['cryo'] + noise_frames_dict['RN'] + noise_frames_dict['dark']
 	noise_frames_dict['gain-multiplied'] = noise_frames_dict['sky'] + noise_frames_dict['cryo'] + noise_frames_dict['dark']
@@ -251,16 +564,103 @@ def noise_frames_from_etc(N, height_px, width_px,
 
 	return noise_frames_dict, etc_output
 
+################################################################################
+@profutils.timed()
+def detector_frames(im, detector,
+	t_exp = None,		# Exposure time (s); by default, 1 / detector.fps
+	rng = None,			# Random number generator, or a rngutils.FrameStreams instance to use a separate stream for each frame
+	first_frame = 0):	# Index of the first frame (used to select the stream of each frame)
+	"""
+		Simulate the readout of an image, or a stack of images with shape 
+		(N, height, width), by a Detector instance. im is the expected 
+		photoelectron count rate in each pixel (electrons/s, i.e. after 
+		multiplying by the QE). Returns the frames in ADU.
+
+		In each pixel, the number of electrons generated by the signal, the 
+		dark current and clock-induced charge (CIC) is drawn from a Poisson 
+		distribution. These are multiplied by the internal gain, which is 
+		stochastic if detector.excess_noise_factor F > 1: n input electrons 
+		give a Gamma-distributed output with mean n * gain and variance 
+		n * gain**2 * (F**2 - 1) (for an EMCCD at high gain, F**2 = 2). 
+		Read noise (detector.RN electrons rms) is then added, the result 
+		is converted to ADU (detector.adu_gain electrons per ADU), rounded 
+		down to an integer and clipped to the range [0, detector.saturation]. 
+		
+		Each stage is a single vectorised operation over the whole stack 
+		unless rng is a FrameStreams instance, in which case each frame is 
+		read out separately using its own stream, so only the temporary 
+		arrays of one frame are held in memory at a time. The vectorised 
+		path is never split into chunks because the order in which the 
+		random numbers are drawn (and hence the output for a given seed) 
+		would then depend on the memory budget: to read out a stack too 
+		large for the memory budget, use a FrameStreams instance.
+	"""
+	if t_exp is None:
+		t_exp = 1 / detector.fps
+	im = np.asarray(im, dtype=np.float64)
+	if im.ndim == 3 and not isinstance(rng, rngutils.FrameStreams):
+		N, height, width = im.shape
+		memutils.check_memory(memutils.detector_frames_bytes(N, height, width), 
+			"detector_frames() with {:d} {:d} x {:d} frames (use a rngutils.FrameStreams instance to read them out one at a time)".format(N, height, width))
+	if isinstance(rng, rngutils.FrameStreams) and im.ndim == 3:
+		frames = np.zeros(im.shape)
+		for k in range(im.shape[0]):
+			frames[k] = _detector_readout(im[k], detector, t_exp, rng.frame(first_frame + k))
+		return frames
+	elif isinstance(rng, rngutils.FrameStreams):
+		rng = rng.frame(first_frame)
+	return _detector_readout(im, detector, t_exp, rngutils.get_rng(rng))
+
+################################################################################
+@profutils.timed()
+def _detector_readout(im, detector, t_exp, rng):
+	""" A private method used by detector_frames() to read out a stack of frames using a single random number generator. """
+	# Photoelectrons, dark current and CIC (electrons).
+	lam = np.clip(im * t_exp, 0, None) + detector.dark_current * t_exp + detector.cic
+	frames = rng.poisson(lam=lam).astype(np.float64)
+
+	# Internal (avalanche) gain.
+	F2_minus_1 = detector.excess_noise_factor**2 - 1
+	if F2_minus_1 > 0:
+		electrons = frames > 0
+		frames[electrons] = rng.gamma(shape=frames[electrons] / F2_minus_1, scale=detector.gain * F2_minus_1)
+	else:
+		frames *= detector.gain
+
+	# Read noise.
+	if detector.RN > 0:
+		frames += rng.normal(loc=0, scale=detector.RN, size=frames.shape)
+
+	# Conversion to ADU and saturation.
+	frames /= detector.adu_gain
+	np.floor(frames, out=frames)
+	np.clip(frames, 0, detector.saturation, out=frames)
+
+	return frames
+
 ################################################################################
 def noise_frames(height_px, width_px, lam,
-	N_frames = 1):
+	N_frames = 1,
+	rng = None,			# Random number generator, or a rngutils.FrameStreams instance to use a separate stream for each frame
+	first_frame = 0):	# Index of the first frame (used to select the stream of each frame)
 	""" Generate an array of integers drawn from a Poisson distribution with an expected value lam in each entry. """
+	if not isinstance(rng, rngutils.FrameStreams):
+		# A single vectorised draw.
+		rng = rngutils.get_rng(rng)
+		if N_frames == 1:
+			return rng.poisson(lam=lam, 
+				size=(height_px, width_px)).astype(int)
+		else:
+			return rng.poisson(lam=lam, 
+				size=(N_frames, height_px, width_px)).astype(int)
+
+	frames = np.zeros((N_frames, height_px, width_px), dtype=int)
+	for k, frame_rng in enumerate(rng.frames(first_frame, first_frame + N_frames)):
+		frames[k] = frame_rng.poisson(lam=lam, size=(height_px, width_px))
 	if N_frames == 1:
-		return np.random.poisson(lam=lam, 
-			size=(height_px, width_px)).astype(int)
+		return frames[0]
 	else:
-		return np.random.poisson(lam=lam, 
-			size=(N_frames, height_px, width_px)).astype(int)
+		return frames
 
 ################################################################################
 def dark_sky_master_frames(N, height_px, width_px,
@@ -294,6 +694,7 @@ def median_combine(images):
 	return np.median(images, axis=0)
 
 ################################################################################
+@profutils.timed()
 def airy_disc(wavelength_m, f_ratio, l_px_m, 
 	detector_size_px=None,
 	trapz_oversampling=8,	# Oversampling used in the trapezoidal rule approximation.
@@ -377,6 +778,167 @@ def airy_disc(wavelength_m, f_ratio, l_px_m,
 
 	return count_cumtrapz, I, P_0, P_sum, I_0
 
+################################################################################
+# OTFs returned by airy_otf(), keyed by the optical parameters, the grid and
+# the offset. At most AIRY_OTF_CACHE_SIZE OTFs are kept; the least recently 
+# used are discarded.
+AIRY_OTF_CACHE_SIZE = 32
+_airy_otf_cache = OrderedDict()
+
+@profutils.timed()
+def airy_otf(wavelength_m, f_ratio, l_px_m, shape,
+	obstruction=0,		# Ratio of the diameter of the central obstruction to that of the aperture
+	offset_px=(0, 0)):	# Position of the centre of the PSF (in pixels)
+	"""
+		Returns the optical transfer function (OTF) of an optical system with 
+		an annular aperture, sampled by square pixels of width l_px_m, on the 
+		frequency grid of np.fft.rfft2 applied to an image of the given shape. 
+
+		The OTF of the aperture is computed analytically from the areas of 
+		overlap of the annular pupil with a shifted copy of itself, and is 
+		multiplied by the MTF of the pixels (which is equivalent to exactly 
+		integrating the PSF over each pixel). If the PSF is undersampled, the 
+		aliased components are included. The inverse FFT of the OTF is the 
+		pixelated PSF centred on pixel offset_px (by default, the centre of 
+		pixel (0, 0)), normalised to unit sum. Sub-pixel offsets are applied 
+		to each alias separately, so they are exact even if the PSF is 
+		undersampled.
+
+		The AIRY_OTF_CACHE_SIZE most recently used OTFs are cached, so 
+		repeated calls with the same arguments return the same (read-only) 
+		array. Offsets are rounded to 1e-6 pixels.
+	"""
+	shape = tuple(int(x) for x in shape[-2:])
+	offset_px = tuple(round(float(x), 6) for x in offset_px)
+	key = (wavelength_m, f_ratio, l_px_m, obstruction, shape, offset_px)
+	if key in _airy_otf_cache:
+		otf = _airy_otf_cache.pop(key)
+		_airy_otf_cache[key] = otf		# Mark as the most recently used
+		return otf
+
+	# Spatial frequencies (cycles per metre in the focal plane).
+	height, width = shape
+	f_y = np.fft.fftfreq(height, d=l_px_m)[:, np.newaxis]
+	f_x = np.fft.rfftfreq(width, d=l_px_m)[np.newaxis, :]
+	f_cutoff = 1 / wavelength_m / f_ratio
+	f_sampling = 1 / l_px_m
+
+	# Sum the OTF over all aliases that fall within the cutoff frequency.
+	N_aliases = int(np.ceil(f_cutoff / f_sampling + 0.5))
+	shifted = offset_px != (0, 0)
+	otf = np.zeros((height, width // 2 + 1), dtype=complex if shifted else np.float64)
+	for m in range(-N_aliases, N_aliases + 1):
+		for n in range(-N_aliases, N_aliases + 1):
+			f_y_alias = f_y + m * f_sampling
+			f_x_alias = f_x + n * f_sampling
+			nu = np.sqrt(f_y_alias**2 + f_x_alias**2) / f_cutoff
+			if np.min(nu) >= 1:
+				continue
+			otf_alias = _annular_otf(nu, obstruction) * np.sinc(f_y_alias * l_px_m) * np.sinc(f_x_alias * l_px_m)
+			if shifted:
+				otf_alias = otf_alias * np.exp(-2j * np.pi * l_px_m * (f_y_alias * offset_px[0] + f_x_alias * offset_px[1]))
+			otf += otf_alias
+
+	otf.setflags(write=False)
+	_airy_otf_cache[key] = otf
+	while len(_airy_otf_cache) > AIRY_OTF_CACHE_SIZE:
+		_airy_otf_cache.popitem(last=False)
+	return otf
+
+################################################################################
+def _annular_otf(nu, obstruction):
+	""" 
+		Returns the OTF of an annular aperture with central obstruction ratio 
+		obstruction at normalised spatial frequencies nu = f / f_cutoff. 
+	"""
+	# The OTF is the area of overlap of the pupil (with unit outer radius) and
+	# a copy of itself shifted by d = 2 * nu, normalised by the pupil area.
+	d = 2 * np.asarray(nu, dtype=np.float64)
+	eps = obstruction
+	area = _circle_overlap_area(1, 1, d)
+	if eps > 0:
+		area += _circle_overlap_area(eps, eps, d) - 2 * _circle_overlap_area(1, eps, d)
+	return area / (np.pi * (1 - eps**2))
+
+################################################################################
+def _circle_overlap_area(r1, r2, d):
+	""" Returns the area of overlap of two circles with radii r1 and r2 whose centres are separated by d. """
+	area = np.zeros(d.shape)
+	r_min = min(r1, r2)
+	inside = d <= np.abs(r1 - r2)
+	area[inside] = np.pi * r_min**2
+	partial = np.logical_and(~inside, d < r1 + r2)
+	dp = d[partial]
+	area[partial] = r1**2 * np.arccos(np.clip((dp**2 + r1**2 - r2**2) / (2 * dp * r1), -1, 1)) + \
+		r2**2 * np.arccos(np.clip((dp**2 + r2**2 - r1**2) / (2 * dp * r2), -1, 1)) - \
+		0.5 * np.sqrt(np.maximum((-dp + r1 + r2) * (dp + r1 - r2) * (dp - r1 + r2) * (dp + r1 + r2), 0))
+	return area
+
+################################################################################
+def telescope_obstruction(telescope):
+	""" Returns the ratio of the diameter of the central obstruction of a Telescope instance to that of its primary mirror. """
+	if not telescope.mirrors:
+		return 0
+	M1 = telescope.mirrors[0]
+	return M1.R_inner_m / M1.R_outer_m
+
+################################################################################
+def airy_disc_otf(wavelength_m, f_ratio, l_px_m, detector_size_px,
+	obstruction=0,	# Ratio of the diameter of the central obstruction to that of the aperture
+	coords=None,
+	P_0=1):
+	"""
+		Returns the PSF of an optical system with an annular aperture given 
+		the f ratio, pixel and detector size at a given wavelength_m, computed 
+		as the inverse FFT of its OTF (see airy_otf()). The pixel values are 
+		exact integrals of the PSF over each pixel, and the PSF is normalised 
+		such that the pixel values of the PSF extended to infinity sum to 
+		P_0. The OTF is sampled on a grid twice the size of the detector so 
+		that the wings of the PSF beyond the edge of the detector are 
+		discarded rather than wrapping around to the opposite edge.
+
+		As in airy_disc(), an offset (measured from the top left corner of the 
+		detector) can be specified in vector coords = (x, y); by default, the 
+		PSF is centred on the detector.
+	"""
+	height, width = detector_size_px[0:2]
+	# coords are measured from the top left corner of the detector, so pixel
+	# centres are at half-integer positions.
+	if coords is None:
+		coords = (height / 2, width / 2)
+	# The detector occupies the top left corner of the padded grid.
+	padded_shape = (fftwconvolve._next_regular(2 * height), fftwconvolve._next_regular(2 * width))
+	otf = airy_otf(wavelength_m, f_ratio, l_px_m, padded_shape, 
+		obstruction=obstruction, 
+		offset_px=(coords[0] - 0.5, coords[1] - 0.5))
+
+	return P_0 * np.fft.irfft2(otf, s=padded_shape)[:height, :width]
+
+################################################################################
+@profutils.timed()
+def convolve_otf(image, wavelength_m, f_ratio, l_px_m,
+	obstruction=0):	# Ratio of the diameter of the central obstruction to that of the aperture
+	"""
+		Convolve an input image, or a stack of images with shape (N, height, 
+		width), with the PSF of an optical system with an annular aperture, 
+		by multiplying its FFT by the (cached) OTF from airy_otf(). 
+
+		The images are zero-padded to twice their size before convolving, 
+		so that the output has the same size as the input, as in 
+		convolve_psf().
+	"""
+	image = np.asarray(image)
+	height, width = image.shape[-2:]
+	conv_shape = (fftwconvolve._next_regular(2 * height), fftwconvolve._next_regular(2 * width))
+	otf = airy_otf(wavelength_m, f_ratio, l_px_m, conv_shape, obstruction=obstruction)
+
+	# The PSF is centred on pixel (0, 0), so the convolved image occupies
+	# the same pixels as the input image.
+	image_fft = np.fft.rfft2(image, s=conv_shape)
+	image_conv = np.fft.irfft2(image_fft * otf, s=conv_shape)
+
+	return image_conv[..., :height, :width]
+
 ################################################################################
 def psf_airy_disk_kernel(wavelength_m, 
 	l_px_m=None, 
@@ -385,10 +947,15 @@ def psf_airy_disk_kernel(wavelength_m,
 	T_OS=8,
 	detector_size_px=None,
 	trunc_sigma=10.25,	# 10.25 corresponds to the 10th Airy ring		
+	telescope=None,		# If given, the central obstruction is that of the telescope's primary mirror (see telescope_obstruction())
+	obstruction=None,	# Ratio of the diameter of the central obstruction to that of the aperture (method 'otf' only); overrides telescope
+	method='auto',		# 'otf' (see airy_disc_otf()), 'trapz' (see airy_disc()) or 'auto'
 	plotit=False):
 	"""
 		Returns an Airy disc PSF corresponding to an optical system with a given f ratio, pixel size and detector size at a specified wavelength_m.
 
+		The 'trapz' method only supports a clear circular aperture, so by default ('auto') it is used unless there is a central obstruction, in which case the 'otf' method is used. Either way, the PSF is normalised to unit sum.
+
 		If the detector size is not specified, then the PSF is truncated at a radius of 8 * sigma, where sigma corresponds to the HWHM (to speed up convolutions made using this kernel)
 
 		There are 3 ways to constrain the plate scale of the output PSF. One of either the f ratio, the pixel width or the Nyquist sampling factor (where a larger number ==> finer sampling) must be left unspecified, and will be constrained by the other two parameters.
@@ -407,16 +974,36 @@ def psf_airy_disk_kernel(wavelength_m,
 		psf_size = int(np.round(trunc_sigma * N_OS * 4))
 		detector_size_px = (psf_size,psf_size)	
 
+	if obstruction is None:
+		obstruction = telescope_obstruction(telescope) if telescope is not None else 0
+	if method == 'auto':
+		method = 'otf' if obstruction > 0 else 'trapz'
+	elif method == 'trapz' and obstruction > 0:
+		print("WARNING: the 'trapz' method ignores the central obstruction!")
+
 	# In the inputs to this function, do we need to specify the oversampling factor AND the f ratio and/or pixel widths?
+	if method == 'otf':
+		kernel = airy_disc_otf(wavelength_m=wavelength_m, f_ratio=f_ratio, l_px_m=l_px_m, detector_size_px=detector_size_px, obstruction=obstruction)
+		kernel /= np.sum(kernel)
+		if plotit:
+			mu.newfigure(1,1)
+			plt.imshow(kernel, norm=LogNorm())
+			mu.colorbar()
+			plt.title('Airy disc PSF')
+			mu.show_plot()
+		return kernel
+
 	kernel = airy_disc(wavelength_m=wavelength_m, f_ratio=f_ratio, l_px_m=l_px_m, detector_size_px=detector_size_px, trapz_oversampling=T_OS, plotit=plotit)[0]	
 
 	return kernel
 
 ###################################################################################
+@profutils.timed()
 def get_diffraction_limited_image(image_truth, l_px_m, f_ratio, wavelength_m, 
 	f_ratio_in=None, wavelength_in_m=None, # f-ratio and imaging wavelength of the input image (if it has N_os > 1)
 	N_OS_psf=4,
 	detector_size_px=None,
+	telescope=None,		# If given, the PSF includes the central obstruction of the telescope (see psf_airy_disk_kernel())
 	plotit=False):
 	""" Convolve the PSF of a given telescope at a given wavelength with image_truth to simulate diffraction-limited imaging. 
 	It is assumed that the truth image has the appropriate plate scale of, but may be larger than, the detector. 
@@ -456,23 +1043,17 @@ def get_diffraction_limited_image(image_truth, l_px_m, f_ratio, wavelength_m,
 	N_OS_input = wavelength_m * f_ratio / 2 / l_px_m / (np.deg2rad(206265 / 3600))
 
 	# Calculating the PSF
-	psf = psf_airy_disk_kernel(wavelength_m=wavelength_m, N_OS=N_OS_psf, l_px_m=l_px_m)
+	psf = psf_airy_disk_kernel(wavelength_m=wavelength_m, N_OS=N_OS_psf, l_px_m=l_px_m, telescope=telescope)
 	# TODO need to check that the PSF is not larger than image_truth_large
 
-	# Convolving the PSF and the truth image to obtain the simulated diffraction-limited image
-	# image_difflim = np.ndarray((N, height, width))
+	# Resample the images up to the plate scale of the PSF.
+	image_truth_large = imutils.fourier_resize(image_truth, scale_factor = N_OS_input / N_OS_psf)
+	# Convolving the PSF and the truth images to obtain the simulated diffraction-limited images
+	image_difflim_large = np.zeros(image_truth_large.shape)
 	for k in range(N):
-		# Resample the image up to the appropriate plate scale.
-		image_truth_large = resizeImagesToDetector(image_truth[k], 1/N_OS_input, 1/N_OS_psf)
-		# Convolve with the PSF.
-		image_difflim_large = fftwconvolve.fftconvolve(image_truth_large, psf, mode='same')
-		# Resize the image to its original plate scale.
-		if k == 0:
-			im = resizeImagesToDetector(image_difflim_large, 1/N_OS_psf, 1/N_OS_input)
-			image_difflim = np.ndarray((N, im.shape[0], im.shape[1]))
-			image_difflim[0] = im
-		else:
-			image_difflim[k] = resizeImagesToDetector(image_difflim_large, 1/N_OS_psf, 1/N_OS_input)
+		image_difflim_large[k] = fftwconvolve.fftconvolve(image_truth_large[k], psf, mode='same')
+	# Resize the images to their original plate scale.
+	image_difflim = imutils.fourier_resize(image_difflim_large, scale_factor = N_OS_psf / N_OS_input)
 
 
 	if plotit:
@@ -495,67 +1076,35 @@ def get_diffraction_limited_image(image_truth, l_px_m, f_ratio, wavelength_m,
 	return np.squeeze(image_difflim)
 
 ################################################################################
+@profutils.timed()
 def get_seeing_limited_image(images, seeing_diameter_as, 
 	plate_scale_as=1,
-	padFactor=1,
+	padFactor=1,		# Unused: pixels outside the image are always treated as zero
 	plotit=False):
 	"""
 		 Convolve a Gaussian PSF with an input image to simulate seeing with a FWHM of seeing_diameter_as. 
 	"""
-	print("Seeing-limiting image(s)",end="")
+	print("Seeing-limiting image(s)...")
 
-	images, N, height, width = get_image_size(images)
+	images, N, height, width = imutils.get_image_size(images)
 
-	# Padding the source image.
-	pad_ud = height // padFactor // 2
-	pad_lr = width // padFactor // 2
-	
-	# If the image dimensions are odd, need to ad an extra row/column of zeros.
-	image_padded = np.pad(images[0], ((pad_ud,pad_ud + height % 2),(pad_lr,pad_lr + width % 2)), mode='constant')
-	# conv_height = image_padded.shape[0]
-	# conv_width = image_padded.shape[1]
-	conv_height = 2 * pad_ud + height + (height % 2)
-	conv_width = 2 * pad_lr + width + (width % 2)
-
-	# Generate a Gaussian kernel.
-	kernel = np.zeros((conv_height, conv_width))
-	y_as = np.arange(-conv_width//2, +conv_width//2 + conv_width%2, 1) * plate_scale_as
-	x_as = np.arange(-conv_height//2, +conv_height//2 + conv_height%2, 1) * plate_scale_as
-	X, Y = np.meshgrid(x_as, y_as)
-	sigma = seeing_diameter_as / (2 * np.sqrt(2 * np.log(2)))
-	kernel = np.exp(-(np.power(X, 2) + np.power(Y, 2)) / (2 * np.power(sigma,2)))
-	kernel /= sum(kernel.flatten())
-	kernel = np.pad(kernel, ((pad_ud, pad_ud + height % 2), (pad_lr, pad_lr + width % 2)), mode='constant')
-
-	# Convolving the kernel with the image.
-	image_seeing_limited = np.ndarray((N, conv_height, conv_width))
-	image_seeing_limited_cropped = np.ndarray((N, height, width))
-
-	for k in range(N):
-		print('.',end="")
-		image_padded = np.pad(images[k], ((pad_ud,pad_ud + height % 2),(pad_lr,pad_lr + width % 2)), mode='constant')
-		image_seeing_limited[k] = fftwconvolve.fftconvolve(image_padded, kernel, mode='same')
-		image_seeing_limited_cropped[k] = image_seeing_limited[k,pad_ud : height + pad_ud, pad_lr : width + pad_lr]		
+	# Convolving a Gaussian kernel with the images. Pixels outside the images
+	# are assumed to be zero.
+	sigma_as = seeing_diameter_as / (2 * np.sqrt(2 * np.log(2)))
+	sigma_px = sigma_as / plate_scale_as
+	image_seeing_limited_cropped = imutils.gaussian_blur(images, sigma_px)
 
 	if plotit:
-		mu.newfigure(2,2)
+		mu.newfigure(1,2)
 		plt.suptitle('Seeing-limiting image')
-		plt.subplot(2,2,1)
+		plt.subplot(1,2,1)
 		plt.imshow(images[0])
 		mu.colorbar()
 		plt.title('Input image')
-		plt.subplot(2,2,2)
-		plt.imshow(kernel, extent=axes_kernel)
-		mu.colorbar()
-		plt.title('Kernel')
-		plt.subplot(2,2,3)
-		plt.imshow(image_seeing_limited[0])
-		mu.colorbar()
-		plt.title('Convolved image')
-		plt.subplot(2,2,4)
+		plt.subplot(1,2,2)
 		plt.imshow(image_seeing_limited_cropped[0])
 		mu.colorbar()
-		plt.title('Cropped, convolved image')
+		plt.title('Convolved image')
 		mu.show_plot()
 
 	return np.squeeze(image_seeing_limited_cropped)
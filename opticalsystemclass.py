@@ -29,9 +29,15 @@
 ################################################################################
 from __future__ import division, print_function
 import numpy as np
+from configclass import Config
 
 ################################################################################
-class OpticalSystem(object):
+class OpticalSystem(Config):
+
+	__slots__ = ['telescope', 'detector', 'cryostat', 'sky', 
+		'plate_scale_as_px', 'plate_scale_rad_px', 
+		'FoV_height_as', 'FoV_width_as', 'FoV_height_rad', 'FoV_width_rad', 'FoV_diag_as', 'FoV_diag_rad', 
+		'omega_px_as2', 'omega_px_sr', 'etendue']
 
 	def __init__(self, telescope, detector, sky,
 		plate_scale_as_px=None,
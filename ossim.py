@@ -38,8 +38,10 @@ from opticalsystemclass import OpticalSystem
 from skyclass import Sky
 from galaxyclass import Galaxy
 import ipdb
+import os
 
 import etc
+from cacheutils import param_hash, cached_array
 
 ################################################################################
 def aoiOpticalSystem():
@@ -86,7 +88,8 @@ def nuvuDetector():
 		saturation = 2**16 - 1,			# ? detector saturation limit
 		adu_gain = 1/2.9,				# electrons per ADU at readout
 		qe = 0.9,						# quantum efficiency
-		fps = 60						# framerate
+		fps = 60,						# framerate
+		excess_noise_factor = np.sqrt(2)	# EM gain register in the high-gain limit
 		)
 
 ################################################################################
@@ -104,11 +107,12 @@ def msoSky():
 
 ################################################################################
 def aoiAoSystem(wave_height_px,
-	compute_response_matrix = True,
-	compute_reconstructor = True,
+	compute_response_matrix = False,	# Recompute the response matrix even if it is in the cache
+	compute_reconstructor = False,		# Recompute the reconstructor even if it is in the cache
 	wavelength_wfs_m = 589e-9,
 	wavelength_science_m = 800e-9,
-	rng_seed = 1
+	rng_seed = 1,
+	cache_dir = 'ao_calibration'		# Directory in which the response and reconstructor matrices are cached
 	):
 	try:
 		from aosim.pyxao import wavefront, deformable_mirror, wfs, ao_system, atmosphere, seeing_limited_system
@@ -118,6 +122,12 @@ def aoiAoSystem(wave_height_px,
 
 	"""
 		Make an AO system instance for AOI.
+
+		The response and reconstructor matrices are cached in cache_dir 
+		under file names containing a hash of the pupil, DM, WFS and 
+		wavelength configuration, so that a cached matrix is only used with 
+		the configuration it was computed for. Cached matrices are 
+		memory-mapped when they are loaded.
 	"""
 	wavefrontPupil = {	
 		'type':'annulus',
@@ -165,23 +175,25 @@ def aoiAoSystem(wave_height_px,
 
 	dm = deformable_mirror.DeformableMirror(
 		wavefronts = wavefronts_dm, 
-		influence_function = 'gaussian', 
+		influence_function = influence_fun, 
 		central_actuator = central_actuator, 
 		actuator_pitch = actuator_pitch_m, 
 		geometry = dm_geometry, 
-		edge_radius = 1.4)
+		edge_radius = edge_radius)
 
 	# Shack-Hartmann wavefront sensor.
 	# We want 1600 photons/cm^2/s on the detector.
 	# We need to put the total number of electrons that will fall on the detector into this function.
 	# So, N_phot = (1600 * 1e4) * 1/ho_loop_rate * QE * EMCCD gain.
+	sh_wfs_N_phot = 1600 * 1e4 * 1/ho_loop_rate * 0.90 * 1000 * 1.752**2/4
+	sh_wfs_sampling = 1
 	sh_wfs = wfs.ShackHartmann(
 		wavefronts = wavefronts_wfs, 
 		lenslet_pitch = lenslet_pitch_m, 
 		geometry = wfs_geometry, 
 		central_lenslet = central_lenslet, 	
-		N_phot = 1600 * 1e4 * 1/ho_loop_rate * 0.90 * 1000 * 1.752**2/4,	
-		sampling = 1)
+		N_phot = sh_wfs_N_phot,	
+		sampling = sh_wfs_sampling)
 	
 	# The atmosphere is a PHASE SCREEN
 	atm = atmosphere.Atmosphere(sz = 4*wave_height_px, 
@@ -200,26 +212,54 @@ def aoiAoSystem(wave_height_px,
 		atm=atm, 
 		image_ixs=psf_ix)
 
-	# Either a full path can be given, or else the file is assumed to be located in the same directory from which the script calling this method is being called.
-	if not compute_response_matrix:
-		try:
-			aoi_ao_system.response_matrix = np.load("aoi_response_matrix.npy")
-		except:
-			aoi_ao_system.find_response_matrix()
-			np.save("aoi_response_matrix", aoi_ao_system.response_matrix)
-	else:
+	# The calibration depends on the pupil, the DM, the WFS and the 
+	# wavelengths, but not on the atmosphere.
+	calibration_params = {
+		'pupil' : wavefrontPupil,
+		'wave_height_px' : wave_height_px,
+		'm_per_px' : m_per_px,
+		'wavelength_wfs_m' : wavelength_wfs_m,
+		'wavelength_science_m' : wavelength_science_m,
+		'psf_ix' : psf_ix,
+		'dm' : {
+			'N_actuators' : N_actuators,
+			'actuator_pitch_m' : actuator_pitch_m,
+			'geometry' : dm_geometry,
+			'central_actuator' : central_actuator,
+			'edge_radius' : edge_radius,
+			'influence_fun' : influence_fun,
+			'pokeStroke' : pokeStroke
+		},
+		'wfs' : {
+			'N_lenslets' : N_lenslets,
+			'lenslet_pitch_m' : lenslet_pitch_m,
+			'geometry' : wfs_geometry,
+			'central_lenslet' : central_lenslet,
+			'N_phot' : sh_wfs_N_phot,
+			'sampling' : sh_wfs_sampling
+		}
+	}
+	calibration_key = param_hash(calibration_params)
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+
+	def _find_response_matrix():
 		aoi_ao_system.find_response_matrix()
-		np.save("aoi_response_matrix", aoi_ao_system.response_matrix)
-
-	if not compute_reconstructor:
-		try:
-			aoi_ao_system.reconstructor = np.load("aoi_reconstructor_matrix.npy")
-		except:
-			aoi_ao_system.compute_reconstructor()
-			np.save("aoi_reconstructor_matrix", aoi_ao_system.reconstructor)			
-	else:
+		return aoi_ao_system.response_matrix
+
+	def _compute_reconstructor():
 		aoi_ao_system.compute_reconstructor()
-		np.save("aoi_reconstructor_matrix", aoi_ao_system.reconstructor)
+		return aoi_ao_system.reconstructor
+
+	aoi_ao_system.response_matrix = cached_array(
+		fname = os.path.join(cache_dir, 'aoi_response_matrix_{}.npy'.format(calibration_key)), 
+		compute_fun = _find_response_matrix, 
+		recompute = compute_response_matrix)
+	# The reconstructor must be recomputed if the response matrix is.
+	aoi_ao_system.reconstructor = cached_array(
+		fname = os.path.join(cache_dir, 'aoi_reconstructor_matrix_{}.npy'.format(calibration_key)), 
+		compute_fun = _compute_reconstructor, 
+		recompute = compute_reconstructor or compute_response_matrix)
 
 	return aoi_ao_system
 
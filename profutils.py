@@ -0,0 +1,267 @@
+################################################################################
+#
+# 	File:		profutils.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Opt-in instrumentation of the simulation and Lucky Imaging hot paths:
+#	per-stage timers and histograms and counters (e.g. of FFTs executed and
+#	bytes allocated), which can be exported to JSON or to a Chrome trace.
+#
+#	Usage:
+#		profutils.enable()
+#		... run a simulation ...
+#		profutils.print_summary()
+#		profutils.export_chrome_trace('trace.json')	# open in chrome://tracing
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+import json
+import threading
+import functools
+from timeit import default_timer as clock
+
+# Whether instrumentation is enabled. When it is not, the hooks do nothing
+# but check this flag.
+ENABLED = False
+
+# Maximum number of events stored for the Chrome trace. Durations and
+# counters are still accumulated once this is reached.
+MAX_TRACE_EVENTS = 10**6
+
+# Bin edges (s) of the per-stage duration histograms: 4 per decade from 1 us
+# to 1000 s.
+HISTOGRAM_EDGES_S = 10**np.arange(-6, 3.01, 0.25)
+
+_lock = threading.Lock()
+_durations = {}		# Stage name -> list of durations (s)
+_counters = {}		# Counter name -> value
+_events = []		# (stage name, start time (s), duration (s), process id, thread id)
+_t0 = clock()
+
+################################################################################
+def enable():
+	""" Start recording. Anything recorded previously is kept (call reset() to discard it). """
+	global ENABLED
+	ENABLED = True
+
+def disable():
+	""" Stop recording. """
+	global ENABLED
+	ENABLED = False
+
+def reset():
+	""" Discard everything recorded so far. """
+	global _t0
+	with _lock:
+		_durations.clear()
+		_counters.clear()
+		del _events[:]
+		_t0 = clock()
+
+################################################################################
+class _Stage(object):
+	""" Context manager timing a stage. """
+
+	__slots__ = ['name', 'tic']
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.tic = clock()
+		return self
+
+	def __exit__(self, *args):
+		record(self.name, self.tic, clock())
+
+class _NullStage(object):
+	""" Context manager that does nothing, used when instrumentation is disabled. """
+
+	__slots__ = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+_NULL_STAGE = _NullStage()
+
+################################################################################
+def stage(name):
+	"""
+		Return a context manager timing the enclosed block as the stage name,
+		e.g.
+			with profutils.stage('lucky_imaging.stacking'):
+				...
+	"""
+	return _Stage(name) if ENABLED else _NULL_STAGE
+
+################################################################################
+def timed(name = None):
+	"""
+		Decorator timing every call of a function as a stage (named
+		<module>.<function> by default).
+	"""
+	def decorator(fun):
+		stage_name = name if name is not None else '{}.{}'.format(fun.__module__, fun.__name__)
+
+		@functools.wraps(fun)
+		def wrapper(*args, **kwargs):
+			if not ENABLED:
+				return fun(*args, **kwargs)
+			tic = clock()
+			try:
+				return fun(*args, **kwargs)
+			finally:
+				record(stage_name, tic, clock())
+		return wrapper
+	return decorator
+
+################################################################################
+def record(name, tic, toc):
+	""" Record a stage name that started at time tic and finished at time toc (as returned by clock()). """
+	if not ENABLED:
+		return
+	with _lock:
+		if name in _durations:
+			_durations[name].append(toc - tic)
+		else:
+			_durations[name] = [toc - tic]
+		if len(_events) < MAX_TRACE_EVENTS:
+			_events.append((name, tic, toc - tic, os.getpid(), threading.current_thread().ident))
+
+def lap(name, tic):
+	"""
+		Record a stage name that started at time tic and finished now, and
+		return the current time (i.e. the start time of the next stage), e.g.
+			tic = profutils.clock()
+			...
+			tic = profutils.lap('stage 1', tic)
+			...
+			tic = profutils.lap('stage 2', tic)
+	"""
+	toc = clock()
+	record(name, tic, toc)
+	return toc
+
+################################################################################
+def count(name,
+	value = 1):
+	""" Add value to the counter name. """
+	if not ENABLED:
+		return
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + value
+
+def count_bytes(*arrays):
+	""" Count the bytes allocated for the given arrays. """
+	if not ENABLED:
+		return
+	count('bytes allocated', sum(arr.nbytes for arr in arrays))
+
+def count_ffts(
+	N = 1,				# Number of transforms
+	N_samples = 0):		# Total number of samples transformed
+	""" Count FFTs executed. """
+	if not ENABLED:
+		return
+	count('FFTs executed', N)
+	count('FFT samples', N_samples)
+
+################################################################################
+def summary():
+	"""
+		Return a dictionary containing, for each stage, the number of times
+		it was run, its total, mean, median, 90th percentile, minimum and
+		maximum duration (s) and a histogram of its durations (with bin edges
+		HISTOGRAM_EDGES_S), and the value of each counter.
+	"""
+	with _lock:
+		durations = dict((name, np.array(d)) for name, d in _durations.items())
+		counters = dict(_counters)
+	stages = {}
+	for name, d in durations.items():
+		stages[name] = {
+			'N' : len(d),
+			'total' : float(np.sum(d)),
+			'mean' : float(np.mean(d)),
+			'median' : float(np.median(d)),
+			'p90' : float(np.percentile(d, 90)),
+			'min' : float(np.min(d)),
+			'max' : float(np.max(d)),
+			'histogram' : np.histogram(d, bins = HISTOGRAM_EDGES_S)[0].tolist()
+		}
+	return {
+		'stages' : stages,
+		'counters' : counters,
+		'histogram_edges_s' : HISTOGRAM_EDGES_S.tolist()
+	}
+
+################################################################################
+def print_summary():
+	""" Print the time spent in each stage (longest first) and the counters. """
+	s = summary()
+	print("{:<45}{:>8}{:>12}{:>12}{:>12}{:>12}".format('Stage', 'N', 'Total (s)', 'Mean (s)', 'Median (s)', 'p90 (s)'))
+	for name, st in sorted(s['stages'].items(), key = lambda item: -item[1]['total']):
+		print("{:<45}{:>8d}{:>12.5f}{:>12.3e}{:>12.3e}{:>12.3e}".format(name, st['N'], st['total'], st['mean'], st['median'], st['p90']))
+	for name in sorted(s['counters']):
+		print("{:<45}{:>20g}".format(name, s['counters'][name]))
+
+################################################################################
+def export_json(fname):
+	""" Save summary() as a JSON file. """
+	with open(fname, 'w') as f:
+		json.dump(summary(), f, indent = 4, sort_keys = True)
+
+################################################################################
+def export_chrome_trace(fname):
+	"""
+		Save the recorded stages and the final counter values as a Chrome
+		trace (Trace Event Format) JSON file, which can be viewed in
+		chrome://tracing or Perfetto.
+	"""
+	with _lock:
+		events = list(_events)
+		counters = dict(_counters)
+		t_end = max([tic + dt for _, tic, dt, _, _ in events] + [_t0])
+	trace = [{
+		'name' : name,
+		'ph' : 'X',
+		'ts' : (tic - _t0) * 1e6,
+		'dur' : dt * 1e6,
+		'pid' : pid,
+		'tid' : tid
+	} for name, tic, dt, pid, tid in events]
+	trace += [{
+		'name' : name,
+		'ph' : 'C',
+		'ts' : (t_end - _t0) * 1e6,
+		'pid' : os.getpid(),
+		'args' : {name : value}
+	} for name, value in counters.items()]
+	with open(fname, 'w') as f:
+		json.dump({'traceEvents' : trace, 'displayTimeUnit' : 'ms'}, f)
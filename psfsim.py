@@ -0,0 +1,203 @@
+################################################################################
+#
+# 	File:		psfsim.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Generating time series of PSFs (e.g. from AO or seeing-limited systems).
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import os
+import json
+import time
+from multiprocessing import Pool as ProcPool			# no dummy = Processes
+
+from cacheutils import param_hash
+
+################################################################################
+def generate_psf_cubes(psf_fun, N_frames, height_px, width_px,
+	bands = ('J', 'H', 'K'),
+	out_dir = 'psfs',		# Directory in which the PSF cubes are stored
+	rng_seed = 1,
+	same_atmosphere = True,	# Whether the PSFs in every band are generated from the same phase screens
+	dtype = np.float32,
+	N_workers = None,		# Number of worker processes (default: number of CPUs)
+	overwrite_existing = False,
+	timeit = True
+	):
+	"""
+		Generate a time series of N_frames PSFs in each of the given bands 
+		concurrently using a pool of worker processes (one per band).
+
+		psf_fun(band, N_frames, rng_seed) must return an iterable (e.g. a 
+		generator) of N_frames PSFs of size (height_px, width_px), typically 
+		by creating an AO or seeing-limited system (e.g. using 
+		ossim.linguineAoSystem(wave_height_px, rng_seed = rng_seed)) and 
+		propagating the wavefront through its phase screens. Because it is 
+		sent to the worker processes, psf_fun must be picklable, i.e. a 
+		module-level function, a functools.partial of one or an instance of 
+		a module-level class.
+
+		The PSFs are written as they are generated to a memory-mapped .npy 
+		file for each band in out_dir, so the cubes never need to fit in 
+		memory. The cubes can then be read using load_psf_cube(). The 
+		parameters used to generate each cube are stored alongside it (see 
+		load_psf_cube_params()), and an existing cube is only reused if it was 
+		generated with the same psf_fun, N_frames, size, seed and dtype (and 
+		overwrite_existing is False). 
+
+		If same_atmosphere is True, then every band uses the same seed 
+		(rng_seed), so that the PSFs in each band correspond to the same 
+		atmospheric turbulence. Otherwise, an independent seed is derived 
+		from rng_seed for each band. Either way, the output is reproducible.
+
+		Returns a dictionary mapping each band to the file name of its cube.
+	"""
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+
+	seeds = band_seeds(bands, rng_seed, same_atmosphere)
+	tasks = []
+	for band in bands:
+		fname = psf_cube_fname(band, out_dir)
+		tasks.append((psf_fun, band, N_frames, height_px, width_px, seeds[band], fname, dtype, overwrite_existing))
+
+	pool = ProcPool(N_workers)
+	results = pool.map(_psf_cube_worker, tasks, 1)
+	pool.close()
+	pool.join()
+
+	if timeit:
+		for timing in results:
+			print("GENERATING PSFS IN {}-BAND: {} in {:.5f} s ({})".format(timing['band'], 
+				'using existing cube' if timing['skipped'] else '{:d} frames generated'.format(N_frames), 
+				timing['time_s'], timing['fname']))
+
+	return {timing['band'] : timing['fname'] for timing in results}
+
+################################################################################
+def band_seeds(bands, rng_seed, 
+	same_atmosphere = True):
+	""" 
+		Returns a dictionary of the seeds used to generate the PSFs in each 
+		band. If same_atmosphere is False, then statistically independent 
+		seeds are spawned from rng_seed for each band.
+	"""
+	if same_atmosphere:
+		return {band : rng_seed for band in bands}
+	children = np.random.SeedSequence(rng_seed).spawn(len(bands))
+	return {band : int(child.generate_state(1)[0]) for band, child in zip(bands, children)}
+
+################################################################################
+def psf_cube_fname(band, 
+	out_dir = 'psfs'):
+	return os.path.abspath(os.path.join(out_dir, 'psfs_{}.npy'.format(band)))
+
+def psf_cube_params_fname(band, 
+	out_dir = 'psfs'):
+	return os.path.abspath(os.path.join(out_dir, 'psfs_{}.json'.format(band)))
+
+def psf_cube_key(psf_fun, N_frames, height_px, width_px, rng_seed, dtype):
+	""" Returns a hash of the parameters used to generate a cube of PSFs. """
+	return param_hash(psf_fun, N_frames, height_px, width_px, rng_seed, np.dtype(dtype).str)
+
+################################################################################
+def load_psf_cube_params(band, 
+	out_dir = 'psfs'):
+	""" 
+		Returns a dictionary of the parameters used to generate the cube of 
+		PSFs in the given band, or None if they were not stored. 
+	"""
+	try:
+		with open(psf_cube_params_fname(band, out_dir), 'r') as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return None
+
+################################################################################
+def load_psf_cube(band, 
+	out_dir = 'psfs'):
+	""" 
+		Returns the cube of PSFs in the given band as a read-only memory-mapped 
+		array, so that frames are only read from disk when they are used 
+		(e.g. by lisim.lucky_frames()). 
+	"""
+	return np.load(psf_cube_fname(band, out_dir), mmap_mode = 'r')
+
+################################################################################
+def _psf_cube_worker(task):
+	"""
+		A private method used by generate_psf_cubes() to generate the PSFs in 
+		a single band in a worker process.
+	"""
+	tic = time.time()
+	psf_fun, band, N_frames, height_px, width_px, rng_seed, fname, dtype, overwrite_existing = task
+
+	params_fname = psf_cube_params_fname(band, os.path.dirname(fname))
+	params = {
+		'key' : psf_cube_key(psf_fun, N_frames, height_px, width_px, rng_seed, dtype),
+		'band' : band,
+		'N_frames' : N_frames,
+		'height_px' : height_px,
+		'width_px' : width_px,
+		'seed' : rng_seed,
+		'dtype' : np.dtype(dtype).str
+	}
+	# An existing cube is only reused if it was generated with the same 
+	# parameters. 
+	stored_params = load_psf_cube_params(band, os.path.dirname(fname))
+	skipped = os.path.isfile(fname) and not overwrite_existing and stored_params is not None and stored_params.get('key') == params['key']
+	if not skipped:
+		# Remove the parameters first so that they are never paired with a 
+		# cube other than the one they describe.
+		if os.path.isfile(params_fname):
+			os.remove(params_fname)
+		# Write to a temporary file first so that an incomplete cube is never 
+		# mistaken for a complete one.
+		tmp_fname = fname[:-len('.npy')] + '.tmp.npy'
+		psfs = np.lib.format.open_memmap(tmp_fname, mode = 'w+', dtype = dtype, shape = (N_frames, height_px, width_px))
+		k = 0
+		for psf in psf_fun(band, N_frames, rng_seed):
+			if k == N_frames:
+				break
+			psfs[k] = psf
+			k += 1
+		psfs.flush()
+		del psfs
+		if k < N_frames:
+			os.remove(tmp_fname)
+			print("ERROR: psf_fun returned {:d} PSFs in {}-band but {:d} were requested!".format(k, band, N_frames))
+			raise UserWarning
+		os.rename(tmp_fname, fname)
+		with open(params_fname, 'w') as f:
+			json.dump(params, f, indent = 4, sort_keys = True)
+
+	return {
+		'band' : band,
+		'fname' : fname,
+		'skipped' : skipped,
+		'seed' : rng_seed,
+		'time_s' : time.time() - tic
+	}
@@ -0,0 +1,91 @@
+################################################################################
+#
+# 	File:		rngutils.py
+#	Author:		Anna Zovaro
+#	Email:		anna.zovaro@anu.edu.au
+#
+#	Description:
+#	Reproducible random number streams for parallel and chunked simulations.
+#
+#	Copyright (C) 2016 Anna Zovaro
+#
+################################################################################
+#
+#	This file is part of linguinesim.
+#
+#	linguinesim is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	linguinesim is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with linguinesim.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+from __future__ import division, print_function
+import numpy as np
+import numbers
+
+################################################################################
+class FrameStreams(object):
+
+	def __init__(self, 
+		seed = None		# Integer seed (a random seed is chosen if None)
+		):
+		"""
+			A family of statistically independent random number streams, one 
+			per frame, derived from a single seed. 
+
+			The stream of frame k is a numpy Generator seeded with 
+			SeedSequence(seed, spawn_key = (k,)), so it depends only on seed 
+			and k. Hence frames can be generated in any order, in chunks or in 
+			separate processes and still be bit-for-bit identical to those 
+			generated serially. Instances are picklable, so they can be sent 
+			to worker processes.
+		"""
+		seed_seq = np.random.SeedSequence(seed)
+		self.entropy = seed_seq.entropy
+		self.spawn_key = tuple(seed_seq.spawn_key)
+
+	def frame(self, k):
+		""" Returns the random number generator of frame k. """
+		seed_seq = np.random.SeedSequence(self.entropy, spawn_key = self.spawn_key + (int(k),))
+		return np.random.Generator(np.random.PCG64(seed_seq))
+
+	def frames(self, start, stop):
+		""" Returns the random number generators of frames start to stop - 1. """
+		return [self.frame(k) for k in range(start, stop)]
+
+################################################################################
+def get_rng(rng = None):
+	"""
+		Returns a random number generator. rng may be
+			None 			the global numpy random state (np.random)
+			an integer 		a new Generator seeded with rng
+			a Generator or RandomState, which is returned as-is.
+	"""
+	if rng is None:
+		return np.random
+	if isinstance(rng, numbers.Integral):
+		return np.random.default_rng(rng)
+	return rng
+
+################################################################################
+def frame_rngs(rng, N_frames, 
+	first_frame = 0):
+	"""
+		Returns a list of the random number generators to use for each of 
+		N_frames frames, the first of which has index first_frame. 
+
+		If rng is a FrameStreams instance, then each frame gets its own 
+		stream; otherwise every frame draws from the single generator 
+		returned by get_rng(rng).
+	"""
+	if isinstance(rng, FrameStreams):
+		return rng.frames(first_frame, first_frame + N_frames)
+	return [get_rng(rng)] * N_frames
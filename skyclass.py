@@ -28,9 +28,13 @@
 #
 ################################################################################
 from __future__ import division, print_function
+import numpy as np
+from configclass import Config
 
 ################################################################################
-class Sky(object):
+class Sky(Config):
+
+	__slots__ = ['brightness', 'magnitude_system', 'T', 'eps']
 
 	def __init__(self, T,
 		eps=1.0,
@@ -47,10 +51,27 @@ class Sky(object):
 		# Temperature
 		self.T = T 	# (kelvin)
 
-		# Emissivity
+		# Emissivity: either a scalar or a function of wavelength (e.g. a 
+		# SkyEmissivity instance). A lambda cannot be pickled or hashed by 
+		# its contents, so use a SkyEmissivity or a module-level function 
+		# if the sky is to be sent to worker processes or used as a cache key.
 		self.eps = eps
-		
 
+################################################################################
+class SkyEmissivity(Config):
+
+	__slots__ = ['wavelengths_m', 'eps']
 
+	def __init__(self, wavelengths_m, eps):
+		"""
+			The emissivity of the sky as a function of wavelength (m), 
+			linearly interpolated between the values eps tabulated at 
+			wavelengths_m (e.g. 1 - the transmission of the atmosphere; see 
+			etc.get_sky_emissivity()). Instances are called like functions, 
+			but unlike a closure they can be pickled and hashed.
+		"""
+		self.wavelengths_m = np.asarray(wavelengths_m, dtype = float)
+		self.eps = np.asarray(eps, dtype = float)
 
-	
\ No newline at end of file
+	def __call__(self, wavelength_m):
+		return np.interp(wavelength_m, self.wavelengths_m, self.eps)
@@ -30,9 +30,15 @@
 from __future__ import division, print_function
 import numpy as np
 from linguineglobals import *
+from configclass import Config
 
 ################################################################################
-class Telescope(object):
+class Telescope(Config):
+
+	__slots__ = ['T', 'tau', 'efl_m', 'efl_mm', 'f_ratio', 
+		'plate_scale_as_mm', 'plate_scale_as_m', 'plate_scale_rad_mm', 'plate_scale_rad_m', 
+		'mirrors', '_N_mirrors', 'A_collecting_m2', 
+		'has_spider', 'A_spider_m2', 'eps_spider', 'eps_spider_eff']
 
 	def __init__(self,
 		efl_m,
@@ -94,7 +100,11 @@ class Telescope(object):
 		self.eps_spider_eff = A_spider_m2 / self.A_collecting_m2 * self.eps_spider
 
 ################################################################################
-class MirrorClass(object):
+class MirrorClass(Config):
+
+	__slots__ = ['R_outer_m', 'R_inner_m', 'D_outer_m', 'D_inner_m', 
+		'A_hole_m2', 'A_outer_m2', 'A_reflective_m2', 
+		'reflectivity', 'eps_reflective', 'eps_hole', 'eps_eff']
 
 	def __init__(self,
 		R_outer_m,